@@ -7,6 +7,8 @@ import numpy as np
 import os
 import json
 import shutil
+import threading
+from collections import OrderedDict
 
 try:
     import wbia
@@ -40,6 +42,8 @@ register_preproc_annot = controller_inject.register_preprocs['annot']
 _PLUGIN_FOLDER = os.path.dirname(os.path.realpath(__file__))
 _DEFAULT_CONFIG = os.path.join(_PLUGIN_FOLDER, 'configs/manta.json')
 _DEFAULT_CONFIG_DICT = {'config_path': _DEFAULT_CONFIG}
+# memory ceiling for chips held at once when computing embeddings in memory
+_EMBEDDING_MAX_MEMORY_MB = 1024
 
 
 MODEL_URLS = {
@@ -206,6 +210,8 @@ def pie_embedding(ibs, aid_list, config_path=None, augmentation_seed=None, use_d
         embeddings = ibs.depc_annot.get(
             'PieEmbedding', aid_list, 'embedding', config=config
         )
+        # rows cached before embeddings were stored as float32 are float64
+        embeddings = [np.asarray(emb, dtype=np.float32) for emb in embeddings]
     else:
         embeddings = pie_compute_embedding(
             ibs, aid_list, config_path=config_path, augmentation_seed=augmentation_seed
@@ -233,14 +239,83 @@ class PieEmbeddingConfig(dt.Config):  # NOQA
 @register_ibs_method
 def pie_embedding_depc(depc, aid_list, config):
     ibs = depc.controller
-    embs = pie_compute_embedding(
-        ibs,
-        aid_list,
-        config_path=config['config_path'],
-        augmentation_seed=config['augmentation_seed'],
-    )
+    config_path = config['config_path']
+    augmentation_seed = config['augmentation_seed']
+    # embeddings already computed in a batch of several seeds by pie_embedding_seeds
+    with _PRECOMPUTED_EMBEDDINGS_LOCK:
+        embs = [
+            _PRECOMPUTED_EMBEDDINGS.get((ibs.dbdir, config_path, augmentation_seed, aid))
+            for aid in aid_list
+        ]
+    missing_aids = [aid for aid, emb in zip(aid_list, embs) if emb is None]
+    if len(missing_aids) > 0:
+        missing_embs = iter(
+            pie_compute_embedding(
+                ibs,
+                missing_aids,
+                config_path=config_path,
+                augmentation_seed=augmentation_seed,
+            )
+        )
+        embs = [next(missing_embs) if emb is None else emb for emb in embs]
     for aid, emb in zip(aid_list, embs):
-        yield (np.array(emb),)
+        # the network outputs float32, stored as is (older float64 rows are cast on read
+        # by pie_embedding)
+        yield (np.asarray(emb, dtype=np.float32),)
+
+
+# Embeddings computed by pie_embedding_seeds, keyed by (dbdir, config_path,
+# augmentation_seed, aid), for pie_embedding_depc to store instead of computing them
+# again. Only accessed under the lock, as several databases or threads may share the
+# process.
+_PRECOMPUTED_EMBEDDINGS = {}
+_PRECOMPUTED_EMBEDDINGS_LOCK = threading.Lock()
+
+
+# Embeddings of aid_list for several augmentation seeds (test-time augmentation), one list
+# of embeddings per seed as returned by pie_embedding. Embeddings missing from the depc
+# are computed together, so each chip is read once whatever the number of seeds.
+@register_ibs_method
+def pie_embedding_seeds(ibs, aid_list, config_path=None, augmentation_seeds=(None,)):
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, aid_list)
+
+    augmentation_seeds = list(augmentation_seeds)
+    missing_seeds = []
+    missing_aids = set()
+    for augmentation_seed in augmentation_seeds:
+        config = {'config_path': config_path, 'augmentation_seed': augmentation_seed}
+        rowids = ibs.depc_annot.get_rowids(
+            'PieEmbedding', aid_list, config=config, ensure=False
+        )
+        seed_missing_aids = [aid for aid, rowid in zip(aid_list, rowids) if rowid is None]
+        if len(seed_missing_aids) > 0:
+            missing_seeds.append(augmentation_seed)
+            missing_aids.update(seed_missing_aids)
+
+    precomputed = {}
+    if len(missing_seeds) > 0:
+        missing_aids = sorted(missing_aids)
+        embs_per_seed = ibs.pie_compute_embedding_seeds(
+            missing_aids, config_path, missing_seeds
+        )
+        for augmentation_seed, embs in zip(missing_seeds, embs_per_seed):
+            for aid, emb in zip(missing_aids, embs):
+                precomputed[(ibs.dbdir, config_path, augmentation_seed, aid)] = emb
+        with _PRECOMPUTED_EMBEDDINGS_LOCK:
+            _PRECOMPUTED_EMBEDDINGS.update(precomputed)
+
+    try:
+        return [
+            ibs.pie_embedding(aid_list, config_path, augmentation_seed=augmentation_seed)
+            for augmentation_seed in augmentation_seeds
+        ]
+    finally:
+        # only the embeddings of this call, a concurrent call may have replaced some
+        with _PRECOMPUTED_EMBEDDINGS_LOCK:
+            for key, emb in precomputed.items():
+                if _PRECOMPUTED_EMBEDDINGS.get(key) is emb:
+                    del _PRECOMPUTED_EMBEDDINGS[key]
 
 
 # TODO: delete the generated files in dbpath when we're done computing embeddings
@@ -253,28 +328,51 @@ def pie_compute_embedding(
     prefix=None,
     export=False,
     augmentation_seed=None,
+    in_memory=True,
+    max_memory_mb=_EMBEDDING_MAX_MEMORY_MB,
 ):
+    r"""
+    Computes PIE embeddings for aid_list, in the order of aid_list.
+
+    By default chips are read, resized and embedded in memory, at most max_memory_mb
+    worth of chips at a time. The original PIE pipeline (write a name csv, preprocess
+    chips into per-name folders, read them back) is used when in_memory=False or when
+    the embeddings are exported to csv files.
+    """
     if config_path is None:
         config_path = _pie_config_fpath(ibs, aid_list)
+    with open(config_path, 'r') as f:
+        pie_config = json.load(f)
 
     pie_aids = aid_list
-    use_special_aids = ibs.pie_uses_special_annots(aid_list)
+    use_special_aids = _pie_uses_temp_annots(ibs, aid_list, pie_config)
     if use_special_aids:
         print('USE_SPECIAL_AIDS case in pie_compute_embedding')
         species = ibs.get_annot_species(aid_list[0])
         new_aids = SPECIAL_PIE_ANNOT_MAP[species]['modifying_func'](ibs, aid_list)
         pie_aids = new_aids
 
+    if in_memory and not export:
+        embeddings = _pie_compute_embedding_in_memory(
+            ibs, aid_list, pie_aids, config_path, augmentation_seed, max_memory_mb
+        )
+        if use_special_aids:
+            ibs.delete_annots(new_aids)
+        return embeddings
+
     preproc_dir = ibs.pie_preprocess(pie_aids, config_path=config_path)
     from .compute_db import compute
 
     # pie_aids might have a temporary species so we pass aid_list to _ensure
     _ensure_model_exists(ibs, aid_list, config_path)
 
-    embeddings, filepaths = compute(preproc_dir, config_path, output_dir, prefix, export)
-    embeddings = fix_pie_embedding_order(
-        ibs, embeddings, pie_aids, filepaths, config_path
-    )
+    try:
+        embeddings, filepaths = compute(
+            preproc_dir, config_path, output_dir, prefix, export
+        )
+    finally:
+        _pie_preproc_cache(ibs).release(preproc_dir)
+    embeddings = _order_by_preproc_index(embeddings, filepaths)
 
     # want to delete new_aids here
     if use_special_aids:
@@ -283,7 +381,177 @@ def pie_compute_embedding(
     return embeddings
 
 
+# Same as pie_compute_embedding (in memory) for several augmentation seeds: returns one
+# list of embeddings per seed, each in the order of aid_list. Augmented embeddings depend
+# on the batch an annot is augmented in, as with pie_compute_embedding.
+@register_ibs_method
+def pie_compute_embedding_seeds(
+    ibs,
+    aid_list,
+    config_path=None,
+    augmentation_seeds=(None,),
+    max_memory_mb=_EMBEDDING_MAX_MEMORY_MB,
+):
+    from .compute_db import compute_files_seeds
+
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, aid_list)
+    with open(config_path, 'r') as f:
+        pie_config = json.load(f)
+
+    pie_aids = aid_list
+    use_special_aids = _pie_uses_temp_annots(ibs, aid_list, pie_config)
+    if use_special_aids:
+        species = ibs.get_annot_species(aid_list[0])
+        new_aids = SPECIAL_PIE_ANNOT_MAP[species]['modifying_func'](ibs, aid_list)
+        pie_aids = new_aids
+
+    chip_inputs, load_imgs = _pie_embedding_chip_inputs(ibs, pie_aids, pie_config)
+    _ensure_model_exists(ibs, aid_list, config_path)
+
+    embs_per_seed = compute_files_seeds(
+        chip_inputs,
+        config_path,
+        augmentation_seeds,
+        max_memory_mb=max_memory_mb,
+        load_imgs=load_imgs,
+    )
+    if use_special_aids:
+        ibs.delete_annots(new_aids)
+    return embs_per_seed
+
+
+def _pie_compute_embedding_in_memory(
+    ibs, aid_list, pie_aids, config_path, augmentation_seed=None, max_memory_mb=None
+):
+    # chips go straight from their fpaths into uint8 batches, so the embeddings come
+    # back in the order of pie_aids (and so aid_list) by construction
+    from .compute_db import compute_files
+
+    with open(config_path, 'r') as f:
+        pie_config = json.load(f)
+
+    chip_inputs, load_imgs = _pie_embedding_chip_inputs(ibs, pie_aids, pie_config)
+
+    # pie_aids might have a temporary species so we pass aid_list to _ensure
+    _ensure_model_exists(ibs, aid_list, config_path)
+
+    embeddings = compute_files(
+        chip_inputs,
+        config_path,
+        augmentation_seed,
+        max_memory_mb=max_memory_mb,
+        load_imgs=load_imgs,
+    )
+    return embeddings
+
+
+# Inputs of compute_files for the embedding chips of aid_list: chip fpaths, read by the
+# default loader, or with "fused_chips": true in the model section of the PIE config, chip
+# specs read by _load_fused_chips
+def _pie_embedding_chip_inputs(ibs, aid_list, pie_config):
+    if pie_config['model'].get('fused_chips', False):
+        return _pie_fused_chip_specs(ibs, aid_list, pie_config), _load_fused_chips
+    return _pie_embedding_chip_fpaths(ibs, aid_list, pie_config)[0], None
+
+
+# Chip fpaths embeddings are computed on, and whether each chip is flipped. Special annots
+# are cropped virtually, and like the temporary annots embeddings were computed on before
+# (whose temporary species is not in FLIP_RIGHTSIDE_MODELS), they are never flipped.
+def _pie_embedding_chip_fpaths(ibs, aid_list, pie_config):
+    if _pie_uses_virtual_annots(ibs, aid_list, pie_config):
+        flip_list = [False] * len(aid_list)
+        return _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list), flip_list
+    chip_fpaths = ibs.pie_annot_embedding_chip_fpaths(aid_list, pie_config)
+    return chip_fpaths, _pie_flip_list(ibs, aid_list)
+
+
+# Fused chip extraction: network-ready chips are cut straight out of their images (crop,
+# optional flip, resize, optional background mask), as the wbia chip, background
+# subtraction and preprocessing steps would produce them, but without writing or reading
+# back any intermediate file. Specs hold what the loader threads need, gathered from the
+# controller up front: (image path, orientation, image-to-chip transform, flip, probchip
+# fpath or None).
+def _pie_fused_chip_specs(ibs, aid_list, pie_config):
+    width = int(pie_config['model']['input_width'])
+    height = int(pie_config['model']['input_height'])
+    use_background_subtract = pie_config['model'].get('background_subtract', False)
+
+    if _pie_uses_virtual_annots(ibs, aid_list, pie_config):
+        bbox_list = _pie_virtual_bboxes(ibs, aid_list)
+        theta_list = [0.0] * len(aid_list)
+        flip_list = [False] * len(aid_list)
+    else:
+        bbox_list = ibs.get_annot_bboxes(aid_list)
+        theta_list = ibs.get_annot_thetas(aid_list)
+        flip_list = _pie_flip_list(ibs, aid_list)
+    if use_background_subtract:
+        config2_ = {
+            'fw_detector': 'cnn',
+        }
+        mask_path_list = ibs.get_annot_probchip_fpath(aid_list, config2_=config2_)
+    else:
+        mask_path_list = None
+    return _pie_chip_specs(
+        ibs, aid_list, (width, height), bbox_list, theta_list, flip_list, mask_path_list
+    )
+
+
+def _pie_chip_specs(
+    ibs, aid_list, size, bbox_list, theta_list, flip_list, mask_path_list=None
+):
+    gid_list = ibs.get_annot_gids(aid_list)
+    gpath_list = ibs.get_image_paths(gid_list)
+    orient_list = ibs.get_image_orientation(gid_list)
+    M_list = [
+        vt.get_image_to_chip_transform(bbox, size, theta)
+        for bbox, theta in zip(bbox_list, theta_list)
+    ]
+    if mask_path_list is None:
+        mask_path_list = [None] * len(aid_list)
+    return list(zip(gpath_list, orient_list, M_list, flip_list, mask_path_list))
+
+
+def _load_fused_chips(chip_specs, size):
+    import cv2
+    from .utils.preprocessing import multiply_by_masks
+
+    # warped as in wbia's chip computation, then channels are reordered to RGB as
+    # load_resized_imgs returns them
+    warpkw = dict(flags=cv2.INTER_LANCZOS4, borderMode=cv2.BORDER_CONSTANT)
+    chips = np.zeros((len(chip_specs), size[1], size[0], 3), dtype=np.uint8)
+    masks = None
+    masked = np.zeros(len(chip_specs), dtype=bool)
+
+    # annots of the same image are cut from a single read of the image
+    imgs = {}
+    for index, (gpath, orient, M, flip, mask_path) in enumerate(chip_specs):
+        if (gpath, orient) not in imgs:
+            imgs[(gpath, orient)] = vt.imread(gpath, orient=orient)
+        chip = cv2.warpAffine(imgs[(gpath, orient)], M[0:2], tuple(size), **warpkw)
+        if flip:
+            chip = cv2.flip(chip, 1)
+        chips[index] = chip
+        if mask_path is not None:
+            mask = vt.resize_mask(vt.imread(mask_path), chip)
+            if masks is None:
+                masks = np.zeros(chips.shape, dtype=np.uint8)
+            if flip:
+                mask = np.fliplr(mask)
+            masks[index] = mask
+            masked[index] = True
+
+    if masks is not None:
+        chips[masked] = multiply_by_masks(chips[masked], masks[masked])
+    return np.ascontiguousarray(chips[..., ::-1])
+
+
 def _ensure_model_exists(ibs, aid_list, config_path):
+    species = ibs.get_annot_species_texts(aid_list[0])
+    return _ensure_species_model_exists(species, config_path)
+
+
+def _ensure_species_model_exists(species, config_path):
 
     # get expected model location from config file. Couple lines copied from Olga's compute_db.py
 
@@ -299,92 +567,127 @@ def _ensure_model_exists(ibs, aid_list, config_path):
     if os.path.isfile(local_fpath):
         return True
 
-    species = ibs.get_annot_species_texts(aid_list[0])
     model_url = MODEL_URLS[species]
     # download the model and put it in the model_folder
     ut.grab_file_url(model_url, download_dir=exp_folder, fname=local_fpath)
     return True
 
 
-def fix_pie_embedding_order(ibs, embeddings, aid_list, filepaths, config_path):
-    filepaths = [_get_parent_dir_and_fname_only(fpath) for fpath in filepaths]
-    # PIE messes with extensions, so throw those away
-    filepaths = [os.path.splitext(fp)[0] for fp in filepaths]
-
-    names = ibs.get_annot_name_texts(aid_list)
-
-    with open(config_path, 'r') as f:
-        pie_config = json.load(f)
-
-    chip_paths = ibs.pie_annot_embedding_chip_fpaths(aid_list, pie_config)
-    fnames = [os.path.split(fname)[1] for fname in chip_paths]
-    aid_filepaths = [os.path.join(name, fname) for name, fname in zip(names, fnames)]
-    # PIE messes with extensions, so throw those away
-    aid_filepaths = [os.path.splitext(fp)[0] for fp in aid_filepaths]
-
-    # aid_filepaths and filepaths have the same entries in different orders
-    filepath_to_idx = {filepaths[i]: i for i in range(len(filepaths))}
-
-    def sorted_embedding(i):
-        key = aid_filepaths[i]
-        idx = filepath_to_idx[key]
-        emb = embeddings[idx]
-        return emb
+@register_ibs_method
+def pie_warmup(ibs, species_list=None):
+    r"""
+    Preload PIE models so the first embedding request per species does not pay for
+    building the network and reading its weights. Models stay resident in the process,
+    see registry.py.
 
-    sorted_embs = [sorted_embedding(i) for i in range(len(aid_list))]
-    return sorted_embs
+    Args:
+        ibs          (IBEISController): IBEIS / WBIA controller object
+        species_list (list of str): species texts to load models for; defaults to every
+            species with a PIE config. Species without a PIE config and model are
+            skipped with a warning
 
+    CommandLine:
+        python -m wbia_pie._plugin pie_warmup
 
-def _get_parent_dir_and_fname_only(fpath):
-    parent_path, fname = os.path.split(fpath)
-    parent_dir = os.path.split(parent_path)[1]
-    parent_dir_and_fname = os.path.join(parent_dir, fname)
-    return parent_dir_and_fname
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> import wbia_pie
+        >>> ibs = wbia_pie._plugin.pie_testdb_ibs()
+        >>> config_paths = ibs.pie_warmup(['manta_ray_giant'])
+        >>> assert config_paths == [wbia_pie._plugin.CONFIG_FPATHS['manta_ray_giant']]
+    """
+    from .registry import warmup
 
+    if species_list is None:
+        species_list = sorted(CONFIG_FPATHS.keys())
 
-# This function calls the PIE image preprocessing method preproc_db.preproc,
-# whose input is a folder full of pre-cropped images. preproc then resizes all
-# images to dimensions specified in the config file and organizes the resized
-# images in sub-folders for each label (name). These folders will be read by
-# PIE's embedding-compute function later.
+    # several species share a config, load each model once
+    config_paths = []
+    for species in species_list:
+        if species not in CONFIG_FPATHS or species not in MODEL_URLS:
+            logger.warning('PIE has no model for species %r, not warmed up' % (species,))
+            continue
+        config_path = CONFIG_FPATHS[species]
+        if config_path not in config_paths:
+            _ensure_species_model_exists(species, config_path)
+            config_paths.append(config_path)
+
+    warmup(config_paths)
+    logger.info('PIE warmed up %s models for %s' % (len(config_paths), species_list))
+    return config_paths
+
+
+# PIE reads preprocessed chips in folder order. Their file names start with the index of
+# their aid in the aid_list given to pie_preprocess, which puts embeddings back in order.
+def _order_by_preproc_index(embeddings, filepaths):
+    index_list = [_preproc_fpath_index(fpath) for fpath in filepaths]
+    assert sorted(index_list) == list(range(len(index_list))), 'missing preproc chips'
+    ordered = np.empty_like(embeddings)
+    ordered[index_list] = embeddings
+    return ordered
+
+
+def _preproc_fpath_index(fpath):
+    return int(os.path.basename(fpath).split('.', 1)[0])
+
+
+# Preprocesses (resizes to the network input and converts to png) the embedding chips of
+# aid_list and organizes them in sub-folders for each label (name), as read by PIE's
+# embedding-compute function. Files are named '<index in aid_list>.<chip name>.png', so
+# results read back in folder order can be put in the order of aid_list, and the same
+# chip name under the same label (e.g. a repeated aid) does not collide. Preprocessed
+# chips come from a content-addressed cache under ibs.cachedir shared by every call (see
+# utils/preproc_cache.py), so a chip is only preprocessed again when it changes, whatever
+# the set of aids it is requested with. The returned folder belongs to the caller, who
+# removes it with _pie_preproc_cache(ibs).release once it has been read.
 @register_ibs_method
 def pie_preprocess(ibs, aid_list, config_path=None):
     if config_path is None:
         config_path = _pie_config_fpath(ibs, aid_list)
 
-    output_dir = pie_preproc_dir(aid_list, config_path)
-    label_file_path = os.path.join(output_dir, 'name_map.csv')
-    label_file = ibs.pie_name_csv(
-        aid_list, fpath=label_file_path, config_path=config_path
-    )
-
     with open(config_path, 'r') as f:
         pie_config = json.load(f)
-    use_background_subtract = pie_config['model'].get('background_subtract', False)
-    if use_background_subtract:
-        chip_path = _bg_subtract_chip_path(pie_config)
-    else:
-        chip_path = os.path.join(ibs.cachedir, 'extern_chips')
-    from .preproc_db import preproc
+    size = (pie_config['model']['input_width'], pie_config['model']['input_height'])
+
+    chip_fpaths, flip_list = _pie_embedding_chip_fpaths(ibs, aid_list, pie_config)
+    names = ibs.get_annot_name_texts(aid_list)
+    fnames = [
+        '%d.%s.png' % (index, os.path.splitext(os.path.basename(fpath))[0])
+        for index, fpath in enumerate(chip_fpaths)
+    ]
 
-    dbpath = preproc(chip_path, config_path, lfile=label_file, output=output_dir)
+    cache = _pie_preproc_cache(ibs)
+    dbpath = cache.dataset(chip_fpaths, size, names, fnames, flips=flip_list)
+    logger.info('PIE preprocess for %d aids returning %s' % (len(aid_list), dbpath))
     return dbpath
 
 
-# pie's preprocess works on every image in a folder, so we put 'em in a folder
-def pie_preproc_dir(aid_list, config_path):
+_PREPROC_CACHE_MAX_MB = 4096
+_PREPROC_CACHES = {}
 
-    # hash the aid_list to make a unique folder name
-    unique_prefix = str(hash(tuple(aid_list)))
-    with open(config_path) as config_file:
-        config = json.loads(config_file.read())
-    conf_output_dir = config['prod']['output']
-    output_dir = os.path.join(_PLUGIN_FOLDER, conf_output_dir, unique_prefix)
-    if not os.path.isdir(output_dir):
-        logger.info('PIE preproc_dir creating output directory %s' % output_dir)
-        os.makedirs(output_dir)
-    logger.info('PIE preproc_dir for aids %s returning %s' % (aid_list, output_dir))
-    return output_dir
+
+def _pie_preproc_cache(ibs):
+    from .utils.preproc_cache import PreprocCache
+
+    folder = os.path.join(ibs.cachedir, 'pie_preproc')
+    if folder not in _PREPROC_CACHES:
+        _PREPROC_CACHES[folder] = PreprocCache(folder, max_mb=_PREPROC_CACHE_MAX_MB)
+    return _PREPROC_CACHES[folder]
+
+
+# Number and size of the preprocessed chips cached by pie_preprocess, and cache hits and
+# misses in this process
+@register_ibs_method
+def pie_cache_stats(ibs):
+    return _pie_preproc_cache(ibs).stats()
+
+
+# Evicts least recently used preprocessed chips until the cache fits in max_mb
+# (default _PREPROC_CACHE_MAX_MB, 0 empties the cache), and removes the preprocessed
+# datasets left by processes that are no longer running
+@register_ibs_method
+def pie_cache_gc(ibs, max_mb=None):
+    return _pie_preproc_cache(ibs).gc(max_mb=max_mb)
 
 
 # PIE's preproc and embed funcs require a .csv file linking filnames to labels (names)
@@ -419,12 +722,26 @@ def _write_csv_dicts(csv_dicts, fpath):
         dict_writer.writerows(csv_dicts)
 
 
+# Bound on the number of database embeddings searched per query by the adaptive kNN
+# search (see evaluate_accuracy.adaptive_k_neigh), so queries against databases with
+# fewer names than n_results do not end up scanning every embedding
+_PIE_SEARCH_MAX_DEPTH = 4096
+
+
 class PieConfig(dt.Config):  # NOQA
     def get_param_info_list(self):
         return [
             ut.ParamInfo('config_path', None),
             ut.ParamInfo('query_aug_seeds', [None]),
             ut.ParamInfo('db_aug_seeds', [None]),
+            # 'annot': search every database annotation, 'name': search per-name
+            # representatives then re-rank the shortlisted names (see pie_name_index)
+            ut.ParamInfo(
+                'search_level', 'annot', valid_values=['annot', 'name'], hideif='annot'
+            ),
+            ut.ParamInfo(
+                'max_depth', _PIE_SEARCH_MAX_DEPTH, hideif=_PIE_SEARCH_MAX_DEPTH
+            ),
         ]
 
 
@@ -524,50 +841,38 @@ class PieRequest(dt.base.VsOneSimilarityRequest):
 def wbia_plugin_pie(depc, qaid_list, daid_list, config):
     ibs = depc.controller
 
-    qaids = list(set(qaid_list))
-    daids = list(set(daid_list))
-
-    assert len(qaids) == 1
-    qaid = qaids[0]
+    # Queries are grouped by their set of daids, and each group is matched with one
+    # batched call for all augmentation seeds (usually a single group of all qaids)
+    qaid_to_daids = ut.ddict(set)
+    for qaid, daid in zip(qaid_list, daid_list):
+        qaid_to_daids[qaid].add(daid)
+    daids_to_qaids = ut.ddict(list)
+    for qaid, daids in qaid_to_daids.items():
+        daids_to_qaids[frozenset(daids)].append(qaid)
 
     query_aug_seeds = config['query_aug_seeds']
     db_aug_seeds = config['db_aug_seeds']
     assert len(query_aug_seeds) > 0
     assert len(db_aug_seeds) > 0
 
-    import itertools as it
-
-    all_aug_seed_pairs = it.product(query_aug_seeds, db_aug_seeds)
-    # herein 'pie_' prefix means the var is in the original PIE match result format,
-    # a list of {"label": ____, "distance": ____} dicts.
-    pie_name_scores_per_aug = []
-
-    # get name scores for every pair of augmentation seeds
-    for query_aug_seed, db_aug_seed in all_aug_seed_pairs:
-        pie_name_dists = ibs.pie_predict_light(
-            qaid,
+    qaid_to_aid_scores = {}
+    for daids, qaids in daids_to_qaids.items():
+        daids = sorted(daids)
+        # scores averaged over every pair of augmentation seeds
+        aid_scores = ibs.pie_predict_tta(
+            qaids,
             daids,
             config['config_path'],
-            query_aug_seed,
-            db_aug_seed,
+            query_aug_seeds,
+            db_aug_seeds,
+            search_level=config['search_level'],
+            max_depth=config['max_depth'],
         )
-        # pie_name_dists looks like
-        # [{'distance': 0.4188250198219591, 'label': '2642'},
-        # {'distance': 0.46805998920189135, 'label': '1616'},
-        # {'distance': 0.6673709053342388, 'label': '1131'},
-        # {'distance': 0.6690026353505921, 'label': '3623'},
-        # {'distance': 1.1676843213624326, 'label': '1971'},
-        # {'distance': 2.377146577694036, 'label': '1804'}]
-        pie_name_scores = distance_dicts_to_score_dicts(pie_name_dists)
-        pie_name_scores_per_aug.append(pie_name_scores)
-
-    avg_name_scores = average_pie_name_score_dicts(pie_name_scores_per_aug)
-
-    aid_score_list = aid_scores_from_name_scores(ibs, avg_name_scores, daids)
-    aid_score_dict = dict(zip(daids, aid_score_list))
-
-    for daid in daid_list:
-        daid_score = aid_score_dict.get(daid)
+        for qaid, aid_score_list in zip(qaids, aid_scores.tolist()):
+            qaid_to_aid_scores[qaid] = dict(zip(daids, aid_score_list))
+
+    for qaid, daid in zip(qaid_list, daid_list):
+        daid_score = qaid_to_aid_scores[qaid].get(daid)
         yield (daid_score,)
 
 
@@ -664,6 +969,7 @@ def pie_predict_light(
     query_aug_seed=None,
     db_aug_seed=None,
     n_results=100,
+    max_depth=_PIE_SEARCH_MAX_DEPTH,
 ):
     r"""
     Matches an annotation using PIE, by calling PIE's k-means distance measure on PIE embeddings.
@@ -710,19 +1016,383 @@ def pie_predict_light(
     if config_path is None:
         config_path = _pie_config_fpath(ibs, [qaid])
 
-    db_embs = ibs.pie_embedding(daid_list, config_path, augmentation_seed=db_aug_seed)
+    index = ibs.pie_neighbor_index(daid_list, config_path, augmentation_seed=db_aug_seed)
     query_emb = ibs.pie_embedding([qaid], config_path, augmentation_seed=query_aug_seed)
     db_labels = _db_labels_for_pie(ibs, daid_list)
 
     from .predict import pred_light
 
-    nearest_neighbors_cache_path = os.path.join(ibs.cachedir, 'pie_neighbors')
-    ut.ensuredir(nearest_neighbors_cache_path)
-
-    ans = pred_light(query_emb, db_embs, db_labels, config_path, n_results)
+    ans = pred_light(
+        query_emb,
+        None,
+        db_labels,
+        config_path,
+        n_results,
+        nn_classifier=index.view(daid_list),
+        adaptive=True,
+        max_depth=max_depth,
+    )
     return ans
 
 
+@register_ibs_method
+def pie_predict_batch(
+    ibs,
+    qaid_list,
+    daid_list,
+    config_path=None,
+    query_aug_seed=None,
+    db_aug_seed=None,
+    n_results=100,
+    search_level='annot',
+    max_depth=_PIE_SEARCH_MAX_DEPTH,
+):
+    r"""
+    Matches many annotations against the same database at once: the database is indexed
+    once and all query embeddings are searched with a single kNN call.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        qaid_list       (int): query annots
+        daid_list       (int): database annots
+        config_path (str): path to a PIE config .json file that parameterizes the model
+            and directs PIE to the weight file, among other fields
+        search_level (str): 'annot' to search every database annot, 'name' to search
+            names with pie_name_index (faster on large databases, approximate shortlist)
+        max_depth (int): bound on the number of database embeddings searched per query
+
+    Returns:
+        list of name distance dicts per qaid, as returned by pie_predict_light
+
+    CommandLine:
+        python -m wbia_pie._plugin pie_predict_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie
+        >>> import numpy as np
+        >>> ibs = wbia_pie._plugin.pie_testdb_ibs()
+        >>> aids = ibs.get_valid_aids(species='Mobula birostris')
+        >>> qaids = aids[:3]
+        >>> preds = ibs.pie_predict_batch(qaids, aids)
+        >>> for qaid, pred in zip(qaids, preds):
+        >>>     pred_light = ibs.pie_predict_light(qaid, aids)
+        >>>     assert [p['label'] for p in pred] == [p['label'] for p in pred_light]
+        >>>     diffs = [abs(p1['distance'] - p2['distance']) for p1, p2 in zip(pred, pred_light)]
+        >>>     assert max(diffs) < 1e-6
+    """
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, qaid_list)
+
+    query_embs = ibs.pie_embedding(
+        qaid_list, config_path, augmentation_seed=query_aug_seed
+    )
+    return _pie_search_db(
+        ibs,
+        query_embs,
+        daid_list,
+        config_path,
+        db_aug_seed,
+        n_results,
+        search_level,
+        max_depth,
+    )
+
+
+def _pie_search_db(
+    ibs,
+    query_embs,
+    daid_list,
+    config_path,
+    db_aug_seed=None,
+    n_results=100,
+    search_level='annot',
+    max_depth=_PIE_SEARCH_MAX_DEPTH,
+):
+    # name distance dicts of every query embedding against the embeddings of daid_list,
+    # searched with a single kNN call
+    index = ibs.pie_neighbor_index(daid_list, config_path, augmentation_seed=db_aug_seed)
+    db_labels = _db_labels_for_pie(ibs, daid_list)
+
+    name_index = None
+    if search_level == 'name':
+        name_index = ibs.pie_name_index(daid_list, config_path, db_aug_seed)
+    else:
+        assert search_level == 'annot', 'Unknown search_level %r' % (search_level,)
+
+    # approximate backend if the config asks for one, exact search of the index otherwise
+    nn_classifier = ibs.pie_ann_index(daid_list, config_path, db_aug_seed)
+    if nn_classifier is None:
+        nn_classifier = index.view(daid_list)
+
+    from .predict import pred_light_batch
+
+    ans_list = pred_light_batch(
+        np.asarray(query_embs, dtype=np.float32),
+        None,
+        db_labels,
+        config_path,
+        n_results,
+        nn_classifier=nn_classifier,
+        adaptive=True,
+        name_index=name_index,
+        max_depth=max_depth,
+    )
+    return ans_list
+
+
+@register_ibs_method
+def pie_predict_tta(
+    ibs,
+    qaid_list,
+    daid_list,
+    config_path=None,
+    query_aug_seeds=(None,),
+    db_aug_seeds=(None,),
+    n_results=100,
+    search_level='annot',
+    max_depth=_PIE_SEARCH_MAX_DEPTH,
+):
+    r"""
+    Matches qaid_list against daid_list with test-time augmentation: name scores are
+    averaged over every pair of query and database augmentation seeds, then spread over
+    the annots of each name.
+
+    The embeddings of every query seed (and of every database seed) are computed in one
+    batched pass, each database seed is searched once with the queries of all seeds,
+    and scores of all pairs are averaged in a single step.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        qaid_list       (int): query annots
+        daid_list       (int): database annots
+        query_aug_seeds (list): augmentation seeds of the queries, None for no augmentation
+        db_aug_seeds    (list): augmentation seeds of the database
+        search_level (str): 'annot' or 'name', see pie_predict_batch
+        max_depth (int): see pie_predict_batch
+
+    Returns:
+        float array (len(qaid_list), len(daid_list)) of annot scores, the same as
+        aid_scores_from_name_scores of average_pie_name_score_dicts over all seed pairs
+
+    CommandLine:
+        python -m wbia_pie._plugin pie_predict_tta
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie
+        >>> import numpy as np
+        >>> import itertools as it
+        >>> from wbia_pie._plugin import average_pie_name_score_dicts, distance_dicts_to_score_dicts
+        >>> ibs = wbia_pie._plugin.pie_testdb_ibs()
+        >>> aids = ibs.get_valid_aids(species='Mobula birostris')
+        >>> qaids = aids[:3]
+        >>> query_aug_seeds, db_aug_seeds = [None, 1], [None, 2]
+        >>> aid_scores = ibs.pie_predict_tta(qaids, aids, None, query_aug_seeds, db_aug_seeds)
+        >>> scores_per_aug = [[] for _ in qaids]
+        >>> for query_aug_seed, db_aug_seed in it.product(query_aug_seeds, db_aug_seeds):
+        >>>     preds = ibs.pie_predict_batch(qaids, aids, None, query_aug_seed, db_aug_seed)
+        >>>     for scores, pred in zip(scores_per_aug, preds):
+        >>>         scores.append(distance_dicts_to_score_dicts(pred))
+        >>> for scores, qaid_scores in zip(scores_per_aug, aid_scores):
+        >>>     name_scores = average_pie_name_score_dicts(scores)
+        >>>     expected = ibs.aid_scores_from_name_scores(name_scores, aids)
+        >>>     assert np.abs(np.array(expected) - qaid_scores).max() < 1e-6
+    """
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, qaid_list)
+
+    query_aug_seeds = list(query_aug_seeds)
+    db_aug_seeds = list(db_aug_seeds)
+    num_queries = len(qaid_list)
+
+    # one batched inference per set of seeds. Query embeddings are stacked seed by seed,
+    # so row i is query i % num_queries
+    query_embs = ibs.pie_embedding_seeds(qaid_list, config_path, query_aug_seeds)
+    query_embs = np.concatenate(
+        [np.asarray(embs, dtype=np.float32) for embs in query_embs], axis=0
+    )
+    ibs.pie_embedding_seeds(daid_list, config_path, db_aug_seeds)
+
+    db_labels = _db_labels_for_pie(ibs, daid_list)
+    names, daid_name_codes = np.unique(db_labels, return_inverse=True)
+    name_to_code = {name: code for code, name in enumerate(names)}
+
+    # herein 'pie_' prefix means the var is in the original PIE match result format,
+    # a list of {"label": ____, "distance": ____} dicts.
+    query_rows, name_codes, distances = [], [], []
+    for db_aug_seed in db_aug_seeds:
+        # every query seed is searched at once against the index of this database seed
+        pie_name_dists_list = _pie_search_db(
+            ibs,
+            query_embs,
+            daid_list,
+            config_path,
+            db_aug_seed,
+            n_results,
+            search_level,
+            max_depth,
+        )
+        for row, pie_name_dists in enumerate(pie_name_dists_list):
+            query_rows += [row % num_queries] * len(pie_name_dists)
+            name_codes += [name_to_code[pred['label']] for pred in pie_name_dists]
+            distances += [pred['distance'] for pred in pie_name_dists]
+
+    # names missing from the results of a pair of seeds score 0 for that pair,
+    # as in average_pie_name_score_dicts
+    num_pairs = len(query_aug_seeds) * len(db_aug_seeds)
+    name_scores = np.zeros((num_queries, len(names)))
+    np.add.at(
+        name_scores,
+        (np.array(query_rows, dtype=np.int64), np.array(name_codes, dtype=np.int64)),
+        distance_to_score(np.array(distances, dtype=np.float64)),
+    )
+    name_scores /= num_pairs
+
+    # as in aid_scores_from_name_scores, a name score is split between its annots
+    name_counts = np.bincount(daid_name_codes, minlength=len(names))
+    aid_scores = name_scores[:, daid_name_codes] / name_counts[daid_name_codes]
+    return aid_scores
+
+
+# Derived indexes (name-level, approximate) of recently queried databases
+_DB_INDEXES = OrderedDict()
+_MAX_DB_INDEXES = 4
+
+
+def _cached_db_index(index_key, build_func):
+    db_index = _DB_INDEXES.pop(index_key, None)
+    if db_index is None:
+        db_index = build_func()
+    _DB_INDEXES[index_key] = db_index
+    while len(_DB_INDEXES) > _MAX_DB_INDEXES:
+        _DB_INDEXES.popitem(last=False)
+    return db_index
+
+
+# Returns the approximate nearest neighbour index of daid_list selected by the "predict"
+# section of the config (see evaluation/ann.py), or None for exact search. Fitted indexes
+# (float16 copy, PQ codes and codebooks, IVF lists) are saved next to the neighbor index
+# and memory-mapped from there, so they are fitted once for all processes, and only the
+# _MAX_DB_INDEXES most recently saved ones are kept per config and backend. When the
+# embeddings change, they are assigned to the centroids or codebooks of the most recently
+# saved index, and k-means is only run again once the quantisation error has drifted by
+# more than the "ann_retrain_drift" of the config (RETRAIN_DRIFT by default).
+@register_ibs_method
+def pie_ann_index(ibs, daid_list, config_path=None, augmentation_seed=None):
+    from .evaluation.ann import (
+        make_nn_classifier,
+        nn_backend_name,
+        load_nn_index,
+        RETRAIN_DRIFT,
+    )
+
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, daid_list)
+
+    with open(config_path) as config_buffer:
+        nn_params = json.loads(config_buffer.read()).get('predict', {})
+    if nn_backend_name(nn_params) == 'exact':
+        return None
+
+    digest = ibs.pie_embedding_digest(daid_list, config_path, augmentation_seed)
+    ann_dpath = os.path.join(
+        _pie_neighbor_index_dpath(ibs, config_path, augmentation_seed),
+        'ann',
+        nn_backend_name(nn_params),
+    )
+
+    def build():
+        saved_dpath = os.path.join(ann_dpath, digest)
+        if not os.path.isdir(saved_dpath):
+            index = ibs.pie_neighbor_index(daid_list, config_path, augmentation_seed)
+            db_embs = index.embeddings[index.rows(daid_list)]
+            ann_index = _latest_pie_ann_index(ann_dpath)
+            if ann_index is not None:
+                drift = ann_index.assign(db_embs)
+                if drift > nn_params.get('ann_retrain_drift', RETRAIN_DRIFT):
+                    logger.info('PIE quantisation error drifted by %.2f' % drift)
+                    ann_index = None
+            if ann_index is None:
+                logger.info('PIE fitting %s index' % nn_backend_name(nn_params))
+                ann_index = make_nn_classifier(nn_params).fit(db_embs)
+            _save_pie_ann_index(ann_index, ann_dpath, digest)
+        return load_nn_index(saved_dpath)
+
+    index_key = (nn_backend_name(nn_params), digest)
+    return _cached_db_index(index_key, build)
+
+
+def _saved_pie_ann_dpaths(ann_dpath):
+    # most recently saved first
+    if not os.path.isdir(ann_dpath):
+        return []
+    saved_dpaths = [
+        os.path.join(ann_dpath, name)
+        for name in os.listdir(ann_dpath)
+        if not name.endswith('.tmp')
+    ]
+    saved_dpaths.sort(key=_mtime_or_zero, reverse=True)
+    return saved_dpaths
+
+
+def _mtime_or_zero(fpath):
+    try:
+        return os.path.getmtime(fpath)
+    except OSError:
+        return 0
+
+
+def _latest_pie_ann_index(ann_dpath):
+    from .evaluation.ann import load_nn_index
+
+    for saved_dpath in _saved_pie_ann_dpaths(ann_dpath):
+        try:
+            return load_nn_index(saved_dpath)
+        except (IOError, OSError):
+            # removed meanwhile by another process
+            continue
+    return None
+
+
+def _save_pie_ann_index(ann_index, ann_dpath, digest):
+    from .evaluation.ann import save_nn_index
+
+    ut.ensuredir(ann_dpath)
+    try:
+        save_nn_index(ann_index, os.path.join(ann_dpath, digest))
+    except OSError:
+        # saved meanwhile by another process
+        if not os.path.isdir(os.path.join(ann_dpath, digest)):
+            raise
+    for saved_dpath in _saved_pie_ann_dpaths(ann_dpath)[_MAX_DB_INDEXES:]:
+        # files memory-mapped by other processes stay readable until they close them
+        shutil.rmtree(saved_dpath, ignore_errors=True)
+
+
+# Returns a NameIndex over the embeddings of daid_list and their names, rebuilt when the
+# embeddings (digest of the neighbor index) or the names of the database change.
+@register_ibs_method
+def pie_name_index(ibs, daid_list, config_path=None, augmentation_seed=None):
+    from .neighbors import NameIndex
+
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, daid_list)
+
+    db_labels = _db_labels_for_pie(ibs, daid_list)
+
+    def build():
+        index = ibs.pie_neighbor_index(daid_list, config_path, augmentation_seed)
+        return NameIndex(index.embeddings[index.rows(daid_list)], db_labels)
+
+    index_key = (
+        'name',
+        ibs.pie_embedding_digest(daid_list, config_path, augmentation_seed),
+        ut.hash_data(db_labels.tolist()),
+    )
+    return _cached_db_index(index_key, build)
+
+
 def _db_labels_for_pie(ibs, daid_list):
     db_labels = ibs.get_annot_name_texts(daid_list)
     db_auuids = ibs.get_annot_semantic_uuids(daid_list)
@@ -735,26 +1405,105 @@ def _db_labels_for_pie(ibs, daid_list):
     return db_labels
 
 
+# Nearest neighbour indexes of PIE embeddings, one per (config, augmentation seed),
+# shared by every database queried with that config: see neighbors.py
+_NEIGHBOR_INDEXES = {}
+
+
+def _pie_neighbor_index_dpath(ibs, config_path, augmentation_seed):
+    config_name = os.path.splitext(os.path.basename(config_path))[0]
+    index_key = ut.hash_data(repr((os.path.realpath(config_path), augmentation_seed)))
+    index_name = '%s-%s' % (config_name, index_key[:16])
+    return os.path.join(ibs.cachedir, 'pie_neighbors', 'index', index_name)
+
+
+def _load_pie_neighbor_index(ibs, config_path, augmentation_seed):
+    from .neighbors import NeighborIndex
+
+    index_dpath = _pie_neighbor_index_dpath(ibs, config_path, augmentation_seed)
+    index = _NEIGHBOR_INDEXES.get(index_dpath)
+    if index is None or index.saved_version() != index.version:
+        # first use in this process, or another process saved a newer version
+        index = NeighborIndex.load(index_dpath)
+        _NEIGHBOR_INDEXES[index_dpath] = index
+    return index
+
+
+# Returns the persistent nearest neighbour index for the config, brought up to date with
+# daid_list: annots that are new or whose embedding was recomputed in the depc (detected
+# by their PieEmbedding rowid) are added, the rest of the index is left untouched, and
+# only the added rows are written to disk (see NeighborIndex.save).
+# Query the annots of a database with index.view(daid_list).
+@register_ibs_method
+def pie_neighbor_index(ibs, daid_list, config_path=None, augmentation_seed=None):
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, daid_list)
+
+    index = _load_pie_neighbor_index(ibs, config_path, augmentation_seed)
+    config = {'config_path': config_path, 'augmentation_seed': augmentation_seed}
+    rowids = ibs.depc_annot.get_rowids('PieEmbedding', daid_list, config=config)
+    stale_aids = index.stale(daid_list, rowids)
+    if len(stale_aids) > 0:
+        stale_aids = list(ut.unique(stale_aids))
+        logger.info('PIE adding %d annots to the neighbor index' % len(stale_aids))
+        aid_to_rowid = dict(zip(daid_list, rowids))
+        stale_rowids = [aid_to_rowid[aid] for aid in stale_aids]
+        stale_embs = ibs.pie_embedding(
+            stale_aids, config_path, augmentation_seed=augmentation_seed
+        )
+        index.add(stale_aids, stale_embs, stale_rowids)
+        index.save()
+    return index
+
+
+# Key of the embeddings of daid_list for caches, from the digest maintained by the
+# neighbor index: no embedding is read or hashed once the annots are indexed. The XOR
+# digest does not depend on the order of the annots, so their order is hashed in as well.
+@register_ibs_method
+def pie_embedding_digest(ibs, daid_list, config_path=None, augmentation_seed=None):
+    index = ibs.pie_neighbor_index(daid_list, config_path, augmentation_seed)
+    order_hash = ut.hash_data(np.asarray(daid_list, dtype=np.int64))
+    return '%s-%s' % (index.digest(daid_list), order_hash[:16])
+
+
+# Drops annots (eg. deleted ones) from the persistent nearest neighbour index of the
+# config. wbia has no hook on annot deletion, so this is a manual clean-up: rows of
+# deleted annots are never returned (queries only search index.view(daid_list)) and a
+# reused aid is re-added as its PieEmbedding rowid differs, but the rows take space until
+# removed here.
+@register_ibs_method
+def pie_neighbor_index_remove(ibs, aid_list, config_path=None, augmentation_seed=None):
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, aid_list)
+
+    index = _load_pie_neighbor_index(ibs, config_path, augmentation_seed)
+    num_before = len(index)
+    index.remove(aid_list)
+    if len(index) != num_before:
+        index.save()
+    return index
+
+
+# The database is searched through the persistent neighbor index (see pie_neighbor_index),
+# memory-mapped and shared by the worker processes answering queries, so no copy of the
+# database embeddings is made per query or per daid_list.
 @register_ibs_method
 def pie_predict_light_2(ibs, qaid, daid_list, config_path=None):
     if config_path is None:
         config_path = _pie_config_fpath(ibs, [qaid])
 
-    db_embs = np.array(ibs.pie_embedding(daid_list))
+    index = ibs.pie_neighbor_index(daid_list, config_path)
     db_labels = np.array(ibs.get_annot_name_texts(daid_list))
     # todo: cache this
     query_emb = ibs.pie_compute_embedding([qaid])
     from .predict import pred_light
 
-    nearest_neighbors_cache_path = os.path.join(ibs.cachedir, 'pie_neighbors')
-    ut.ensuredir(nearest_neighbors_cache_path)
-
     ans = pred_light(
         query_emb,
-        db_embs,
+        None,
         db_labels,
         config_path,
-        nearest_neighbors_cache_path=nearest_neighbors_cache_path,
+        nn_classifier=index.view(daid_list),
     )
     return ans
 
@@ -800,26 +1549,26 @@ def pie_predict_prepare_config(ibs, daid_list, config_path=None):
     return config
 
 
-# pie_predict requires embeddings stored in a .csv file that is identified in the config file, as well as a file linking image names to labels (names). This func makes and saves those csvs if necessary, in a unique folder for a given daid_list.
+# pie_predict requires embeddings stored in an embedding store (see utils/emb_store.py) in the folder that is identified in the config file, along with labels linking image names to names. This func makes and saves the store if necessary, in a unique folder for a given daid_list.
 @register_ibs_method
 def pie_ensure_predict_datafiles(ibs, daid_list, config_path=None):
+    from .utils.emb_store import EMB_SUFFIX, LBL_SUFFIX
+
     if config_path is None:
         config_path = _pie_config_fpath(ibs, daid_list)
 
     pred_data_dir = pie_annot_info_dir(daid_list)
-    embs_fname = os.path.join(pred_data_dir, '_emb.csv')
-    lbls_fname = os.path.join(pred_data_dir, '_lbl.csv')
+    embs_fname = os.path.join(pred_data_dir, EMB_SUFFIX)
+    lbls_fname = os.path.join(pred_data_dir, LBL_SUFFIX)
 
-    if not os.path.isfile(embs_fname):
+    if not os.path.isfile(embs_fname) or not os.path.isfile(lbls_fname):
         embeddings = ibs.pie_embedding(daid_list)
-        embs_fname = _write_embeddings_csv(embeddings, embs_fname)
-    if not os.path.isfile(lbls_fname):
-        lbls_fname = _write_labels_csv(ibs, daid_list, lbls_fname)
+        _write_embedding_store(ibs, daid_list, embeddings, pred_data_dir)
 
     return pred_data_dir
 
 
-# directory where we'll store embeddings and label .csv's to be read by PIE
+# directory where we'll store embeddings and labels to be read by PIE
 def pie_annot_info_dir(aid_list):
     embeddings_dir = os.path.join(_PLUGIN_FOLDER, 'embeddings')
     unique_label = str(hash(tuple(aid_list)))
@@ -830,16 +1579,9 @@ def pie_annot_info_dir(aid_list):
     return output_dir
 
 
-def _write_embeddings_csv(embeddings, fname):
-    ncols = len(embeddings[0])
-    header = ['emb_' + str(i) for i in range(ncols)]
-    header = ','.join(header)
-    np.savetxt(fname, embeddings, delimiter=',', newline='\n', header=header)
-    logger.info('PIE wrote embeddings csv to %s' % fname)
-    return fname
-
+def _write_embedding_store(ibs, aid_list, embeddings, folder):
+    from .utils.emb_store import save_emb_store
 
-def _write_labels_csv(ibs, aid_list, fname):
     names = ibs.get_annot_name_texts(aid_list)
     # PIE expects a zero-indexed "class" column that corresponds with the names; like temporary nids
     unique_names = list(set(names))
@@ -848,11 +1590,14 @@ def _write_labels_csv(ibs, aid_list, fname):
     }
     classes = [name_class_dict[name] for name in names]
     files = ibs.get_annot_image_paths(aid_list)
-    csv_dicts = [
-        {'class': c, 'file': f, 'name': n} for (c, f, n) in zip(classes, files, names)
-    ]
-    _write_csv_dicts(csv_dicts, fname)
-    logger.info('PIE wrote labels csv to %s' % fname)
+    fname = save_emb_store(
+        embeddings,
+        info=[classes, files, names],
+        folder=folder,
+        prefix='',
+        info_header=['class', 'file', 'name'],
+    )
+    logger.info('PIE wrote embedding store to %s' % folder)
     return fname
 
 
@@ -955,9 +1700,13 @@ def pie_annot_training_chip_fpaths(ibs, aid_list, pie_config, flip_horizontal=Fa
     # if undefined, assume no bg subtract
     use_background_subtract = pie_config['model'].get('background_subtract', False)
 
+    if _pie_uses_virtual_annots(ibs, aid_list, pie_config):
+        flip_list = [flip_horizontal] * len(aid_list)
+        return _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list)
+
     # in case we have a special PIE aid-modifying func
     pie_aids = aid_list
-    use_special_aids = ibs.pie_uses_special_annots(aid_list)
+    use_special_aids = _pie_uses_temp_annots(ibs, aid_list, pie_config)
     if use_special_aids:
         print('USE_SPECIAL_AIDS case in pie_annot_training_chip_fpaths')
         species = ibs.get_annot_species(aid_list[0])
@@ -994,69 +1743,122 @@ def _bg_subtract_chip_path(pie_config, default_path='/tmp/training_chips'):
     return path
 
 
+_BG_SUBTRACT_BATCH_SIZE = 256
+
+
+# Background-subtracted training chips: each chip multiplied by its probchip (foreground
+# mask). Chips are read and written by a pool of n_workers threads, and masked
+# _BG_SUBTRACT_BATCH_SIZE at a time with one NumPy operation per chip size. Output names
+# hold the chip size and a hash of the probchip config, so outputs of other sizes or masks
+# are never taken for them, and outputs newer than both their chip and probchip are up to
+# date and not computed again.
 @register_ibs_method
 def background_subtracted_training_chip_fpath(
-    ibs, aid_list, width, height, pie_config, output_path=None, flip_horizontal=False
+    ibs,
+    aid_list,
+    width,
+    height,
+    pie_config,
+    output_path=None,
+    flip_horizontal=False,
+    n_workers=None,
 ):
+    from concurrent.futures import ThreadPoolExecutor
+    import cv2
+    from .utils.preprocessing import multiply_by_masks
 
     if output_path is None:
         output_path = _bg_subtract_chip_path(pie_config)
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
 
     config2_ = {
         'fw_detector': 'cnn',
     }
     mask_path_list = ibs.get_annot_probchip_fpath(aid_list, config2_=config2_)
-    mask_list = [vt.imread(mask_path) for mask_path in mask_path_list]
     chip_path_list = _training_chip_fpath_helper(
         ibs, aid_list, width, height, flip_horizontal
     )
-    chip_list = [vt.imread(chip_path) for chip_path in chip_path_list]
 
-    # just used for file naming
+    # just used for file naming. Each chip size, probchip config and flip gets its own
+    # files, otherwise outputs of an annot would overwrite each other and an output of
+    # another size would be taken as up to date
     species_list = ibs.get_annot_species_texts(aid_list)
     gid_list = ibs.get_annot_gids(aid_list)
+    suffix = '.%dx%d.%s%s' % (
+        width,
+        height,
+        ut.hash_data(repr(sorted(config2_.items())))[:8],
+        '.flip' if flip_horizontal else '',
+    )
+    fpaths = [
+        os.path.join(
+            output_path, 'background.%s.%d.%d%s.png' % (species, gid, aid, suffix)
+        )
+        for aid, gid, species in zip(aid_list, gid_list, species_list)
+    ]
 
-    fpaths = []
-    zipped = zip(aid_list, gid_list, species_list, mask_list, chip_list)
+    todo = [
+        index
+        for index, fpath in enumerate(fpaths)
+        if not _is_up_to_date(fpath, [chip_path_list[index], mask_path_list[index]])
+    ]
+    print(
+        'Background subtracting %d of %d chips (%d up to date)'
+        % (len(todo), len(fpaths), len(fpaths) - len(todo))
+    )
 
-    import cv2
+    def read_chip_and_mask(index):
+        chip = vt.imread(chip_path_list[index])
+        mask = vt.resize_mask(vt.imread(mask_path_list[index]), chip)
+        return chip, mask
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for start in range(0, len(todo), _BG_SUBTRACT_BATCH_SIZE):
+            batch = todo[start : start + _BG_SUBTRACT_BATCH_SIZE]
+            chips_and_masks = list(pool.map(read_chip_and_mask, batch))
+
+            # chips of an annot set share a size, but group by shape to be safe
+            shape_groups = OrderedDict()
+            for index, (chip, mask) in zip(batch, chips_and_masks):
+                shape_groups.setdefault((chip.shape, mask.shape), []).append(
+                    (index, chip, mask)
+                )
 
-    for index, (aid, gid, species, mask_img, chip) in enumerate(zipped):
-        mask = vt.resize_mask(mask_img, chip)
-        if flip_horizontal:
-            # note: this is untested but should work
-            mask = np.fliplr(mask)
-        blended = vt.blend_images_multiply(chip, mask)
-        blended *= 255.0
-        blended = np.around(blended)
-        blended[blended < 0] = 0
-        blended[blended > 255] = 255
-        blended = blended.astype(np.uint8)
-
-        canvas = blended
-        output_filepath = os.path.join(
-            output_path, 'background.%s.%d.%d.png' % (species, gid, aid)
-        )
-        cv2.imwrite(output_filepath, canvas)
-        fpaths.append(output_filepath)
+            writes = []
+            for group in shape_groups.values():
+                chips = np.stack([chip for _, chip, _ in group])
+                masks = np.stack([mask for _, _, mask in group])
+                if masks.ndim == 3:
+                    masks = masks[..., None]
+                if flip_horizontal:
+                    # probchips are of the unflipped chips: mirror them (axis 2 is the
+                    # width), same as the unflipped output mirrored
+                    masks = masks[:, :, ::-1]
+                blended = multiply_by_masks(chips, masks)
+                writes += [
+                    pool.submit(cv2.imwrite, fpaths[index], canvas)
+                    for (index, _, _), canvas in zip(group, blended)
+                ]
+            for write in writes:
+                write.result()
 
     return fpaths
 
 
+def _is_up_to_date(fpath, src_fpaths):
+    if not os.path.exists(fpath):
+        return False
+    mtime = os.path.getmtime(fpath)
+    return all(os.path.getmtime(src_fpath) <= mtime for src_fpath in src_fpaths)
+
+
 # same as training_chip_fpaths, except mirroring right-side photos if necessary
 @register_ibs_method
 def pie_annot_embedding_chip_fpaths(ibs, aid_list, pie_config):
 
     # flip right images if necessary
-    species = ibs.get_annot_species_texts(aid_list[0])
-    flip_list = [False] * len(aid_list)
-    if species in FLIP_RIGHTSIDE_MODELS:
-        viewpoint_list = ibs.get_annot_viewpoints(aid_list)
-        viewpoint_list = [
-            None if viewpoint is None else viewpoint.lower()
-            for viewpoint in viewpoint_list
-        ]
-        flip_list = [viewpoint in RIGHT_FLIP_LIST for viewpoint in viewpoint_list]
+    flip_list = _pie_flip_list(ibs, aid_list)
 
     flip_aids = ut.compress(aid_list, flip_list)
     unflipped_aids = ut.compress(aid_list, [not flip for flip in flip_list])
@@ -1085,6 +1887,19 @@ def pie_annot_embedding_chip_fpaths(ibs, aid_list, pie_config):
     return fpaths
 
 
+def _pie_flip_list(ibs, aid_list):
+    species = ibs.get_annot_species_texts(aid_list[0])
+    flip_list = [False] * len(aid_list)
+    if species in FLIP_RIGHTSIDE_MODELS:
+        viewpoint_list = ibs.get_annot_viewpoints(aid_list)
+        viewpoint_list = [
+            None if viewpoint is None else viewpoint.lower()
+            for viewpoint in viewpoint_list
+        ]
+        flip_list = [viewpoint in RIGHT_FLIP_LIST for viewpoint in viewpoint_list]
+    return flip_list
+
+
 def csv_to_dicts(fname):
     import csv
 
@@ -1417,21 +2232,10 @@ def _invert_dict(d):
 
 # remember bbox is (xtl, ytl, w, h)
 def orca_annot_modifier(ibs, aid_list):
-    bboxes = ibs.get_annot_bboxes(aid_list)
+    new_bboxes = orca_annot_bboxes(ibs, aid_list)
     viewpoints = ibs.get_annot_viewpoints(aid_list)
     viewpoints = [None if v is None else v.lower() for v in viewpoints]
     gids = ibs.get_annot_gids(aid_list)
-    img_heights = ibs.get_image_heights(gids)
-    img_widths = ibs.get_image_widths(gids)
-
-    bbox_imgw_imgh_viewpoint = list(zip(bboxes, img_widths, img_heights, viewpoints))
-    # tuple unpacking
-    bbox_imgw_imgh_viewpoint = [
-        (xtl, ytl, ann_w, ann_h, im_w, im_h, view)
-        for (xtl, ytl, ann_w, ann_h), im_w, im_h, view in bbox_imgw_imgh_viewpoint
-    ]
-
-    new_bboxes = [orca_convert_bbox(*bbox_info) for bbox_info in bbox_imgw_imgh_viewpoint]
     names = ibs.get_annot_names(aid_list)
     species = ibs.get_annot_species(aid_list)
     new_species = [spec + '_pie_temp_annot' for spec in species]
@@ -1447,6 +2251,26 @@ def orca_annot_modifier(ibs, aid_list):
     return new_aids
 
 
+# expanded orca bboxes, cropped virtually or by orca_annot_modifier's temporary annots
+def orca_annot_bboxes(ibs, aid_list):
+    bboxes = ibs.get_annot_bboxes(aid_list)
+    viewpoints = ibs.get_annot_viewpoints(aid_list)
+    viewpoints = [None if v is None else v.lower() for v in viewpoints]
+    gids = ibs.get_annot_gids(aid_list)
+    img_heights = ibs.get_image_heights(gids)
+    img_widths = ibs.get_image_widths(gids)
+
+    bbox_imgw_imgh_viewpoint = list(zip(bboxes, img_widths, img_heights, viewpoints))
+    # tuple unpacking
+    bbox_imgw_imgh_viewpoint = [
+        (xtl, ytl, ann_w, ann_h, im_w, im_h, view)
+        for (xtl, ytl, ann_w, ann_h), im_w, im_h, view in bbox_imgw_imgh_viewpoint
+    ]
+
+    new_bboxes = [orca_convert_bbox(*bbox_info) for bbox_info in bbox_imgw_imgh_viewpoint]
+    return new_bboxes
+
+
 _ORCA_WIDTH_MODIFIER = 3.0
 _ORCA_HEIGHT_MODIFIER = 1.5
 
@@ -1483,13 +2307,152 @@ def orca_convert_left_box(xtl, ytl, annot_w, annot_h, img_w, img_h):
 
 
 # orcas reuse a dorsal-fin annot, adding some more context by expanding the bbox.
+# bbox_func gives the expanded bboxes, cropped virtually (see _pie_virtual_chip_fpaths);
+# modifying_func adds them as temporary annots, only needed for background subtraction.
 SPECIAL_PIE_ANNOT_MAP = {
     'whale_orca+fin_dorsal': {
         'modifying_func': orca_annot_modifier,
+        'bbox_func': orca_annot_bboxes,
     }
 }
 
 
+# Special annots are cropped from their expanded bboxes at chip extraction time, without
+# adding temporary annots, unless chips are background subtracted: probchips are computed
+# by wbia for real annots only.
+def _pie_uses_virtual_annots(ibs, aid_list, pie_config):
+    use_background_subtract = pie_config['model'].get('background_subtract', False)
+    return ibs.pie_uses_special_annots(aid_list) and not use_background_subtract
+
+
+def _pie_uses_temp_annots(ibs, aid_list, pie_config):
+    use_background_subtract = pie_config['model'].get('background_subtract', False)
+    return ibs.pie_uses_special_annots(aid_list) and use_background_subtract
+
+
+def _pie_virtual_bboxes(ibs, aid_list):
+    species = ibs.get_annot_species(aid_list[0])
+    return SPECIAL_PIE_ANNOT_MAP[species]['bbox_func'](ibs, aid_list)
+
+
+_VIRTUAL_CHIP_BATCH_SIZE = 256
+
+
+# Chips of special annots cropped from their expanded bboxes, written to
+# ibs.cachedir/pie_virtual_chips. A chip file is named after its aid, the version of its
+# crop (image, expanded bbox and size) and its flip, so it is extracted once and again
+# only when the annot or its image change; the previous version is then deleted. Like the
+# temporary annots, crops have no rotation.
+def _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list):
+    import cv2
+    from glob import glob
+
+    if len(aid_list) == 0:
+        return []
+    size = (
+        int(pie_config['model']['input_width']),
+        int(pie_config['model']['input_height']),
+    )
+    bbox_list = _pie_virtual_bboxes(ibs, aid_list)
+    gid_list = ibs.get_annot_gids(aid_list)
+    uuid_list = ibs.get_image_uuids(gid_list)
+    species_list = ibs.get_annot_species_texts(aid_list)
+
+    folder = os.path.join(ibs.cachedir, 'pie_virtual_chips')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fpaths = []
+    stale_patterns = []
+    zipped = zip(aid_list, gid_list, uuid_list, species_list, bbox_list, flip_list)
+    for aid, gid, uuid, species, bbox, flip in zipped:
+        version = ut.hash_data(repr((str(uuid), tuple(bbox), size)))[:16]
+        suffix = '.flip.png' if flip else '.png'
+        fname = 'pie_virtual.%s.%d.%d.%s%s' % (species, gid, aid, version, suffix)
+        fpaths.append(os.path.join(folder, fname))
+        # any version of the same chip (e.g. before its bbox changed)
+        stale_fname = 'pie_virtual.*.%d.%d.%s%s' % (gid, aid, '?' * 16, suffix)
+        stale_patterns.append(os.path.join(folder, stale_fname))
+
+    missing = [index for index, fpath in enumerate(fpaths) if not os.path.exists(fpath)]
+    if len(missing) > 0:
+        print('Extracting %d of %d virtual chips' % (len(missing), len(fpaths)))
+    for start in range(0, len(missing), _VIRTUAL_CHIP_BATCH_SIZE):
+        batch = missing[start : start + _VIRTUAL_CHIP_BATCH_SIZE]
+        chip_specs = _pie_chip_specs(
+            ibs,
+            ut.take(aid_list, batch),
+            size,
+            ut.take(bbox_list, batch),
+            [0.0] * len(batch),
+            ut.take(flip_list, batch),
+        )
+        chips = _load_fused_chips(chip_specs, size)
+        for index, chip in zip(batch, chips):
+            for stale_fpath in glob(stale_patterns[index]):
+                if stale_fpath != fpaths[index]:
+                    os.remove(stale_fpath)
+            # written aside then moved in place, so a chip is never read half written
+            root = os.path.splitext(fpaths[index])[0]
+            tmp_fpath = '%s.%d.tmp.png' % (root, os.getpid())
+            cv2.imwrite(tmp_fpath, cv2.cvtColor(chip, cv2.COLOR_RGB2BGR))
+            os.replace(tmp_fpath, fpaths[index])
+    return fpaths
+
+
+# Times the chips of special annots (e.g. orcas with the orca saddle config): temporary
+# annots with wbia chips, as before, against virtual crops (first extraction, then
+# cached). Temporary annots, their chips and the virtual chips of aid_list are deleted in
+# between. Needs a database with special annots, e.g. orcas, which the PIE test db does
+# not have:
+#     ibs = wbia.opendb(<orca db>)
+#     aids = ibs.get_valid_aids(species='whale_orca+fin_dorsal')
+#     ibs.pie_benchmark_special_annots(aids)  # configs/orca-deploy-saddle.json
+@register_ibs_method
+def pie_benchmark_special_annots(ibs, aid_list, config_path=None):
+    import time
+
+    if config_path is None:
+        config_path = _pie_config_fpath(ibs, aid_list)
+    with open(config_path, 'r') as f:
+        pie_config = json.load(f)
+    assert ibs.pie_uses_special_annots(aid_list), 'aids have no special PIE annots'
+    width = int(pie_config['model']['input_width'])
+    height = int(pie_config['model']['input_height'])
+    species = ibs.get_annot_species(aid_list[0])
+    flip_list = [False] * len(aid_list)
+
+    start = time.perf_counter()
+    new_aids = SPECIAL_PIE_ANNOT_MAP[species]['modifying_func'](ibs, aid_list)
+    _training_chip_fpath_helper(ibs, new_aids, width, height)
+    ibs.delete_annots(new_aids)
+    temp_time = time.perf_counter() - start
+
+    for fpath in _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list):
+        os.remove(fpath)
+    start = time.perf_counter()
+    _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list)
+    virtual_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _pie_virtual_chip_fpaths(ibs, aid_list, pie_config, flip_list)
+    cached_time = time.perf_counter() - start
+
+    print('Chips of %d special annots (%s):' % (len(aid_list), config_path))
+    timings = [
+        ('temporary annots', temp_time),
+        ('virtual, extracted', virtual_time),
+        ('virtual, cached', cached_time),
+    ]
+    for name, timing in timings:
+        # speedup over temporary annots, unless below the clock resolution
+        speedup = '%.1fx' % (temp_time / timing) if timing > 0 else '-'
+        print('%-18s %.4f s (%s)' % (name, timing, speedup))
+    return {
+        'temp_annots': temp_time,
+        'virtual': virtual_time,
+        'virtual_cached': cached_time,
+    }
+
+
 # Careful, this returns a different ibs than you sent in
 def pie_testdb_ibs():
     testdb_name = 'manta-test'
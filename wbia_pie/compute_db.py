@@ -14,8 +14,8 @@ PARAMETERS:
     -d     path to a directory with images to process. Required argument.
     -c     path to configuration file. Default: configs/config-manta.json
            Preconfigured files: configs/config-manta.json for manta rays, configs/config-whale.json
-    -o     path to save csv with embeddings files. Default is in config: prod.embeddings
-    -p     prefix, string to add to csv filenames. Default is in config: prod.prefix
+    -o     path to save embeddings files. Default is in config: prod.embeddings
+    -p     prefix, string to add to embedding filenames. Default is in config: prod.prefix
 
 README:
 Image directory should have the following structure:
@@ -36,9 +36,15 @@ import os
 import json
 import numpy as np
 
-from .model.triplet import TripletLoss
-from .utils.utils import export_emb
-from .utils.preprocessing import read_dataset
+from .registry import get_model
+from .utils.emb_store import save_emb_store
+from .utils.feature_cache import FeatureCache
+from .utils.preprocessing import (
+    read_dataset,
+    iter_dataset,
+    chunk_size_for_memory,
+)
+from .utils.pipeline import StageTimer
 
 argparser = argparse.ArgumentParser(
     description='Compute embeddings for the database. No arguments are required if default values are used.'
@@ -53,13 +59,19 @@ argparser.add_argument(
 argparser.add_argument(
     '-o',
     '--output',
-    help='Path to output csv files. Default is in config: prod.embeddings',
+    help='Path to output embedding files. Default is in config: prod.embeddings',
 )
 argparser.add_argument(
     '-p',
     '--prefix',
     help='String to add to embeddings file. Default is in config: prod.prefix',
 )
+argparser.add_argument(
+    '-m',
+    '--max_memory',
+    type=float,
+    help='Memory ceiling in MB for images held at once. Default: read all images at once',
+)
 
 
 def hello():
@@ -68,7 +80,13 @@ def hello():
 
 # This is a package-ified version of original _main_ func
 def compute(
-    dbpath, config_path, output_dir, prefix, export=False, augmentation_seed=None
+    dbpath,
+    config_path,
+    output_dir,
+    prefix,
+    export=False,
+    augmentation_seed=None,
+    max_memory_mb=None,
 ):
 
     # process inputs and load default values
@@ -87,17 +105,41 @@ def compute(
     if prefix is None:
         prefix = config['prod']['prefix']
 
-    # Read localized images from a folder with localized database images
-    if os.path.exists(dbpath):
-        print('Loading images from from {}'.format(dbpath))
-        db_imgs, db_labels, lbl2names, db_files = read_dataset(
-            dbpath, return_filenames=True, original_labels=False
-        )
-        db_names = np.array([lbl2names[lab] for lab in db_labels])
-    else:
+    if not os.path.exists(dbpath):
         print('Error! Path does not exist: {}'.format(dbpath))
         quit()
 
+    if max_memory_mb is not None:
+        # Streaming mode: only max_memory_mb worth of images is held at once
+        db_preds, db_labels, db_files, db_names = [], [], [], []
+        for preds, labels, files, names in compute_stream(
+            dbpath, config_path, max_memory_mb, augmentation_seed
+        ):
+            db_preds.append(preds)
+            db_labels.append(labels)
+            db_files += files
+            db_names.append(names)
+        db_preds = np.concatenate(db_preds, axis=0)
+        db_labels = np.concatenate(db_labels, axis=0)
+        db_names = np.concatenate(db_names, axis=0)
+        if export:
+            print('Done computing embeddings, exporting to %s' % output_dir)
+            save_emb_store(
+                db_preds,
+                info=[db_labels, db_files, db_names],
+                folder=output_dir,
+                prefix=prefix,
+                info_header=['class,file,name'],
+            )
+        return db_preds, db_files
+
+    # Read localized images from a folder with localized database images
+    print('Loading images from from {}'.format(dbpath))
+    db_imgs, db_labels, lbl2names, db_files = read_dataset(
+        dbpath, return_filenames=True, original_labels=False
+    )
+    db_names = np.array([lbl2names[lab] for lab in db_labels])
+
     # print('db_imgs   = %s' % db_imgs)
     # print('db_labels = %s' % db_labels)
     # print('lbl2names = %s' % lbl2names)
@@ -107,48 +149,18 @@ def compute(
     #   Load the model
     ##############################
 
-    INPUT_SHAPE = (config['model']['input_height'], config['model']['input_width'], 3)
-    model_args = dict(
-        backend=config['model']['backend'],
-        frontend=config['model']['frontend'],
-        input_shape=INPUT_SHAPE,
-        embedding_size=config['model']['embedding_size'],
-        connect_layer=config['model']['connect_layer'],
-        train_from_layer=config['model']['train_from_layer'],
-        loss_func=config['model']['loss'],
-        weights='imagenet',
-        optimizer=config['model'].get('optimizer', 'adam'),
-        use_dropout=config['model'].get('use_dropout', False),
-    )
-    print('model_args  = %s' % model_args)
-
-    if config['model']['type'] == 'TripletLoss':
-        mymodel = TripletLoss(**model_args)
-    else:
-        raise Exception('Only TripletLoss model type is supported')
-
-    # Define folder for experiment
-    exp_folder = os.path.join(
-        plugin_folder, config['train']['exp_dir'], config['train']['exp_id']
-    )
-    saved_weights = os.path.join(exp_folder, 'best_weights.h5')
-
-    if os.path.exists(saved_weights):
-        print('Loading saved weights in ', saved_weights)
-        mymodel.load_weights(saved_weights)
-    else:
-        print('ERROR! No pre-trained weights are found in {} ', saved_weights)
-        quit()
+    # Models are built and loaded once per process, see registry.py
+    mymodel = get_model(config_path, config)
 
     # Compute embeddings
-    print('Computing embeddings and saving as csv in {}'.format(output_dir))
+    print('Computing embeddings and saving in {}'.format(output_dir))
     db_preds = mymodel.preproc_predict(db_imgs, 1024, augmentation_seed)
     # db_preds appears to be just the embeddings. So we can hook in here and export them
 
     if export:
         # Export embeddings
         print('Done computing embeddings, exporting to %s' % output_dir)
-        export_emb(
+        save_emb_store(
             db_preds,
             info=[db_labels, db_files, db_names],
             folder=output_dir,
@@ -158,6 +170,194 @@ def compute(
     return db_preds, db_files
 
 
+def compute_stream(
+    dbpath, config_path, max_memory_mb, augmentation_seed=None, batch_size=1024
+):
+    """Compute embeddings for a folder of localized images chunk by chunk,
+    so peak memory is bounded by max_memory_mb rather than the size of the database.
+    Input:
+    dbpath: string, folder with one subfolder of images per class
+    config_path: string, path to configuration file
+    max_memory_mb: float, memory ceiling for images held at once
+    batch_size: integer, size of the batches test-time augmentation draws its transforms
+                for. Batches fed to the model are shrunk to fit max_memory_mb, which
+                does not change the embeddings
+    Yields:
+    embeddings, labels, filenames and names of each chunk
+    """
+    mymodel = get_model(config_path)
+    chunk_size = chunk_size_for_memory(max_memory_mb, mymodel.input_shape, batch_size)
+    if chunk_size < batch_size and _augments_whole_batches(mymodel, [augmentation_seed]):
+        chunk_size = batch_size
+    print('Streaming embeddings in chunks of {} images'.format(chunk_size))
+
+    # labels and filenames of each chunk, in the order chunks are fed to the model
+    chunk_info = []
+
+    def img_chunks():
+        for imgs, labels, lbl2names, files in iter_dataset(dbpath, chunk_size):
+            chunk_info.append((labels, lbl2names, files))
+            yield imgs
+
+    chunks_preds = mymodel.predict_stream(
+        img_chunks(), min(batch_size, chunk_size), augmentation_seed, batch_size
+    )
+    for preds in chunks_preds:
+        labels, lbl2names, files = chunk_info.pop(0)
+        names = np.array([lbl2names[lab] for lab in labels])
+        yield preds, labels, files, names
+
+
+def compute_files(
+    files,
+    config_path,
+    augmentation_seed=None,
+    max_memory_mb=None,
+    batch_size=1024,
+    n_workers=4,
+    queue_depth=2,
+    load_imgs=None,
+):
+    """Compute embeddings for a list of image files, in the order of files.
+    Images are decoded, resized and normalised by n_workers threads, queue_depth batches
+    ahead of the model, so decoding overlaps with inference.
+    Input:
+    max_memory_mb: float or None, memory ceiling for the batches held at once
+                   (the current one and the prefetched ones). Batches are shrunk to fit,
+                   test-time augmentation still draws its transforms for batches of
+                   batch_size so embeddings do not depend on the ceiling
+    n_workers: integer, number of decoder threads. 0 to decode sequentially
+    queue_depth: integer, number of batches prepared ahead of the model
+    load_imgs: function reading a batch of files, see BaseModel.predict_files.
+               Default: read and resize image files
+    Returns:
+    embeddings, 2D array (num_images, embedding_size)
+    """
+    mymodel = get_model(config_path)
+    mem_batch_size = batch_size
+    if max_memory_mb is not None:
+        per_batch_mb = max_memory_mb / (queue_depth + 1)
+        mem_batch_size = _memory_batch_size(
+            mymodel, batch_size, per_batch_mb, [augmentation_seed]
+        )
+
+    print('Computing embeddings for {} images in memory'.format(len(files)))
+    timer = StageTimer()
+    preds = mymodel.predict_files(
+        files,
+        mem_batch_size,
+        augmentation_seed,
+        n_workers,
+        queue_depth,
+        timer,
+        load_imgs,
+        seed_batch_size=batch_size,
+    )
+    return preds
+
+
+def compute_files_seeds(
+    files,
+    config_path,
+    augmentation_seeds,
+    max_memory_mb=None,
+    batch_size=1024,
+    n_workers=4,
+    queue_depth=2,
+    load_imgs=None,
+):
+    """Compute embeddings for a list of image files for several augmentation seeds
+    (test-time augmentation) in one pass: each image is decoded once and predicted once
+    per seed. Same arguments as compute_files.
+    Input:
+    augmentation_seeds: list of integers or None (no augmentation)
+    Returns:
+    list of embeddings, 2D arrays (num_images, embedding_size), one per seed
+    """
+    mymodel = get_model(config_path)
+    augmentation_seeds = list(augmentation_seeds)
+    mem_batch_size = batch_size
+    if max_memory_mb is not None:
+        # a prefetched batch holds one normalised copy for no augmentation, and one per
+        # seed when augmenting on the workers (see predict_files_seeds)
+        n_copies = int(None in augmentation_seeds)
+        if mymodel.augmentation == 'vectorised':
+            n_copies += sum(seed is not None for seed in augmentation_seeds)
+        per_batch_mb = max_memory_mb / (queue_depth + 1) / max(1, n_copies)
+        mem_batch_size = _memory_batch_size(
+            mymodel, batch_size, per_batch_mb, augmentation_seeds
+        )
+
+    print(
+        'Computing embeddings for {} images and {} augmentation seeds in memory'.format(
+            len(files), len(augmentation_seeds)
+        )
+    )
+    timer = StageTimer()
+    return mymodel.predict_files_seeds(
+        files,
+        augmentation_seeds,
+        mem_batch_size,
+        n_workers,
+        queue_depth,
+        timer,
+        load_imgs,
+        seed_batch_size=batch_size,
+    )
+
+
+def _augments_whole_batches(mymodel, augmentation_seeds):
+    """Whether test-time augmentation needs batches of the full batch size: the keras
+    augmentation draws the transforms of a whole batch at once, the vectorised one draws
+    them image by image."""
+    if mymodel.augmentation != 'keras':
+        return False
+    if not any(seed is not None for seed in augmentation_seeds):
+        return False
+    print(
+        'keras augmentation draws its transforms per batch, the memory ceiling is not '
+        'applied below one batch: use "augmentation": "vectorised" to apply it'
+    )
+    return True
+
+
+def _memory_batch_size(mymodel, batch_size, per_batch_mb, augmentation_seeds):
+    """Size of the batches fed to the model so that one fits in per_batch_mb. Test-time
+    augmentation still draws its transforms for batches of batch_size."""
+    mem_batch_size = min(
+        batch_size, chunk_size_for_memory(per_batch_mb, mymodel.input_shape)
+    )
+    if mem_batch_size < batch_size and _augments_whole_batches(
+        mymodel, augmentation_seeds
+    ):
+        return batch_size
+    return mem_batch_size
+
+
+def compute_imgs(
+    imgs, config_path, augmentation_seed=None, batch_size=1024, feature_cache_dir=None
+):
+    """Compute embeddings for images already in memory.
+    Input:
+    imgs: 4D uint8 array of images resized to the network input size
+    config_path: string, path to configuration file
+    augmentation_seed: integer or None, seed for test-time augmentation
+    feature_cache_dir: string or None, folder of a FeatureCache (utils/feature_cache.py).
+                       Without augmentation, backbone features are read from the cache
+                       (computed and added on a miss) and only the head of the model runs
+    Returns:
+    embeddings, 2D array (num_images, embedding_size) in the same order as imgs
+    """
+    mymodel = get_model(config_path)
+    print('Computing embeddings for {} images in memory'.format(len(imgs)))
+    if feature_cache_dir is not None and augmentation_seed is None:
+        with mymodel.predict_scope():
+            feature_cache = FeatureCache(feature_cache_dir, mymodel)
+            features = feature_cache.features(imgs, batch_size)
+            return mymodel.predict_features(features, batch_size)
+    return mymodel.preproc_predict(imgs, batch_size, augmentation_seed)
+
+
 if __name__ == '__main__':
     args = argparser.parse_args()
     compute(
@@ -165,4 +365,5 @@ if __name__ == '__main__':
         config_path=args.conf,
         output_dir=args.output,
         prefix=args.prefix,
+        max_memory_mb=args.max_memory,
     )
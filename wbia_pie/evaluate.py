@@ -193,6 +193,7 @@ def evaluate(config_path, split_num=-1, mode='all'):
             n_eval_runs=config['evaluate']['n_eval_epochs'],
             move_to_db=config['evaluate']['move_to_dataset'],
             k_list=config['evaluate']['accuracy_at_k'],
+            nn_params=config.get('predict'),
         )
 
     if mode in ('all', 'compute'):
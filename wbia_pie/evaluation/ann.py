@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Nearest neighbour backends for predict_k_neigh.
+
+'exact'     sklearn NearestNeighbors, the default.
+'ivf_flat'  inverted file index in pure NumPy: the database is clustered with
+            k-means into n_lists lists, a query is compared with every
+            embedding of its n_probe closest lists only. Approximate, with a
+            search cost of about n_probe / n_lists of the exact one.
+'fp16'      exact search over embeddings stored as float16: 2 bytes per value
+            instead of 8 for float64 (512 bytes per 256-d embedding).
+'pq'        product quantisation: every embedding is split into pq_n_subvectors
+            subvectors, each stored as the uint8 code of its closest of 256
+            centroids (32 bytes per 256-d embedding with 32 subvectors).
+            Distances are asymmetric (ADC): the query is not quantised, its
+            distances to every centroid are tabulated once, and the distance to
+            an embedding is a sum of pq_n_subvectors table lookups.
+
+Backends are selected by the "predict" section of a config file:
+    "predict": {
+        "nn_backend":   "ivf_flat",
+        "ivf_n_lists":  1024,
+        "ivf_n_probe":  16
+    }
+    "predict": {
+        "nn_backend":       "pq",
+        "pq_n_subvectors":  32
+    }
+Accuracy of a compressed or approximate backend is measured by evaluate.py,
+which reports accuracy@k with the backend and its recall@k against exact search.
+Every backend has the fit / kneighbors interface of sklearn NearestNeighbors.
+
+Fitted 'ivf_flat', 'fp16' and 'pq' indexes are written to a folder by
+save_nn_index (one .npy file per fitted array: the float16 copy, the PQ codes
+and codebooks, the IVF lists) and memory-mapped back by load_nn_index, so the
+compressed arrays are fitted once, kept on disk next to the float32 embeddings
+and shared by the processes that search them, rather than refitted in each one.
+
+When the database changes, assign(X) encodes the new database with the
+centroids (IVF) or codebooks (PQ) trained before, which costs one pass over
+the embeddings instead of a k-means per list or subvector. It returns the
+drift of the mean quantisation error since training (0.2 for 20% larger),
+and the index is trained again once the drift exceeds RETRAIN_DRIFT, or the
+"ann_retrain_drift" of the "predict" section.
+===============================================================================
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+NN_BACKENDS = ('exact', 'ivf_flat', 'fp16', 'pq')
+
+# rows per block when computing distances to the centroids
+BLOCK_SIZE = 4096
+
+PARAMS_FNAME = 'params.json'
+
+# relative increase of the quantisation error over which an index is trained again
+RETRAIN_DRIFT = 0.2
+
+
+def make_nn_classifier(nn_params=None, n_neighbors=50):
+    """Unfitted nearest neighbour classifier for the backend described by nn_params.
+    Input:
+    nn_params: None or dict, eg. the "predict" section of a config. Default: exact
+    n_neighbors: integer, default number of neighbours of kneighbors
+    """
+    nn_params = nn_params or {}
+    backend = nn_params.get('nn_backend', 'exact')
+    if backend == 'exact':
+        return NearestNeighbors(n_neighbors=n_neighbors, metric='euclidean')
+    if backend == 'ivf_flat':
+        return IVFFlatIndex(
+            n_lists=nn_params.get('ivf_n_lists'),
+            n_probe=nn_params.get('ivf_n_probe', 8),
+            n_neighbors=n_neighbors,
+        )
+    if backend == 'fp16':
+        return FP16FlatIndex(n_neighbors=n_neighbors)
+    if backend == 'pq':
+        return PQIndex(
+            n_subvectors=nn_params.get('pq_n_subvectors', 32), n_neighbors=n_neighbors
+        )
+    raise ValueError(
+        'Unknown nn_backend {}, expected one of {}'.format(backend, NN_BACKENDS)
+    )
+
+
+def nn_backend_name(nn_params=None):
+    """Short description of the backend, eg. to name cache files."""
+    nn_params = nn_params or {}
+    backend = nn_params.get('nn_backend', 'exact')
+    if backend == 'ivf_flat':
+        return 'ivf-{}-{}'.format(
+            nn_params.get('ivf_n_lists'), nn_params.get('ivf_n_probe', 8)
+        )
+    if backend == 'pq':
+        return 'pq-{}'.format(nn_params.get('pq_n_subvectors', 32))
+    return backend
+
+
+def save_nn_index(nn_index, folder):
+    """Write a fitted index to folder, which must not exist yet. The folder is written
+    under a temporary name and renamed, so it is either complete or missing.
+    Input:
+    nn_index: fitted IVFFlatIndex, FP16FlatIndex or PQIndex
+    folder: string, folder to create
+    """
+    tmp_folder = '{}.{}.tmp'.format(folder, os.getpid())
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    params = {name: getattr(nn_index, name) for name in nn_index.param_names}
+    params['class'] = type(nn_index).__name__
+    params['n_samples_fit_'] = int(nn_index.n_samples_fit_)
+    with open(os.path.join(tmp_folder, PARAMS_FNAME), 'w') as params_file:
+        json.dump(params, params_file)
+    for name in nn_index.fitted_arrays:
+        np.save(os.path.join(tmp_folder, name + '.npy'), getattr(nn_index, name))
+    try:
+        os.rename(tmp_folder, folder)
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def load_nn_index(folder):
+    """Index written by save_nn_index, with its fitted arrays memory-mapped."""
+    with open(os.path.join(folder, PARAMS_FNAME)) as params_file:
+        params = json.load(params_file)
+    classes = {cls.__name__: cls for cls in (IVFFlatIndex, FP16FlatIndex, PQIndex)}
+    cls = classes[params.pop('class')]
+    n_samples_fit = params.pop('n_samples_fit_')
+    nn_index = cls(**params)
+    for name in cls.fitted_arrays:
+        fpath = os.path.join(folder, name + '.npy')
+        setattr(nn_index, name, np.load(fpath, mmap_mode='r'))
+    nn_index.n_samples_fit_ = n_samples_fit
+    return nn_index
+
+
+class FP16FlatIndex(object):
+    """Exact search over embeddings stored as float16. Blocks of the database are
+    converted to float32 when they are scanned."""
+
+    param_names = ('n_neighbors',)
+    fitted_arrays = ('data_', 'sq_norms_')
+
+    def __init__(self, n_neighbors=50):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, X, y=None):
+        self.data_ = np.asarray(X, dtype=np.float16)
+        data = self.data_.astype(np.float32)
+        self.sq_norms_ = np.einsum('ij,ij->i', data, data)
+        self.n_samples_fit_ = len(X)
+        return self
+
+    def assign(self, X):
+        """Stores X, there is nothing to train. Returns a drift of 0."""
+        self.fit(X)
+        return 0.0
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        X = np.asarray(X, dtype=np.float32)
+
+        def block_d2(start, stop):
+            block = self.data_[start:stop].astype(np.float32)
+            d2 = -2 * np.dot(X, block.T)
+            d2 += np.einsum('ij,ij->i', X, X)[:, None]
+            d2 += self.sq_norms_[None, start:stop]
+            return d2
+
+        return _scan_blocks(
+            block_d2, len(X), self.n_samples_fit_, n_neighbors, return_distance
+        )
+
+
+class PQIndex(object):
+    """Product quantisation index with asymmetric distance computation.
+    Input:
+    n_subvectors: integer, number of subvectors (must divide the embedding size)
+    n_centroids: integer, centroids per subvector (at most 256, codes are uint8)
+    n_neighbors: integer, default number of neighbours of kneighbors
+    n_iter, max_train, seed: k-means parameters
+    """
+
+    param_names = (
+        'n_subvectors',
+        'n_centroids',
+        'n_neighbors',
+        'n_iter',
+        'max_train',
+        'seed',
+    )
+    fitted_arrays = ('codebooks_', 'codes_', 'train_error_')
+
+    def __init__(
+        self,
+        n_subvectors=32,
+        n_centroids=256,
+        n_neighbors=50,
+        n_iter=10,
+        max_train=25600,
+        seed=0,
+    ):
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.n_neighbors = n_neighbors
+        self.n_iter = n_iter
+        self.max_train = max_train
+        self.seed = seed
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float32)
+        emb_size = X.shape[1]
+        assert (
+            emb_size % self.n_subvectors == 0
+        ), 'Embedding size %d is not divisible by %d subvectors' % (
+            emb_size,
+            self.n_subvectors,
+        )
+        assert self.n_centroids <= 256, 'Codes are uint8: at most 256 centroids'
+        n_centroids = min(self.n_centroids, len(X))
+
+        # codebooks_[j] holds the centroids of subvector j
+        sub_size = emb_size // self.n_subvectors
+        self.codebooks_ = np.zeros(
+            (self.n_subvectors, n_centroids, sub_size), dtype=np.float32
+        )
+        for j in range(self.n_subvectors):
+            sub = X[:, j * sub_size : (j + 1) * sub_size]
+            self.codebooks_[j] = _kmeans(
+                sub, n_centroids, self.n_iter, self.max_train, self.seed + j
+            )
+        self.train_error_ = np.float64(self._encode(X))
+        return self
+
+    def assign(self, X):
+        """Encodes X with the trained codebooks.
+        Returns:
+        relative increase of the mean quantisation error since training
+        """
+        return _drift(self._encode(np.asarray(X, dtype=np.float32)), self.train_error_)
+
+    def _encode(self, X):
+        """Sets the codes of X, returns its mean squared quantisation error."""
+        sub_size = self.codebooks_.shape[2]
+        self.codes_ = np.zeros((len(X), self.n_subvectors), dtype=np.uint8)
+        sq_error = np.zeros(len(X))
+        for j in range(self.n_subvectors):
+            sub = X[:, j * sub_size : (j + 1) * sub_size]
+            self.codes_[:, j], sub_d2 = _nearest_centroid(
+                sub, self.codebooks_[j], return_d2=True
+            )
+            sq_error += sub_d2
+        self.n_samples_fit_ = len(X)
+        return np.mean(sq_error) if len(X) > 0 else 0.0
+
+    def distance_tables(self, X):
+        """Squared distances of each query subvector to every centroid of its subspace,
+        shape (num_queries, n_subvectors, n_centroids)."""
+        X = np.asarray(X, dtype=np.float32)
+        sub_size = self.codebooks_.shape[2]
+        sub_queries = X.reshape(len(X), self.n_subvectors, 1, sub_size)
+        diffs = sub_queries - self.codebooks_[None]
+        return np.einsum('qjcd,qjcd->qjc', diffs, diffs)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        tables = self.distance_tables(X)
+
+        def block_d2(start, stop):
+            codes = self.codes_[start:stop]
+            # one table lookup per subvector, for every query and row at once
+            d2 = np.zeros((len(tables), stop - start), dtype=np.float32)
+            for j in range(self.n_subvectors):
+                d2 += tables[:, j, codes[:, j]]
+            return d2
+
+        return _scan_blocks(
+            block_d2, len(tables), self.n_samples_fit_, n_neighbors, return_distance
+        )
+
+
+def _scan_blocks(block_d2, n_queries, n_samples, n_neighbors, return_distance=True):
+    """k smallest squared distances over the database, scanned block by block.
+    block_d2(start, stop) returns the squared distances of every query to rows
+    start:stop, shape (n_queries, stop - start)."""
+    n_neighbors = min(n_neighbors, n_samples)
+    best_d2 = np.full((n_queries, 0), np.inf)
+    best_ind = np.zeros((n_queries, 0), dtype=np.int64)
+    for start in range(0, n_samples, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n_samples)
+        cand_d2 = np.concatenate([best_d2, block_d2(start, stop)], axis=1)
+        block_ind = np.broadcast_to(np.arange(start, stop), (n_queries, stop - start))
+        cand_ind = np.concatenate([best_ind, block_ind], axis=1)
+        if cand_d2.shape[1] > n_neighbors:
+            keep = np.argpartition(cand_d2, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            cand_d2 = np.take_along_axis(cand_d2, keep, axis=1)
+            cand_ind = np.take_along_axis(cand_ind, keep, axis=1)
+        best_d2, best_ind = cand_d2, cand_ind
+
+    order = np.argsort(best_d2, axis=1, kind='stable')
+    best_ind = np.take_along_axis(best_ind, order, axis=1)
+    if not return_distance:
+        return best_ind
+    best_d2 = np.take_along_axis(best_d2, order, axis=1)
+    return np.sqrt(np.maximum(best_d2, 0)), best_ind
+
+
+class IVFFlatIndex(object):
+    """Inverted file index with exact distances inside the probed lists.
+    Input:
+    n_lists: integer or None, number of k-means lists. Default: sqrt(num_emb)
+    n_probe: integer, number of lists searched per query
+    n_neighbors: integer, default number of neighbours of kneighbors
+    n_iter: integer, k-means iterations
+    max_train: integer, maximum number of embeddings used to train k-means
+    seed: integer, random seed of k-means
+    """
+
+    param_names = ('n_lists', 'n_probe', 'n_neighbors', 'n_iter', 'max_train', 'seed')
+    fitted_arrays = (
+        'centroids_',
+        'order_',
+        'data_',
+        'sq_norms_',
+        'list_starts_',
+        'train_error_',
+    )
+
+    def __init__(
+        self, n_lists=None, n_probe=8, n_neighbors=50, n_iter=10, max_train=100000, seed=0
+    ):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_neighbors = n_neighbors
+        self.n_iter = n_iter
+        self.max_train = max_train
+        self.seed = seed
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float32)
+        n_lists = self.n_lists or int(np.sqrt(len(X)))
+        n_lists = int(min(max(n_lists, 1), len(X)))
+
+        self.centroids_ = _kmeans(X, n_lists, self.n_iter, self.max_train, self.seed)
+        self.train_error_ = np.float64(self._fill_lists(X))
+        return self
+
+    def assign(self, X):
+        """Fills the lists of the trained centroids with X.
+        Returns:
+        relative increase of the mean quantisation error since training
+        """
+        X = np.asarray(X, dtype=np.float32)
+        return _drift(self._fill_lists(X), self.train_error_)
+
+    def _fill_lists(self, X):
+        """Stores X list by list, returns its mean squared distance to its centroid."""
+        assignment, d2 = _nearest_centroid(X, self.centroids_, return_d2=True)
+        self.order_ = np.argsort(assignment, kind='stable')
+        self.data_ = X[self.order_]
+        self.sq_norms_ = np.einsum('ij,ij->i', self.data_, self.data_).astype(np.float64)
+        counts = np.bincount(assignment, minlength=len(self.centroids_))
+        self.list_starts_ = np.concatenate([[0], np.cumsum(counts)])
+        self.n_samples_fit_ = len(X)
+        return np.mean(d2) if len(X) > 0 else 0.0
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        n_neighbors = min(n_neighbors, self.n_samples_fit_)
+        X = np.asarray(X, dtype=np.float64)
+
+        probe_order = np.argsort(_sq_dists(X, self.centroids_), axis=1)
+        dists = np.zeros((len(X), n_neighbors))
+        ind = np.zeros((len(X), n_neighbors), dtype=np.int64)
+        for i, query in enumerate(X):
+            rows = self._probe_rows(probe_order[i], n_neighbors)
+            d2 = self.sq_norms_[rows] - 2 * np.dot(self.data_[rows], query)
+            d2 += np.dot(query, query)
+            best = np.argpartition(d2, n_neighbors - 1)[:n_neighbors]
+            best = best[np.argsort(d2[best], kind='stable')]
+            dists[i] = np.sqrt(np.maximum(d2[best], 0))
+            ind[i] = self.order_[rows[best]]
+
+        if return_distance:
+            return dists, ind
+        return ind
+
+    def _probe_rows(self, list_order, n_neighbors):
+        """Rows of the n_probe closest lists, probing further lists if they hold fewer
+        than n_neighbors embeddings."""
+        ranges = []
+        num_rows = 0
+        for n_probed, lst in enumerate(list_order):
+            start, stop = self.list_starts_[lst], self.list_starts_[lst + 1]
+            ranges.append(np.arange(start, stop))
+            num_rows += stop - start
+            if n_probed + 1 >= self.n_probe and num_rows >= n_neighbors:
+                break
+        return np.concatenate(ranges)
+
+
+def _sq_dists(X, C):
+    """Squared euclidean distances between the rows of X and C, in float64."""
+    X = np.asarray(X, dtype=np.float64)
+    C = np.asarray(C, dtype=np.float64)
+    d2 = -2 * np.dot(X, C.T)
+    d2 += np.einsum('ij,ij->i', X, X)[:, None]
+    d2 += np.einsum('ij,ij->i', C, C)[None, :]
+    return np.maximum(d2, 0)
+
+
+def _nearest_centroid(X, centroids, return_d2=False):
+    """Index of the closest centroid of every row of X, and optionally the squared
+    distance to it."""
+    assignment = np.zeros(len(X), dtype=np.int64)
+    min_d2 = np.zeros(len(X))
+    for start in range(0, len(X), BLOCK_SIZE):
+        block_d2 = _sq_dists(X[start : start + BLOCK_SIZE], centroids)
+        block_assignment = np.argmin(block_d2, axis=1)
+        assignment[start : start + BLOCK_SIZE] = block_assignment
+        min_d2[start : start + BLOCK_SIZE] = np.take_along_axis(
+            block_d2, block_assignment[:, None], axis=1
+        )[:, 0]
+    if return_d2:
+        return assignment, min_d2
+    return assignment
+
+
+def _drift(error, train_error):
+    """Relative increase of the quantisation error over the one measured in training."""
+    if train_error <= 0:
+        return 0.0 if error <= 0 else np.inf
+    return float(error / train_error - 1)
+
+
+def _kmeans(X, n_clusters, n_iter=10, max_train=100000, seed=0):
+    """Lloyd's k-means on at most max_train rows of X, initialised with random rows.
+    Empty clusters are re-seeded with random rows."""
+    rng = np.random.RandomState(seed)
+    if len(X) > max_train:
+        X = X[rng.choice(len(X), max_train, replace=False)]
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].astype(np.float64)
+    for _ in range(n_iter):
+        assignment = _nearest_centroid(X, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        non_empty = counts > 0
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        sums = np.add.reduceat(X[order].astype(np.float64), starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+        n_empty = np.sum(~non_empty)
+        if n_empty > 0:
+            centroids[~non_empty] = X[rng.choice(len(X), n_empty, replace=False)]
+    return centroids.astype(np.float32)
+
+
+def recall_at_k(exact_lbls, approx_lbls, k):
+    """Fraction of the exact top-k labels that are in the approximate top-k labels,
+    averaged over queries.
+    Input:
+    exact_lbls, approx_lbls: lists of per-query lists of labels, closest first
+    """
+    recalls = []
+    for exact, approx in zip(exact_lbls, approx_lbls):
+        exact = list(exact)[:k]
+        if len(exact) == 0:
+            continue
+        approx = set(list(approx)[:k])
+        recalls.append(np.mean([lbl in approx for lbl in exact]))
+    return float(np.mean(recalls)) if recalls else 1.0
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Micro-benchmarks of the matching code on synthetic data.
+
+USAGE:
+    python benchmark.py dedupe -q 10000 -n 50 -l 500
+    python benchmark.py augment -q 256
+
+PARAMETERS:
+    dedupe   compare the vectorised duplicate-label collapsing of predict_k_neigh
+             with the per-row rem_dupl loop it replaces
+    augment  compare the vectorised test-time augmentation (utils/augmentation.py)
+             with keras ImageDataGenerator.flow, on -q random 300x300 images
+    -q       number of query rows
+    -n       number of neighbours per row
+    -l       number of distinct labels
+===============================================================================
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + '/utils')
+
+from evaluate_accuracy import collapse_duplicate_labels  # NOQA
+from utils import rem_dupl  # NOQA
+from augmentation import TTA_PARAMS, augment_batch  # NOQA
+
+
+def collapse_duplicate_labels_loop(neigh_ind, neigh_dist, db_lbls, k):
+    """Reference implementation: the label lookup and rem_dupl loops
+    predict_k_neigh used before collapse_duplicate_labels."""
+    neigh_lbl = np.zeros(shape=neigh_ind.shape, dtype=db_lbls.dtype)
+    for i, preds in enumerate(neigh_ind):
+        for j, pred in enumerate(preds):
+            neigh_lbl[i, j] = db_lbls[pred]
+
+    neigh_lbl_un = []
+    neigh_ind_un = []
+    neigh_dist_un = []
+    for j in range(neigh_lbl.shape[0]):
+        indices = np.arange(0, len(neigh_lbl[j]))
+        a, b = rem_dupl(neigh_lbl[j], indices)
+        neigh_lbl_un.append(a[:k])
+        neigh_ind_un.append(neigh_ind[j][b][:k].tolist())
+        neigh_dist_un.append(neigh_dist[j][b][:k].tolist())
+    return neigh_lbl_un, neigh_ind_un, neigh_dist_un
+
+
+def timeit(func, *args, **kwargs):
+    repeats = kwargs.pop('repeats', 3)
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_dedupe(n_queries=10000, n_neighbours=50, n_labels=500, k=10, seed=0):
+    """Time both implementations on random neighbours of string labels and check that
+    they return the same labels, indices and distances.
+    Returns:
+    dict with the best time of each implementation in seconds
+    """
+    rng = np.random.RandomState(seed)
+    n_db = max(n_neighbours, 20 * n_labels)
+    db_lbls = np.array(['name_%d' % lbl for lbl in rng.randint(0, n_labels, n_db)])
+    neigh_ind = np.array(
+        [rng.choice(n_db, n_neighbours, replace=False) for _ in range(n_queries)]
+    )
+    neigh_dist = np.sort(rng.rand(n_queries, n_neighbours), axis=1)
+
+    def vectorised():
+        return collapse_duplicate_labels(db_lbls[neigh_ind], neigh_ind, neigh_dist, k)
+
+    def loop():
+        return collapse_duplicate_labels_loop(neigh_ind, neigh_dist, db_lbls, k)
+
+    loop_time, expected = timeit(loop)
+    vect_time, result = timeit(vectorised)
+    for exp_rows, res_rows in zip(expected, result):
+        assert [list(row) for row in exp_rows] == [list(row) for row in res_rows]
+
+    print(
+        'Duplicate labels, {} rows x {} neighbours, {} labels:'.format(
+            n_queries, n_neighbours, n_labels
+        )
+    )
+    print('loop       {:.4f} s'.format(loop_time))
+    print('vectorised {:.4f} s ({:.1f}x)'.format(vect_time, loop_time / vect_time))
+    return {'loop': loop_time, 'vectorised': vect_time}
+
+
+def benchmark_augment(n_imgs=256, img_size=300, seed=0, augmentation_seed=1):
+    """Time keras ImageDataGenerator.flow and the vectorised augmentation on one batch of
+    random images, and check that the vectorised augmentation is reproducible.
+    Returns:
+    dict with the best time of each implementation in seconds
+    """
+    from keras.preprocessing.image import ImageDataGenerator
+
+    rng = np.random.RandomState(seed)
+    imgs = rng.randint(0, 256, (n_imgs, img_size, img_size, 3)).astype(np.uint8)
+    aug_gen = ImageDataGenerator(
+        data_format='channels_last', fill_mode='reflect', **TTA_PARAMS
+    )
+
+    def keras_flow():
+        return aug_gen.flow(imgs, batch_size=n_imgs, seed=augmentation_seed)[0]
+
+    def vectorised():
+        return augment_batch(imgs, augmentation_seed)
+
+    keras_time, _ = timeit(keras_flow)
+    vect_time, result = timeit(vectorised)
+    assert np.array_equal(result, vectorised())
+
+    print('Test-time augmentation of {} images {}x{}:'.format(n_imgs, img_size, img_size))
+    print('keras      {:.4f} s'.format(keras_time))
+    print('vectorised {:.4f} s ({:.1f}x)'.format(vect_time, keras_time / vect_time))
+    return {'keras': keras_time, 'vectorised': vect_time}
+
+
+argparser = argparse.ArgumentParser(description='Micro-benchmarks of matching code.')
+argparser.add_argument(
+    'benchmark', choices=['dedupe', 'augment'], help='Benchmark to run'
+)
+argparser.add_argument('-q', '--queries', type=int, default=10000, help='Query rows')
+argparser.add_argument(
+    '-n', '--neighbours', type=int, default=50, help='Neighbours per row'
+)
+argparser.add_argument('-l', '--labels', type=int, default=500, help='Distinct labels')
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    if args.benchmark == 'dedupe':
+        benchmark_dedupe(args.queries, args.neighbours, args.labels)
+    elif args.benchmark == 'augment':
+        benchmark_augment(args.queries)
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
 from sklearn.utils import shuffle
 
 import os
@@ -10,10 +9,18 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__)))  # models subdir
 
 from utils import rem_dupl  # NOQA
 from metrics import acck, mapk  # NOQA
+from ann import make_nn_classifier, nn_backend_name, recall_at_k  # NOQA
 
 
 def evaluate_1_vs_all(
-    train, train_lbl, test, test_lbl, n_eval_runs=10, move_to_db=2, k_list=[1, 5, 10]
+    train,
+    train_lbl,
+    test,
+    test_lbl,
+    n_eval_runs=10,
+    move_to_db=2,
+    k_list=[1, 5, 10],
+    nn_params=None,
 ):
     """Compute accuracy on each class from test set given the training set in multiple runs.
     Input:
@@ -24,6 +31,8 @@ def evaluate_1_vs_all(
     n_eval_runs: integer, number of evaluation runs,default = 10
     move_to_db: integer, number of images to move to a database for each individual, default = 2
     k: array of integers, top-k accuracy to evaluate.
+    nn_params: None or dict, nearest neighbour backend (see ann.py). For an approximate
+               backend, recall@k of its labels against the exact search is reported too.
 
     Returns:
     mean_accuracy_1, mean_accuracy_5, mean_accuracy_10
@@ -41,9 +50,12 @@ def evaluate_1_vs_all(
     acc = {k: [] for k in k_list}
     map_dict = {k: [] for k in k_list}
     max_k = max(k_list)
+    is_approximate = nn_backend_name(nn_params) != 'exact'
+    recall = {k: [] for k in k_list}
 
     for i in range(n_eval_runs):
         neigh_lbl_run = []
+        exact_lbl_run = []
         db_emb, db_lbl, query_emb, query_lbl = get_eval_set_one_class(
             train, train_lbl, test, test_lbl, move_to_db=move_to_db
         )
@@ -51,9 +63,14 @@ def evaluate_1_vs_all(
 
         for j in range(len(db_emb)):
             neigh_lbl_un, _, _ = predict_k_neigh(
-                db_emb[j], db_lbl[j], query_emb[j], k=max_k
+                db_emb[j], db_lbl[j], query_emb[j], k=max_k, nn_params=nn_params
             )
             neigh_lbl_run.append(neigh_lbl_un)
+            if is_approximate:
+                exact_lbl_un, _, _ = predict_k_neigh(
+                    db_emb[j], db_lbl[j], query_emb[j], k=max_k
+                )
+                exact_lbl_run.append(exact_lbl_un)
 
         query_lbl = flatten(query_lbl)
         neigh_lbl_run = flatten(neigh_lbl_run)
@@ -62,6 +79,8 @@ def evaluate_1_vs_all(
         for k in k_list:
             acc[k].append(acck(query_lbl, neigh_lbl_run, k=k, verbose=False))
             map_dict[k].append(mapk(query_lbl, neigh_lbl_run, k=k))
+            if is_approximate:
+                recall[k].append(recall_at_k(flatten(exact_lbl_run), neigh_lbl_run, k))
 
     # Report accuracy
     print('Accuracy over {} runs:'.format(n_eval_runs))
@@ -81,11 +100,27 @@ def evaluate_1_vs_all(
     for i, k in enumerate(k_list):
         print('MAP@{} %{:.2f} +-{:.2f}'.format(k, map_runs[i], std_map_runs[i]))
 
+    # Report recall of the approximate backend against exact search
+    if is_approximate:
+        print('Recall of {} against exact search:'.format(nn_backend_name(nn_params)))
+        for k in k_list:
+            print('RECALL@{} %{:.2f}'.format(k, np.mean(recall[k]) * 100))
+
     return dict(zip(k_list, acc_runs)), dict(zip(k_list, std_runs))
 
 
 def predict_k_neigh(
-    db_emb, db_lbls, test_emb, k=5, f=None, nearest_neighbors_cache_path=None
+    db_emb,
+    db_lbls,
+    test_emb,
+    k=5,
+    f=None,
+    nearest_neighbors_cache_path=None,
+    nn_classifier=None,
+    cache_key=None,
+    adaptive=False,
+    max_depth=None,
+    nn_params=None,
 ):
     """Predict k nearest solutions for test embeddings based on labelled database embeddings.
     Input:
@@ -93,6 +128,20 @@ def predict_k_neigh(
     db_lbls: 1D array, string or floats: database labels
     test_emb: 2D float array: test embeddings
     k: integer, number of predictions.
+    nn_classifier: None or object with a sklearn-like kneighbors(X, n_neighbors) method
+                   searching db_emb, eg. a view of a persistent NeighborIndex.
+                   If provided, nothing is fitted and db_emb is not used.
+    cache_key: None or string identifying db_emb (contents and order), eg. a maintained
+               digest of the database. Used to name the nearest neighbours cache file in
+               nearest_neighbors_cache_path. If None, db_emb is hashed.
+    adaptive: boolean, if False a fixed number of min(50, num_emb) nearest points is
+              searched, so fewer than k labels are returned when the closest individuals
+              have many embeddings. If True the search starts at 2*k points and is
+              expanded (x4) for the queries with fewer than k distinct labels.
+    max_depth: integer or None, bound on the number of points searched in adaptive mode.
+               Default: all embeddings (exact top-k labels).
+    nn_params: None or dict, nearest neighbour backend fitted on db_emb, eg. the
+               "predict" section of a config (see ann.py). Default: exact search.
 
     Returns:
     neigh_lbl_un - 2d int array of shape [len(test_emb), k] labels of predictions
@@ -101,9 +150,9 @@ def predict_k_neigh(
     """
     # Set number of nearest points (with duplicated labels)
 
-    k_w_dupl = min(50, len(db_emb))
+    k_w_dupl = min(50, len(db_lbls))
 
-    if nearest_neighbors_cache_path is None:
+    if nn_classifier is not None or nearest_neighbors_cache_path is None:
         cache_filepath = None
     else:
         import utool as ut
@@ -111,20 +160,22 @@ def predict_k_neigh(
 
         assert os.path.exists(nearest_neighbors_cache_path)
 
-        db_emb_hash = list(map(ut.hash_data, db_emb))
-        db_data = list(zip(db_emb_hash, db_lbls))
-        db_data = sorted(db_data)
-        db_data = '%s' % (db_data,)
-        db_data_hash = ut.hash_data(db_data)
+        if cache_key is None:
+            # One pass over the embeddings buffer. The fitted classifier returns
+            # indices into db_emb, so the key depends on the order of the embeddings.
+            cache_key = ut.hash_data(np.ascontiguousarray(db_emb))
         args = (
             len(db_emb),
-            db_data_hash,
+            cache_key,
             k_w_dupl,
         )
         cache_filename = 'pie-kneigh-num-%d-hash-%s-k-%d.cPkl' % args
+        if nn_backend_name(nn_params) != 'exact':
+            cache_filename = cache_filename.replace(
+                '.cPkl', '-%s.cPkl' % nn_backend_name(nn_params)
+            )
         cache_filepath = os.path.join(nearest_neighbors_cache_path, cache_filename)
 
-    nn_classifier = None
     if cache_filepath is not None and os.path.exists(cache_filepath):
         print('[pie] Found existing K Nearest Neighbors cache at: %r' % (cache_filepath,))
         try:
@@ -136,7 +187,7 @@ def predict_k_neigh(
             nn_classifier = None
 
     if nn_classifier is None:
-        nn_classifier = NearestNeighbors(n_neighbors=k_w_dupl, metric='euclidean')
+        nn_classifier = make_nn_classifier(nn_params, n_neighbors=k_w_dupl)
         nn_classifier.fit(db_emb, db_lbls)
 
     if cache_filepath is not None and not os.path.exists(cache_filepath):
@@ -146,27 +197,110 @@ def predict_k_neigh(
             pickle.dump(nn_classifier, pickle_file)
         print('[pie] pie cache saved!')
 
+    if adaptive:
+        return adaptive_k_neigh(nn_classifier, db_lbls, test_emb, k, max_depth)
+
     # Predict nearest neighbors and distances for test embeddings
-    neigh_dist, neigh_ind = nn_classifier.kneighbors(test_emb)
+    neigh_dist, neigh_ind = nn_classifier.kneighbors(test_emb, n_neighbors=k_w_dupl)
 
     # Get labels of nearest neighbors
-    neigh_lbl = np.zeros(shape=neigh_ind.shape, dtype=db_lbls.dtype)
-    for i, preds in enumerate(neigh_ind):
-        for j, pred in enumerate(preds):
-            neigh_lbl[i, j] = db_lbls[pred]
+    neigh_lbl = np.asarray(db_lbls)[neigh_ind]
 
     # Remove duplicates
-    neigh_lbl_un = []
-    neigh_ind_un = []
-    neigh_dist_un = []
+    return collapse_duplicate_labels(neigh_lbl, neigh_ind, neigh_dist, k)
 
-    for j in range(neigh_lbl.shape[0]):
-        indices = np.arange(0, len(neigh_lbl[j]))
-        a, b = rem_dupl(neigh_lbl[j], indices)
-        neigh_lbl_un.append(a[:k])
-        neigh_ind_un.append(neigh_ind[j][b][:k].tolist())
-        neigh_dist_un.append(neigh_dist[j][b][:k].tolist())
 
+def adaptive_k_neigh(nn_classifier, db_lbls, test_emb, k, max_depth=None):
+    """Search deeper until k distinct labels are found for each test embedding.
+    The first search retrieves 2*k points. Queries that still have fewer than k distinct
+    labels are searched again with 4 times more points, until max_depth points are
+    searched, so the worst case is a few searches of max_depth points. A query also stops
+    when the database has fewer than k labels and all of them are found.
+    Input:
+    nn_classifier: fitted NearestNeighbors or object with the same kneighbors method
+    db_lbls: 1D array of labels of the searched points
+    test_emb: 2D float array: test embeddings
+    k: integer, number of distinct labels
+    max_depth: integer or None, maximum number of points searched. Default: all points
+    Returns:
+    neigh_lbl_un, neigh_ind_un, neigh_dist_un as in predict_k_neigh
+    """
+    db_lbls = np.asarray(db_lbls)
+    test_emb = np.asarray(test_emb)
+    max_depth = len(db_lbls) if max_depth is None else min(max_depth, len(db_lbls))
+    depth = min(2 * k, max_depth)
+    # k cannot be reached with fewer labels in the database
+    k_found = min(k, len(np.unique(db_lbls)))
+
+    neigh_lbl_un = [None] * len(test_emb)
+    neigh_ind_un = [None] * len(test_emb)
+    neigh_dist_un = [None] * len(test_emb)
+    pending = np.arange(len(test_emb))
+    while len(pending) > 0:
+        neigh_dist, neigh_ind = nn_classifier.kneighbors(
+            test_emb[pending], n_neighbors=depth
+        )
+        lbl_un, ind_un, dist_un = collapse_duplicate_labels(
+            db_lbls[neigh_ind], neigh_ind, neigh_dist, k
+        )
+        is_done = np.array([len(lbls) >= k_found for lbls in lbl_un]) | (
+            depth >= max_depth
+        )
+        for i, row in enumerate(pending):
+            if is_done[i]:
+                neigh_lbl_un[row] = lbl_un[i]
+                neigh_ind_un[row] = ind_un[i]
+                neigh_dist_un[row] = dist_un[i]
+        pending = pending[~is_done]
+        depth = min(4 * depth, max_depth)
+
+    return neigh_lbl_un, neigh_ind_un, neigh_dist_un
+
+
+def first_occurrences(labels):
+    """Mask of the first occurrence of each label in each row of a 2D array.
+    Labels are integer-encoded, then a (row, label) pair is kept only at the first
+    column it appears in: np.unique returns the first index of every distinct pair.
+    Input:
+    labels: 2D array (num_rows, num_cols) of any comparable dtype
+    Returns:
+    2D bool array of the same shape
+    """
+    num_rows, num_cols = labels.shape
+    _, codes = np.unique(labels, return_inverse=True)
+    codes = codes.reshape(num_rows, num_cols).astype(np.int64)
+    keys = codes + np.arange(num_rows, dtype=np.int64)[:, None] * (codes.max() + 1)
+    _, first_index = np.unique(keys.ravel(), return_index=True)
+    mask = np.zeros(num_rows * num_cols, dtype=bool)
+    mask[first_index] = True
+    return mask.reshape(num_rows, num_cols)
+
+
+def collapse_duplicate_labels(neigh_lbl, neigh_ind, neigh_dist, k):
+    """Keep the first (closest) neighbour of each label in each row, up to k per row.
+    Input:
+    neigh_lbl, neigh_ind, neigh_dist: 2D arrays (num_queries, num_neighbours) of labels,
+        indices and distances of the nearest points, closest first
+    k: integer, maximum number of labels to keep per row
+    Returns:
+    neigh_lbl_un - list of num_queries lists of at most k distinct labels
+    neigh_ind_un - list of num_queries lists of indices of the kept points
+    neigh_dist_un - list of num_queries lists of distances of the kept points
+    """
+    neigh_ind = np.asarray(neigh_ind)
+    neigh_dist = np.asarray(neigh_dist)
+    if neigh_lbl.size == 0:
+        empty = [[] for _ in range(len(neigh_lbl))]
+        return empty, [[] for _ in empty], [[] for _ in empty]
+
+    keep = first_occurrences(neigh_lbl)
+    keep &= np.cumsum(keep, axis=1) <= k
+
+    # split the kept entries of the flattened arrays back into rows
+    splits = np.cumsum(keep.sum(axis=1))[:-1]
+    neigh_lbl_un = [list(row) for row in np.split(neigh_lbl[keep], splits)]
+    neigh_ind_un = [row.tolist() for row in np.split(neigh_ind[keep], splits)]
+    neigh_dist_un = [row.tolist() for row in np.split(neigh_dist[keep], splits)]
     return neigh_lbl_un, neigh_ind_un, neigh_dist_un
 
 
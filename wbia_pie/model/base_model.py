@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import hashlib
+from contextlib import contextmanager
 import numpy as np
 from keras.models import Model
+from keras.layers import Input
 from keras.preprocessing.image import ImageDataGenerator
 import keras.backend as K
 from keras.callbacks import Callback
@@ -22,7 +25,10 @@ from backend import (  # NOQA
     # EfficientNetB2Feature,
 )  # NOQA
 from backend import InceptionResNetV2Feature  # NOQA
-from utils import make_batches  # NOQA
+from utils import make_seeded_batches  # NOQA
+from preprocessing import load_resized_imgs  # NOQA
+from pipeline import prefetch, StageTimer  # NOQA
+import augmentation as batch_augmentation  # NOQA
 from top_models import glob_pool_norm, glob_pool, glob_softmax  # NOQA
 from keras.callbacks import EarlyStopping, ModelCheckpoint, CSVLogger  # NOQA
 import keras.backend as K  # NOQA
@@ -183,6 +189,7 @@ class BaseModel(object):
         weights='imagenet',
         optimizer='adam',
         use_dropout=False,
+        augmentation='keras',
     ):
         """Base model consists of backend feature extractor (pretrained model) and a front-end model.
 
@@ -196,8 +203,13 @@ class BaseModel(object):
         train_from_layer: integer (positive or negative) or a string: either index of a layer or name of a layer
                            to train the model from.
         distance: string, distance function to calculate distance between embeddings. TODO: implement
+        augmentation: string, implementation of test-time augmentation: 'keras' (ImageDataGenerator)
+                      or 'vectorised' (utils/augmentation.py, batched and seeded per batch)
 
         """
+        if augmentation not in ('keras', 'vectorised'):
+            raise Exception('{} augmentation is not supported'.format(augmentation))
+        self.augmentation = augmentation
         self.input_shape = input_shape
         self.embedding_size = embedding_size
         self.weights = weights
@@ -212,6 +224,9 @@ class BaseModel(object):
         self.train_from_layer = self.get_train_from_layer(train_from_layer)
         self.top_model()
         self.distance = distance
+        # graph and session the model was loaded in, see predict_scope
+        self.graph = None
+        self.session = None
 
     def feature_extractor(self):
         """ Base feature extractor """
@@ -256,19 +271,55 @@ class BaseModel(object):
         self.features_shape = self.backend_model.get_output_shape_at(0)[1:]
         print('Shape of base features: {}'.format(self.features_shape))
 
-    def preproc_predict(self, imgs, batch_size=32, augmentation_seed=None):
+    def capture_graph(self):
+        """Keep the current graph and session as those of the model and build its predict
+        function in them, so it can predict from other threads (see predict_scope).
+        """
+        self.session = K.get_session()
+        self.graph = self.session.graph
+        with self.predict_scope():
+            self.model.predict_on_batch(
+                np.zeros((1,) + tuple(self.input_shape), dtype=np.float32)
+            )
+
+    @contextmanager
+    def predict_scope(self):
+        """Graph and session of the model as defaults of the calling thread, once
+        captured by capture_graph. Keras only sets them for the thread that built the model.
+        """
+        if self.graph is None:
+            yield
+            return
+        with self.graph.as_default(), self.session.as_default():
+            yield
+
+    def preproc_predict(
+        self,
+        imgs,
+        batch_size=32,
+        augmentation_seed=None,
+        seed_batch_size=None,
+        offset=0,
+    ):
         """Preprocess images and predict with the model (no batch processing for first step)
         Input:
         imgs: 4D float or int array of images
         batch_size: integer, size of the batch
+        seed_batch_size: integer or None, size of the batches test-time augmentation draws
+                         its transforms for, whatever batch_size. Default: batch_size
+        offset: integer, number of images before imgs (eg. in previous chunks)
         Returns:
-        predictions: numpy array with predictions (num_images, len_model_output)
+        predictions: float32 array with predictions (num_images, len_model_output)
         """
         print('base_model preproc_predict!')
         # import utool as ut
         # ut.embed()
-        batch_idx = make_batches(imgs.shape[0], batch_size)
-        imgs_preds = np.zeros((imgs.shape[0],) + self.model.get_output_shape_at(0)[1:])
+        batch_idx = make_seeded_batches(
+            imgs.shape[0], batch_size, seed_batch_size, offset
+        )
+        imgs_preds = np.zeros(
+            (imgs.shape[0],) + self.model.get_output_shape_at(0)[1:], dtype=np.float32
+        )
         print('Computing predictions with the shape {}'.format(imgs_preds.shape))
 
         # do some augmentation here
@@ -278,36 +329,193 @@ class BaseModel(object):
             % (use_augmentation, augmentation_seed)
         )
         if use_augmentation:
-            gen_args = dict(
-                rotation_range=30,
-                width_shift_range=0.15,
-                height_shift_range=0.15,
-                shear_range=0.1,
-                zoom_range=0.15,
-                channel_shift_range=0.15,
-                data_format=K.image_data_format(),
-                fill_mode='reflect',
-                preprocessing_function=self.backend_class.normalize,
-            )
-            aug_gen = ImageDataGenerator(**gen_args)
+            aug_gen = self.augmentation_generator()
+            self._check_seeded_batches(batch_idx)
 
-        for sid, eid in batch_idx:
+        for sid, eid, start in batch_idx:
             if use_augmentation:
-                # [0] found experimentally
-                preproc = aug_gen.flow(
-                    imgs[sid:eid], batch_size=batch_size, seed=augmentation_seed
+                preproc = self.augment_batch(
+                    aug_gen, imgs[sid:eid], batch_size, augmentation_seed, start
                 )
-                assert len(preproc) == 1
-                assert len(preproc[0]) <= batch_size
-                preproc = preproc[0]
             else:
                 preproc = self.backend_class.normalize(imgs[sid:eid])
-            imgs_preds[sid:eid] = self.model.predict_on_batch(preproc)
+            with self.predict_scope():
+                imgs_preds[sid:eid] = self.model.predict_on_batch(preproc)
 
         print('imgs_preds = %s' % imgs_preds)
 
         return imgs_preds
 
+    def augmentation_generator(self):
+        """Test-time augmentation used by preproc_predict when a seed is given"""
+        gen_args = dict(
+            data_format=K.image_data_format(),
+            fill_mode='reflect',
+            preprocessing_function=self.backend_class.normalize,
+            **batch_augmentation.TTA_PARAMS
+        )
+        return ImageDataGenerator(**gen_args)
+
+    def augment_batch(self, aug_gen, imgs, batch_size, augmentation_seed, start=0):
+        """Augment and normalise one batch, starting at position start of its seeded
+        batch. The keras augmentation seeds the global numpy random state, so it must
+        not be called from several threads at once; the vectorised one (aug_gen is
+        unused) can."""
+        if self.augmentation == 'vectorised':
+            return self.backend_class.normalize(
+                batch_augmentation.augment_batch(imgs, augmentation_seed, start=start)
+            )
+        # [0] found experimentally
+        preproc = aug_gen.flow(imgs, batch_size=batch_size, seed=augmentation_seed)
+        assert len(preproc) == 1
+        assert len(preproc[0]) <= batch_size
+        return preproc[0]
+
+    def _check_seeded_batches(self, batch_idx):
+        """The keras augmentation draws the transforms of a whole batch at once, so it
+        can only augment batches that start seeded batches (a batch that ends one early
+        is followed by one that does not)."""
+        if self.augmentation == 'keras' and any(start != 0 for _, _, start in batch_idx):
+            raise ValueError(
+                'keras augmentation draws its transforms per batch and cannot augment '
+                'part of a seeded batch: use "augmentation": "vectorised" to augment '
+                'batches smaller than the seeded ones'
+            )
+
+    def predict_files(
+        self,
+        files,
+        batch_size=32,
+        augmentation_seed=None,
+        n_workers=4,
+        queue_depth=8,
+        timer=None,
+        load_imgs=None,
+        seed_batch_size=None,
+    ):
+        """Read, preprocess and predict a list of image files. Reading, resizing and
+        normalisation of the next batches run on a pool of worker threads while the
+        model predicts the current batch.
+        Input:
+        files: list of strings, paths to images, resized to the model input on reading
+               (or any items read by load_imgs)
+        batch_size: integer, size of the batch
+        n_workers: integer, number of threads decoding images. 0 to decode in this thread
+        queue_depth: integer, number of batches prepared ahead of the model
+        timer: StageTimer or None, collects time spent in decode, normalize, augment,
+               predict and wait (model idle waiting for the workers) stages
+        load_imgs: function (files, size) returning the 4D uint8 array of a batch of files
+                   at size (width, height), called on the worker threads.
+                   Default: load_resized_imgs
+        seed_batch_size: integer or None, size of the batches test-time augmentation draws
+                         its transforms for, whatever batch_size. Default: batch_size
+        Returns:
+        predictions: float32 array with predictions (num_images, len_model_output) in the
+                     order of files
+        """
+        return self.predict_files_seeds(
+            files,
+            [augmentation_seed],
+            batch_size,
+            n_workers,
+            queue_depth,
+            timer,
+            load_imgs,
+            seed_batch_size,
+        )[0]
+
+    def predict_files_seeds(
+        self,
+        files,
+        augmentation_seeds,
+        batch_size=32,
+        n_workers=4,
+        queue_depth=8,
+        timer=None,
+        load_imgs=None,
+        seed_batch_size=None,
+    ):
+        """Same as predict_files for several augmentation seeds at once: every batch is
+        decoded once and predicted once per seed. Predictions for a seed are the same
+        as predict_files with that seed and seed batch size.
+        Input:
+        augmentation_seeds: list of integers or None (no augmentation)
+        Returns:
+        list of float32 arrays (num_images, len_model_output), one per seed
+        """
+        if timer is None:
+            timer = StageTimer()
+        if load_imgs is None:
+            load_imgs = load_resized_imgs
+        size = (self.input_shape[1], self.input_shape[0])
+        batch_idx = make_seeded_batches(len(files), batch_size, seed_batch_size)
+        output_shape = (len(files),) + self.model.get_output_shape_at(0)[1:]
+        seeds_preds = [
+            np.zeros(output_shape, dtype=np.float32) for _ in augmentation_seeds
+        ]
+
+        aug_seeds = [seed for seed in augmentation_seeds if seed is not None]
+        if len(aug_seeds) > 0:
+            aug_gen = self.augmentation_generator()
+            self._check_seeded_batches(batch_idx)
+        # the vectorised augmentation does not use the global random state, so it runs
+        # on the worker threads, overlapping with the model
+        augment_in_workers = self.augmentation == 'vectorised'
+
+        def load_batch(idx):
+            sid, eid, start = idx
+            with timer.stage('decode'):
+                imgs = load_imgs(files[sid:eid], size)
+            preprocs = {}
+            if len(aug_seeds) < len(augmentation_seeds):
+                with timer.stage('normalize'):
+                    preprocs[None] = self.backend_class.normalize(imgs)
+            if augment_in_workers:
+                for seed in aug_seeds:
+                    with timer.stage('augment'):
+                        preprocs[seed] = self.augment_batch(
+                            None, imgs, batch_size, seed, start
+                        )
+            return imgs, preprocs
+
+        batches = prefetch(load_batch, batch_idx, n_workers, queue_depth, timer)
+        for (sid, eid, start), (imgs, preprocs) in zip(batch_idx, batches):
+            for seed, imgs_preds in zip(augmentation_seeds, seeds_preds):
+                preproc = preprocs.get(seed)
+                if preproc is None:
+                    # keras augmentation relies on the global random state, done here
+                    with timer.stage('augment'):
+                        preproc = self.augment_batch(
+                            aug_gen, imgs, batch_size, seed, start
+                        )
+                with timer.stage('predict'), self.predict_scope():
+                    imgs_preds[sid:eid] = self.model.predict_on_batch(preproc)
+
+        timer.report()
+        return seeds_preds
+
+    def predict_stream(
+        self, img_chunks, batch_size=32, augmentation_seed=None, seed_batch_size=None
+    ):
+        """Streaming version of preproc_predict: consumes chunks of images and yields
+        their predictions one chunk at a time, so only one chunk is held in memory.
+        With augmentation, results match preproc_predict on the whole set with the same
+        seed_batch_size, whatever the size of the chunks and batches (with the keras
+        augmentation, chunks but the last must be multiples of seed_batch_size).
+        Input:
+        img_chunks: iterable of 4D float or int arrays of images
+        batch_size: integer, size of the batch
+        seed_batch_size: integer or None, see preproc_predict. Default: batch_size
+        Yields:
+        predictions: numpy array with predictions (len(chunk), len_model_output)
+        """
+        offset = 0
+        for chunk in img_chunks:
+            yield self.preproc_predict(
+                chunk, batch_size, augmentation_seed, seed_batch_size, offset
+            )
+            offset += len(chunk)
+
     def top_model(self, verbose=1):
         """Model on top of features."""
         if self.frontend == 'glob_pool_norm':
@@ -513,7 +721,95 @@ class BaseModel(object):
             use_multiprocessing=False,
         )
 
+    def train_on_features(
+        self,
+        train_gen,
+        valid_gen,
+        nb_epochs,
+        batch_size,
+        learning_rate,
+        steps_per_epoch,
+        distance='l2',
+        saved_weights_name='best_weights.h5',
+        logs_file='history.csv',
+        debug=False,
+        weights=None,
+    ):
+        """Same as train, on generators of precomputed backbone features instead of images
+        (see utils/feature_cache.py): only the head runs, the backbone must be frozen.
+        The head shares its layers with the model, so the whole model is trained and
+        saved_weights_name is the whole model at the best epoch, as with train.
+        Note that frozen BatchNormalization layers of the backbone use their moving
+        statistics in the cached features, not the statistics of the batch.
+        """
+        if not self.backbone_frozen():
+            raise Exception('Features can only be precomputed for a frozen backbone')
+
+        head_weights_name = os.path.splitext(saved_weights_name)[0] + '_head.h5'
+        model = self.model
+        head = self.head_model()
+        self.model = head
+        try:
+            self.train(
+                train_gen,
+                valid_gen,
+                nb_epochs,
+                batch_size,
+                learning_rate,
+                steps_per_epoch,
+                distance=distance,
+                saved_weights_name=head_weights_name,
+                logs_file=logs_file,
+                debug=debug,
+                weights=weights,
+            )
+        finally:
+            self.model = model
+
+        # save the whole model with the head of the best epoch, and keep training
+        # from the weights of the last epoch
+        if os.path.exists(head_weights_name):
+            last_weights = head.get_weights()
+            head.load_weights(head_weights_name)
+            self.model.save(saved_weights_name)
+            head.set_weights(last_weights)
+
+    def backbone_frozen(self):
+        """True if no layer of backend_model is trained (train_from_layer is past it),
+        so that its features can be precomputed."""
+        return self.train_from_layer >= len(self.backend_model.layers)
+
+    def backbone_key(self):
+        """Key of the features computed by backend_model: backend, connect layer, input
+        shape and a digest of the backbone weights."""
+        hasher = hashlib.sha1(
+            repr((self.backend, self.connect_layer, tuple(self.input_shape))).encode(
+                'utf-8'
+            )
+        )
+        for weights in self.backend_model.get_weights():
+            hasher.update(np.ascontiguousarray(weights).tobytes())
+        return '{}-{}'.format(self.backend, hasher.hexdigest()[:16])
+
+    def head_model(self):
+        """Layers of top_model after backend_model, as a model with the backbone features
+        as input. Layers (and so weights) are shared with top_model."""
+        if getattr(self, '_head_model', None) is None:
+            features = Input(shape=self.features_shape)
+            x = features
+            for layer in self.top_model.layers[len(self.backend_model.layers) :]:
+                x = layer(x)
+            self._head_model = Model(features, x, name='head_model')
+        return self._head_model
+
     def precompute_features(self, imgs, batch_size):
-        imgs = self.backend_class.preprocess_imgs(imgs)
+        """Backbone features of images, see utils/feature_cache.py"""
+        imgs = self.backend_class.normalize(imgs)
         features = self.backend_model.predict(imgs, batch_size)
         return features
+
+    def predict_features(self, features, batch_size=32):
+        """Predictions of the model from precomputed backbone features, running only the
+        head. Same as preproc_predict (without augmentation) on the images of the features.
+        """
+        return self.head_model().predict(features, batch_size).astype(np.float32)
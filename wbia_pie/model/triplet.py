@@ -34,6 +34,7 @@ class TripletLoss(BaseModel):
         optimizer='adam',
         use_dropout=False,
         show_summary=True,
+        augmentation='keras',
     ):
         self.loss_func = loss_func
         super(TripletLoss, self).__init__(
@@ -47,6 +48,7 @@ class TripletLoss(BaseModel):
             weights,
             optimizer,
             use_dropout,
+            augmentation,
         )
         self.model = self.top_model
         if show_summary:
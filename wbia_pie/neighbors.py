@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Persistent nearest neighbour index of PIE embeddings.
+
+predict_k_neigh fits a new sklearn NearestNeighbors on the whole database for
+every new database, so a single new sighting triggers a refit on every
+embedding. A NeighborIndex keeps the embeddings of every annotation seen for a
+config in one contiguous matrix, which supports adding and removing
+annotations in place and exact euclidean queries over the whole index or a
+subset of it (see NeighborIndex.view).
+
+An index is saved in a folder as .npy files (embeddings, aids, depc rowids,
+embedding hashes) and opened memory-mapped, so processes querying the same
+index share one page-cache copy. The matrix is only copied into memory once
+it is modified. Saving after a few additions or removals does not rewrite the
+matrix: the changes since the last save are appended as a delta segment
+(delta.*.npz) that load replays. The .npy files are rewritten, and the
+segments dropped, once the segments hold more than COMPACT_FRACTION of the
+rows of the matrix, so saving costs O(1) amortized per changed row. Loads and
+saves hold a lock file of the folder; a writer that is behind the saved index
+replays its changes on top of it, so concurrent writers merge their changes.
+
+The index also maintains a content digest: the XOR of a 64-bit hash of every
+(aid, embedding). It is updated in O(1) per added or removed aid, so caches
+keyed by the digest never hash the embeddings again (see NeighborIndex.digest).
+
+A NameIndex answers name-level queries directly: it searches a few
+representatives per name (the centroid and exemplars of its embeddings) to
+shortlist names, then re-ranks the shortlisted names exactly by their closest
+embedding.
+
+USAGE:
+    index = NeighborIndex.load(folder)
+    index.add(aids, embs)
+    index.remove(aids)
+    dists, aids = index.query(embs, k)
+    index.save()
+
+    name_index = NameIndex(index.embeddings[index.rows(aids)], labels)
+    neigh_lbl, neigh_ind, neigh_dist = name_index.kneighbors_names(embs, k)
+===============================================================================
+"""
+
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+import contextlib
+
+import numpy as np
+
+from .utils.emb_store import save_npy_atomic
+
+EMB_FNAME = 'emb.npy'
+AIDS_FNAME = 'aids.npy'
+ROWIDS_FNAME = 'rowids.npy'
+HASHES_FNAME = 'hashes.npy'
+META_FNAME = 'meta.json'
+LOCK_FNAME = 'index.lock'
+DELTA_FNAME = 'delta.{}.npz'
+
+# delta segments are merged into the .npy files once they hold more than this fraction
+# of the rows of the saved matrix
+COMPACT_FRACTION = 0.25
+
+# number of database rows per block of the distance computation
+QUERY_BLOCK_SIZE = 4096
+
+
+class NeighborIndex(object):
+    """Exact euclidean nearest neighbour index over embeddings identified by aids.
+    Rows are kept contiguous: removing an aid moves the last row into its place.
+    """
+
+    def __init__(self, folder=None, emb_size=None):
+        self.folder = folder
+        self.emb_size = emb_size
+        self.version = 0
+        self._emb = np.zeros((0, emb_size or 0), dtype=np.float32)
+        self._sq_norms = np.zeros((0,), dtype=np.float64)
+        self._aids = np.zeros((0,), dtype=np.int64)
+        self._rowids = np.zeros((0,), dtype=np.int64)
+        self._hashes = np.zeros((0,), dtype=np.uint64)
+        self._digest = 0
+        self._size = 0
+        self._aid_to_row = {}
+        # changes since the last save, and delta segments saved on top of the .npy files
+        self._ops = []
+        self._segments = []
+        self._base_size = 0
+        self._delta_size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, aid):
+        return aid in self._aid_to_row
+
+    @property
+    def aids(self):
+        return self._aids[: self._size]
+
+    @property
+    def rowids(self):
+        return self._rowids[: self._size]
+
+    @property
+    def embeddings(self):
+        return self._emb[: self._size]
+
+    @classmethod
+    def load(cls, folder):
+        """Open the index saved in folder, memory-mapped. Returns an empty index
+        if nothing was saved in folder yet.
+        """
+        if not os.path.exists(os.path.join(folder, META_FNAME)):
+            return cls(folder)
+        with _locked(folder, exclusive=False):
+            return cls._load(folder)
+
+    @classmethod
+    def _load(cls, folder):
+        # called under the lock of folder
+        index = cls(folder)
+        meta = _read_meta(folder)
+        if meta is None:
+            return index
+
+        index.version = meta['version']
+        index.emb_size = meta['emb_size']
+        index._emb = np.load(os.path.join(folder, EMB_FNAME), mmap_mode='r')
+        index._aids = np.load(os.path.join(folder, AIDS_FNAME))
+        index._rowids = np.load(os.path.join(folder, ROWIDS_FNAME))
+        if 'digest' in meta:
+            index._hashes = np.load(os.path.join(folder, HASHES_FNAME))
+            index._digest = int(meta['digest'], 16)
+        else:
+            # saved before digests were maintained: hash every entry once
+            index._hashes = np.array(
+                [_entry_hash(aid, emb) for aid, emb in zip(index._aids, index._emb)],
+                dtype=np.uint64,
+            )
+            index._digest = int(np.bitwise_xor.reduce(index._hashes))
+        index._size = len(index._aids)
+        index._sq_norms = _squared_norms(index._emb)
+        index._aid_to_row = {aid: row for row, aid in enumerate(index._aids.tolist())}
+        index._base_size = index._size
+
+        # changes saved since the .npy files were written, replayed in order
+        for segment in meta.get('segments', []):
+            with np.load(os.path.join(folder, segment)) as delta:
+                for i, kind in enumerate(delta['kinds']):
+                    if kind == 'add':
+                        index._add(
+                            delta['%d_aids' % i].tolist(),
+                            delta['%d_embs' % i],
+                            delta['%d_rowids' % i].tolist(),
+                        )
+                    else:
+                        index._remove(delta['%d_aids' % i].tolist())
+        if 'digest' in meta:
+            # the digest of the metadata already includes the segments
+            index._digest = int(meta['digest'], 16)
+        index._ops = []
+        index._segments = list(meta.get('segments', []))
+        index._delta_size = meta.get('delta_size', 0)
+        return index
+
+    def save(self, folder=None):
+        """Save the changes since the last save as a delta segment, or the whole index
+        as .npy files when there is no saved index to build on or the segments grew past
+        COMPACT_FRACTION of it. The metadata is written last, so a reader never opens a
+        partially saved index.
+        Saves are serialised by a lock file in the folder. When another writer saved
+        since this index was loaded, its changes are read back first and the changes of
+        this index are replayed on top of them, so no writer loses the others' changes.
+        """
+        if folder is not None and folder != self.folder:
+            # a copy in a new folder: nothing to build on
+            self.folder = folder
+            self._segments = []
+            self._base_size = 0
+            self._delta_size = 0
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+
+        with _locked(self.folder, exclusive=True):
+            meta = _read_meta(self.folder)
+            if meta is not None and meta['version'] != self.version:
+                self._rebase()
+            self.version = (0 if meta is None else meta['version']) + 1
+
+            delta_size = self._delta_size + sum(len(op[1]) for op in self._ops)
+            if meta is not None and self._base_size > 0:
+                if delta_size <= COMPACT_FRACTION * self._base_size:
+                    self._save_delta(delta_size)
+                    return
+            self._save_full()
+            # only the segments merged into this save, as listed by the metadata
+            if meta is not None:
+                for segment in meta.get('segments', []):
+                    segment_fpath = os.path.join(self.folder, segment)
+                    if os.path.exists(segment_fpath):
+                        os.remove(segment_fpath)
+
+    def _rebase(self):
+        """Replace the state of the index by the one saved in its folder, with the
+        changes since the last save of this index replayed on top."""
+        ops = self._ops
+        saved = type(self)._load(self.folder)
+        for op in ops:
+            if op[0] == 'add':
+                saved._add(op[1], op[2], op[3])
+            else:
+                saved._remove(op[1])
+        self.__dict__.update(saved.__dict__)
+        self._ops = ops
+
+    def _save_full(self):
+        """Write the whole index as .npy files, without delta segments."""
+        save_npy_atomic(os.path.join(self.folder, EMB_FNAME), self.embeddings)
+        save_npy_atomic(os.path.join(self.folder, AIDS_FNAME), self.aids)
+        save_npy_atomic(os.path.join(self.folder, ROWIDS_FNAME), self.rowids)
+        save_npy_atomic(
+            os.path.join(self.folder, HASHES_FNAME), self._hashes[: self._size]
+        )
+        _write_meta(
+            self.folder,
+            {
+                'version': self.version,
+                'size': self._size,
+                'emb_size': self.emb_size,
+                'digest': '%016x' % self._digest,
+            },
+        )
+        self._ops = []
+        self._segments = []
+        self._base_size = self._size
+        self._delta_size = 0
+
+    def _save_delta(self, delta_size):
+        """Append the changes since the last save as a new delta segment."""
+        if len(self._ops) > 0:
+            arrays = {'kinds': np.array([op[0] for op in self._ops])}
+            for i, op in enumerate(self._ops):
+                arrays['%d_aids' % i] = np.asarray(op[1], dtype=np.int64)
+                if op[0] == 'add':
+                    arrays['%d_embs' % i] = op[2]
+                    arrays['%d_rowids' % i] = np.asarray(op[3], dtype=np.int64)
+            segment = DELTA_FNAME.format(uuid.uuid4().hex)
+            segment_fpath = os.path.join(self.folder, segment)
+            tmp_fpath = '{}.{}.tmp.npz'.format(segment_fpath, os.getpid())
+            np.savez(tmp_fpath, **arrays)
+            os.replace(tmp_fpath, segment_fpath)
+            self._segments.append(segment)
+
+        _write_meta(
+            self.folder,
+            {
+                'version': self.version,
+                'size': self._size,
+                'emb_size': self.emb_size,
+                'digest': '%016x' % self._digest,
+                'segments': self._segments,
+                'delta_size': delta_size,
+            },
+        )
+        self._ops = []
+        self._delta_size = delta_size
+
+    def saved_version(self):
+        """Version of the index saved in self.folder, or None if it was never saved."""
+        meta = _read_meta(self.folder)
+        return None if meta is None else meta['version']
+
+    def _reserve(self, num_new):
+        """Make room for num_new rows, growing the buffers geometrically.
+        A memory-mapped (read-only) matrix is copied into memory here.
+        """
+        needed = self._size + num_new
+        if needed <= len(self._emb) and self._emb.flags.writeable:
+            return
+        capacity = max(needed, 2 * len(self._emb), 1024)
+        for name in ('_emb', '_sq_norms', '_aids', '_rowids', '_hashes'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self._size] = old[: self._size]
+            setattr(self, name, new)
+
+    def add(self, aids, embs, rowids=None):
+        """Add embeddings of aids to the index. Aids already in the index are replaced.
+        Input:
+        aids: list of integers
+        embs: 2D float array (len(aids), emb_size)
+        rowids: list of integers or None, depc rowids the embeddings were read from
+        """
+        embs = np.asarray(embs, dtype=np.float32).reshape(len(aids), -1)
+        if rowids is None:
+            rowids = [-1] * len(aids)
+        self._add(aids, embs, rowids)
+        self._ops.append(('add', list(aids), embs, list(rowids)))
+
+    def _add(self, aids, embs, rowids):
+        if self.emb_size is None:
+            self.emb_size = embs.shape[1]
+            self._emb = np.zeros((0, self.emb_size), dtype=np.float32)
+        assert embs.shape[1] == self.emb_size, 'Embedding size %d != %d' % (
+            embs.shape[1],
+            self.emb_size,
+        )
+
+        self._remove([aid for aid in aids if aid in self._aid_to_row])
+        self._reserve(len(aids))
+        start, stop = self._size, self._size + len(aids)
+        self._emb[start:stop] = embs
+        self._sq_norms[start:stop] = _squared_norms(embs)
+        self._aids[start:stop] = aids
+        self._rowids[start:stop] = rowids
+        for row, aid in enumerate(aids, start):
+            self._aid_to_row[aid] = row
+            entry_hash = _entry_hash(aid, self._emb[row])
+            self._hashes[row] = entry_hash
+            self._digest ^= entry_hash
+        self._size = stop
+
+    def remove(self, aids):
+        """Remove aids from the index. Aids not in the index are ignored."""
+        aids = [aid for aid in aids if aid in self._aid_to_row]
+        if len(aids) == 0:
+            return
+        self._remove(aids)
+        self._ops.append(('remove', aids))
+
+    def _remove(self, aids):
+        aids = [aid for aid in aids if aid in self._aid_to_row]
+        if len(aids) == 0:
+            return
+        self._reserve(0)
+        for aid in aids:
+            row = self._aid_to_row.pop(aid)
+            self._digest ^= int(self._hashes[row])
+            last = self._size - 1
+            if row != last:
+                # move the last row into the hole
+                self._emb[row] = self._emb[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._aids[row] = self._aids[last]
+                self._rowids[row] = self._rowids[last]
+                self._hashes[row] = self._hashes[last]
+                self._aid_to_row[int(self._aids[row])] = row
+            self._size = last
+
+    def digest(self, aids=None):
+        """Content digest of the index, or of the entries of aids, as a hex string.
+        The digest does not depend on the order of entries. It is maintained for the
+        whole index (O(1)), and costs one XOR per aid for a subset (no hashing).
+        Raises KeyError for aids not in the index.
+        """
+        if aids is None:
+            digest = self._digest
+        else:
+            digest = int(np.bitwise_xor.reduce(self._hashes[self.rows(aids)]))
+        return '%016x' % digest
+
+    def stale(self, aids, rowids):
+        """Aids that are not in the index or were added from another depc rowid."""
+        stale_aids = []
+        for aid, rowid in zip(aids, rowids):
+            row = self._aid_to_row.get(aid)
+            if row is None or self._rowids[row] != rowid:
+                stale_aids.append(aid)
+        return stale_aids
+
+    def rows(self, aids):
+        """Rows of the index for aids. Raises KeyError for aids not in the index."""
+        return np.array([self._aid_to_row[aid] for aid in aids], dtype=np.int64)
+
+    def kneighbors_rows(self, query_embs, k, rows=None):
+        """Exact k nearest rows of the index (or of a subset of rows) for each query.
+        Distances are computed as in sklearn euclidean_distances, in float64.
+        Input:
+        query_embs: 2D float array (num_queries, emb_size)
+        k: integer, number of neighbours
+        rows: 1D integer array or None, restrict the search to these rows
+        Returns:
+        dists - 2D float array (num_queries, k), ascending
+        ind - 2D int array (num_queries, k), rows of the index,
+              or positions in rows if rows is provided
+        """
+        num_rows = self._size if rows is None else len(rows)
+        return block_kneighbors(query_embs, self._emb, self._sq_norms, k, num_rows, rows)
+
+    def query(self, query_embs, k):
+        """k nearest aids of the whole index for each query embedding.
+        Returns:
+        dists - 2D float array (num_queries, k)
+        aids - 2D int array (num_queries, k)
+        """
+        dists, rows = self.kneighbors_rows(query_embs, k)
+        return dists, self._aids[rows]
+
+    def view(self, aids):
+        """Nearest neighbour search restricted to aids, see IndexView."""
+        return IndexView(self, aids)
+
+
+class IndexView(object):
+    """A subset of a NeighborIndex with the kneighbors interface of sklearn
+    NearestNeighbors: indices refer to positions in the aids list of the view,
+    so a view can be used in place of a classifier fitted on the embeddings of aids.
+    """
+
+    def __init__(self, index, aids):
+        self.index = index
+        self.aids = list(aids)
+        rows = index.rows(self.aids)
+        if len(rows) == len(index) and np.array_equal(rows, np.arange(len(index))):
+            # the view is the whole index in order: no need to gather rows
+            rows = None
+        self._rows = rows
+
+    def __len__(self):
+        return len(self.aids)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        if n_neighbors is None:
+            n_neighbors = min(50, len(self.aids))
+        dists, positions = self.index.kneighbors_rows(X, n_neighbors, rows=self._rows)
+        if return_distance:
+            return dists, positions
+        return positions
+
+
+class NameIndex(object):
+    """Name-level index over labelled embeddings.
+    Every name is represented by the centroid of its embeddings and up to n_exemplars
+    of its embeddings, chosen by farthest point sampling from the one closest to the
+    centroid, so names seen under varied conditions keep a representative of each.
+    A query searches the representatives to shortlist names, then re-ranks the
+    shortlisted names exactly: the distance of a name is the distance to its closest
+    embedding, as in annotation-level search followed by duplicate removal.
+    """
+
+    def __init__(self, embs, labels, n_exemplars=3, shortlist_factor=4):
+        self.embs = np.asarray(embs, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.n_exemplars = n_exemplars
+        self.shortlist_factor = shortlist_factor
+        self.sq_norms = _squared_norms(self.embs)
+
+        self.names, codes = np.unique(self.labels, return_inverse=True)
+        # rows of embs grouped name by name: the rows of name i are
+        # self.member_rows[self.starts[i]:self.starts[i + 1]]
+        self.member_rows = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(self.names))
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+
+        centroids = (
+            np.add.reduceat(
+                self.embs[self.member_rows].astype(np.float64), self.starts[:-1], axis=0
+            )
+            / counts[:, None]
+        )
+        rep_embs = [centroids]
+        rep_codes = [np.arange(len(self.names))]
+        for code in np.nonzero(counts > 1)[0]:
+            rows = self.member_rows[self.starts[code] : self.starts[code + 1]]
+            exemplars = _farthest_points(self.embs[rows], centroids[code], n_exemplars)
+            rep_embs.append(self.embs[rows[exemplars]])
+            rep_codes.append(np.full(len(exemplars), code))
+        self.rep_embs = np.concatenate(rep_embs, axis=0).astype(np.float32)
+        self.rep_codes = np.concatenate(rep_codes)
+        self.rep_sq_norms = _squared_norms(self.rep_embs)
+
+    def __len__(self):
+        return len(self.embs)
+
+    def shortlist(self, query_embs, num_names):
+        """Codes of the num_names names with the closest representatives, per query."""
+        reps_per_name = self.n_exemplars + 1
+        _, rep_ind = block_kneighbors(
+            query_embs, self.rep_embs, self.rep_sq_norms, num_names * reps_per_name
+        )
+        shortlists = []
+        for codes in self.rep_codes[rep_ind]:
+            _, first = np.unique(codes, return_index=True)
+            shortlists.append(codes[np.sort(first)][:num_names])
+        return shortlists
+
+    def kneighbors_names(self, query_embs, k):
+        """Top-k names for each query embedding.
+        Input:
+        query_embs: 2D float array (num_queries, emb_size)
+        k: integer, number of names
+        Returns:
+        neigh_lbl_un, neigh_ind_un, neigh_dist_un as in predict_k_neigh: per query the
+        names, the row in embs of their closest embedding and its distance, closest first
+        """
+        query_embs = np.asarray(query_embs, dtype=np.float64)
+        num_names = min(len(self.names), max(k, self.shortlist_factor * k))
+        neigh_lbl_un, neigh_ind_un, neigh_dist_un = [], [], []
+        for query_emb, codes in zip(query_embs, self.shortlist(query_embs, num_names)):
+            # exact distances to every embedding of the shortlisted names
+            groups = [
+                self.member_rows[self.starts[code] : self.starts[code + 1]]
+                for code in codes
+            ]
+            rows = np.concatenate(groups)
+            d2 = self.sq_norms[rows] - 2 * np.dot(
+                self.embs[rows].astype(np.float64), query_emb
+            )
+            d2 += np.dot(query_emb, query_emb)
+            dists = np.sqrt(np.maximum(d2, 0))
+
+            # closest embedding of each name
+            group_starts = np.concatenate([[0], np.cumsum([len(g) for g in groups])[:-1]])
+            name_dists = np.minimum.reduceat(dists, group_starts)
+            closest = [
+                start + np.argmin(dists[start : start + len(group)])
+                for start, group in zip(group_starts, groups)
+            ]
+            order = np.argsort(name_dists, kind='stable')[:k]
+            neigh_lbl_un.append(list(self.names[codes[order]]))
+            neigh_ind_un.append(rows[np.array(closest)[order]].tolist())
+            neigh_dist_un.append(name_dists[order].tolist())
+        return neigh_lbl_un, neigh_ind_un, neigh_dist_un
+
+
+def _farthest_points(embs, start_emb, num_points):
+    """Indices of num_points rows of embs: the closest to start_emb, then repeatedly
+    the row farthest from those already chosen."""
+    num_points = min(num_points, len(embs))
+    embs = embs.astype(np.float64)
+    min_d2 = np.sum((embs - start_emb) ** 2, axis=1)
+    chosen = [int(np.argmin(min_d2))]
+    min_d2 = np.sum((embs - embs[chosen[0]]) ** 2, axis=1)
+    while len(chosen) < num_points:
+        chosen.append(int(np.argmax(min_d2)))
+        min_d2 = np.minimum(min_d2, np.sum((embs - embs[chosen[-1]]) ** 2, axis=1))
+    return np.array(chosen)
+
+
+def block_kneighbors(query_embs, emb, sq_norms, k, num_rows=None, rows=None):
+    """Exact k nearest rows of emb for each query, computed block by block so the
+    distance matrix never holds more than QUERY_BLOCK_SIZE rows.
+    Input:
+    query_embs: 2D float array (num_queries, emb_size)
+    emb: 2D float array, searched embeddings
+    sq_norms: 1D float64 array, squared norms of the rows of emb
+    k: integer, number of neighbours
+    num_rows: integer or None, search the first num_rows rows of emb. Default: all
+    rows: 1D integer array or None, search these rows of emb instead
+    Returns:
+    dists - 2D float array (num_queries, k), ascending
+    ind - 2D int array (num_queries, k), rows of emb, or positions in rows if provided
+    """
+    query_embs = np.asarray(query_embs, dtype=np.float64)
+    query_sq_norms = _squared_norms(query_embs)
+    if rows is not None:
+        num_rows = len(rows)
+    elif num_rows is None:
+        num_rows = len(emb)
+    k = min(k, num_rows)
+
+    best_d2 = np.full((len(query_embs), 0), np.inf)
+    best_ind = np.zeros((len(query_embs), 0), dtype=np.int64)
+    for start in range(0, num_rows, QUERY_BLOCK_SIZE):
+        stop = min(start + QUERY_BLOCK_SIZE, num_rows)
+        block_ind = np.arange(start, stop)
+        block_rows = block_ind if rows is None else rows[start:stop]
+        block = emb[block_rows]
+        d2 = np.dot(query_embs, block.astype(np.float64).T)
+        d2 *= -2
+        d2 += query_sq_norms[:, None]
+        d2 += sq_norms[block_rows][None, :]
+        np.maximum(d2, 0, out=d2)
+
+        # merge the block with the best rows so far, keep the k smallest
+        cand_d2 = np.concatenate([best_d2, d2], axis=1)
+        cand_ind = np.concatenate(
+            [best_ind, np.broadcast_to(block_ind, d2.shape)], axis=1
+        )
+        if cand_d2.shape[1] > k:
+            keep = np.argpartition(cand_d2, k - 1, axis=1)[:, :k]
+            cand_d2 = np.take_along_axis(cand_d2, keep, axis=1)
+            cand_ind = np.take_along_axis(cand_ind, keep, axis=1)
+        best_d2, best_ind = cand_d2, cand_ind
+
+    order = np.argsort(best_d2, axis=1, kind='stable')
+    best_d2 = np.take_along_axis(best_d2, order, axis=1)
+    best_ind = np.take_along_axis(best_ind, order, axis=1)
+    return np.sqrt(best_d2), best_ind
+
+
+@contextlib.contextmanager
+def _locked(folder, exclusive):
+    """Lock file of an index folder: shared to load, exclusive to save."""
+    with open(os.path.join(folder, LOCK_FNAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_meta(folder):
+    meta_fpath = os.path.join(folder, META_FNAME)
+    if not os.path.exists(meta_fpath):
+        return None
+    with open(meta_fpath) as meta_file:
+        return json.load(meta_file)
+
+
+def _write_meta(folder, meta):
+    meta_fpath = os.path.join(folder, META_FNAME)
+    tmp_fpath = '{}.{}.tmp'.format(meta_fpath, os.getpid())
+    with open(tmp_fpath, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_fpath, meta_fpath)
+
+
+def _entry_hash(aid, emb):
+    """64-bit hash of an aid and its embedding."""
+    hasher = hashlib.sha1(str(int(aid)).encode('utf-8'))
+    hasher.update(np.ascontiguousarray(emb, dtype=np.float32).tobytes())
+    return int.from_bytes(hasher.digest()[:8], 'little')
+
+
+def _squared_norms(embs):
+    """Squared norms in float64, converted QUERY_BLOCK_SIZE rows at a time so a
+    memory-mapped matrix is never copied whole."""
+    embs = np.asarray(embs)
+    sq_norms = np.zeros((len(embs),), dtype=np.float64)
+    for start in range(0, len(embs), QUERY_BLOCK_SIZE):
+        block = embs[start : start + QUERY_BLOCK_SIZE].astype(np.float64)
+        sq_norms[start : start + len(block)] = np.einsum('ij,ij->i', block, block)
+    return sq_norms
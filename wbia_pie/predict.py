@@ -22,7 +22,7 @@ FUNCTIONALITY:
         b) query image is cropped by a provided line
         c) query image is resized to the size specified in the config
     2) Embeddings for the query image are computed.
-    3) Embeddings for the database images are read from csv files.
+    3) Embeddings for the database images are memory-mapped from the embeddings folder.
     4) Matching individuals are returned.
 
 ===============================================================================
@@ -33,13 +33,13 @@ import json
 import numpy as np
 from imageio import imread
 import matplotlib.pyplot as plt
-from glob import glob
 
 # import utool as ut
 
 from .utils.drawer import MaskDrawer
-from .model.triplet import TripletLoss
-from .utils.utils import export_emb, print_nested, str2bool
+from .registry import get_model
+from .utils.utils import print_nested, str2bool
+from .utils.emb_store import save_emb_store, open_db_embeddings, db_matrix_key
 from .utils.preprocessing import crop_im_by_mask, resize_imgs, convert_to_fmt
 from .evaluation.evaluate_accuracy import predict_k_neigh
 
@@ -170,40 +170,17 @@ def predict(
 
     # Prediction step
     print('Loading model...')
-    INPUT_SHAPE = (config['model']['input_height'], config['model']['input_width'], 3)
-    model_args = dict(
-        backend=config['model']['backend'],
-        frontend=config['model']['frontend'],
-        input_shape=INPUT_SHAPE,
-        embedding_size=config['model']['embedding_size'],
-        connect_layer=config['model']['connect_layer'],
-        train_from_layer=config['model']['train_from_layer'],
-        loss_func=config['model']['loss'],
-        weights=None,
-    )
-
-    mymodel = TripletLoss(**model_args)
-
-    # db: added plugin_folder below
-    exp_folder = os.path.join(
-        plugin_folder, config['train']['exp_dir'], config['train']['exp_id']
-    )
-    saved_weights = os.path.join(exp_folder, 'best_weights.h5')
-
-    print('Loading saved weights in ', saved_weights)
-    if os.path.exists(saved_weights):
-        mymodel.load_weights(saved_weights)
-    else:
-        raise ('ERROR! No pre-trained weights are found in ', saved_weights)
+    # Models are built and loaded once per process, see registry.py
+    mymodel = get_model(config_path, config)
 
     # compute embedding for the image
     image = imread(resizedpath)
     embedding = mymodel.preproc_predict(np.expand_dims(image, 0))
 
-    print('Exporting computed embedding to csv files...')
+    print('Exporting computed embedding...')
     folder = os.path.join(output_dir, 'query-embeddings')
     emb_prefix = os.path.splitext(os.path.basename(img_path))[0]
-    export_emb(
+    save_emb_store(
         embedding,
         info=[[img_path], [img_path], [img_path]],
         folder=folder,
@@ -211,35 +188,13 @@ def predict(
         info_header=['label,filename,name'],
     )
 
-    db_embs = []
-    db_lbls = []
-    db_info = []
-
-    # Read embeddings and info from a list of provided csv files
-    emb_list = glob(saved_emb + '/*')
-
-    for i, file in enumerate(emb_list):
-        if '_emb.csv' in file:
-            print('Reading embeddings from file {}'.format(file))
-            read_embs = np.genfromtxt(file, delimiter=',', skip_header=1)
-            if len(read_embs.shape) == 1:
-                read_embs = np.expand_dims(read_embs, 0)
-            db_embs.append(read_embs)
-
-            lab_file = file[: -(len('_emb.csv'))] + '_lbl.csv'
-            print('Reading corresponding labels from file {}'.format(lab_file))
-            read_info = np.genfromtxt(lab_file, dtype=str, delimiter=',', skip_header=1)
-            if len(read_info.shape) == 1:
-                read_info = np.expand_dims(read_info, 0)
-            db_lbls.append(read_info[:, 0])
-            db_info.append(read_info[:, 1:])
+    # Memory-map the database matrix consolidated from the stores in the embeddings folder
+    db_embs, read_info = open_db_embeddings(saved_emb)
+    db_lbls = read_info[:, 0]
+    db_info = read_info[:, 1:]
 
     # Might want to do a ut.embed here to double check the size/shape of db_embs and db_lbls
 
-    # Concatenate together
-    db_embs = np.concatenate(db_embs, axis=0)
-    db_lbls = np.concatenate(db_lbls, axis=0)
-    db_info = np.concatenate(db_info, axis=0)
     # print(db_embs.shape, db_lbls.shape, db_info.shape)
 
     # import utool as ut
@@ -252,6 +207,7 @@ def predict(
         embedding,
         k=10,
         nearest_neighbors_cache_path=nearest_neighbors_cache_path,
+        cache_key=db_matrix_key(saved_emb),
     )
 
     # print(neigh_lbl_un, neigh_ind_un, neigh_dist_un)
@@ -349,23 +305,74 @@ def pred_light(
     config_path,
     n_results=10,
     nearest_neighbors_cache_path=None,
+    nn_classifier=None,
+    cache_key=None,
+    adaptive=False,
+    max_depth=None,
 ):
-    # Fit nearest neighbours classifier
-    neigh_lbl_un, neigh_ind_un, neigh_dist_un = predict_k_neigh(
+    ans_dict = pred_light_batch(
+        query_embedding,
         db_embeddings,
         db_labels,
-        query_embedding,
-        k=n_results,
+        config_path,
+        n_results=n_results,
         nearest_neighbors_cache_path=nearest_neighbors_cache_path,
-    )
+        nn_classifier=nn_classifier,
+        cache_key=cache_key,
+        adaptive=adaptive,
+        max_depth=max_depth,
+    )[0]
+    return ans_dict
 
-    neigh_lbl_un = neigh_lbl_un[0]
-    neigh_dist_un = neigh_dist_un[0]
 
-    ans_dict = [
-        {'label': lbl, 'distance': dist} for lbl, dist in zip(neigh_lbl_un, neigh_dist_un)
+def pred_light_batch(
+    query_embeddings,
+    db_embeddings,
+    db_labels,
+    config_path,
+    n_results=10,
+    nearest_neighbors_cache_path=None,
+    nn_classifier=None,
+    cache_key=None,
+    adaptive=False,
+    name_index=None,
+    max_depth=None,
+):
+    """Match many query embeddings against the same database in a single kNN search.
+    Input:
+    query_embeddings: 2D float array (num_queries, emb_size)
+    db_embeddings, db_labels: database embeddings and their labels
+    adaptive: boolean, search deeper until n_results distinct labels are found,
+              see evaluate_accuracy.adaptive_k_neigh
+    max_depth: integer or None, bound on the number of points searched in adaptive mode
+    name_index: None or NameIndex of the database, to search names directly instead
+                of every embedding (see neighbors.py)
+    Returns:
+    list of num_queries lists of {'label': ___, 'distance': ___} dicts, closest first
+    """
+    if name_index is not None:
+        neigh_lbl_un, neigh_ind_un, neigh_dist_un = name_index.kneighbors_names(
+            query_embeddings, n_results
+        )
+    else:
+        # Fit nearest neighbours classifier, unless a prebuilt index is given
+        neigh_lbl_un, neigh_ind_un, neigh_dist_un = predict_k_neigh(
+            db_embeddings,
+            db_labels,
+            query_embeddings,
+            k=n_results,
+            nearest_neighbors_cache_path=nearest_neighbors_cache_path,
+            nn_classifier=nn_classifier,
+            cache_key=cache_key,
+            adaptive=adaptive,
+            max_depth=max_depth,
+        )
+
+    ans_dicts = [
+        [{'label': lbl, 'distance': dist} for lbl, dist in zip(lbls, dists)]
+        for lbls, dists in zip(neigh_lbl_un, neigh_dist_un)
     ]
-    return ans_dict
+    return ans_dicts
 
 
 if __name__ == '__main__':
@@ -12,6 +12,10 @@ USAGE:
     with all optional parametres:
     python prepare_db.py -i <image_path/image_dir> -d <yes/no> -c <path_config>
                          -o <path_output_folder>   -l <path_to_csv>
+                         -e <thread/process> -w <num_workers>
+
+    to compare throughput of thread and process workers on a folder of images:
+    python prepare_db.py -i <image_dir> -c <path_config> -b
 
 FUNCTIONALITY:
     1) Interactive drawing tool to highligh the region of interest in the image.
@@ -32,6 +36,10 @@ PARAMETERS:
            Preconfigured files: configs/manta.json for manta rays, configs/whale.json for whales.
     -o     path to save processed files. Default is in config.prod.output
     -l     path to a csv files with a list of files and corresponding labels. Default is in config.prod.lfile.
+    -e     thread/process, run workers in threads or in processes. Default: thread.
+           Ignored with the drawing tool, which processes images one at a time.
+    -w     number of workers. Default: number of CPUs (processes) or Python's default (threads)
+    -b     benchmark thread and process workers instead of processing images
 
 README:
     If drawing tool is activated, draw a line around a pattern of interest.
@@ -51,8 +59,11 @@ import numpy as np
 import os
 import argparse
 import json
+import shutil
+import tempfile
+import time
 
-from .utils.preprocessing import crop_im_by_mask, resize_imgs, convert_to_fmt
+from .utils.preprocessing import crop_im_by_mask, resize_to_png
 from .utils.drawer import MaskDrawer
 from .utils.utils import str2bool
 import concurrent.futures
@@ -94,6 +105,22 @@ argparser.add_argument(
     default=0,
     help='Index (number) of file to resume the process. Zero based. Useful for large folders',
 )
+argparser.add_argument(
+    '-e',
+    '--executor',
+    choices=['thread', 'process'],
+    default='thread',
+    help='Run workers in threads or in processes. Default: thread',
+)
+argparser.add_argument(
+    '-w', '--workers', type=int, help='Number of workers. Default: number of CPUs'
+)
+argparser.add_argument(
+    '-b',
+    '--benchmark',
+    action='store_true',
+    help='Compare throughput of thread and process workers on the images',
+)
 
 
 def preproc_worker(arguments):
@@ -133,15 +160,36 @@ def preproc_worker(arguments):
     else:
         proc_count += 1
         croppedpath = file
-    # Resize to the size and convert to png format
-    resizedpath = resize_imgs(croppedpath, output_dir, size)
-    resizedpath = convert_to_fmt(resizedpath, imformat='png')
+    # Resize to the size and convert to png format in one step
+    resize_to_png(croppedpath, output_dir, size)
     # print('Processed {} images'.format(proc_count))
 
     return proc_count
 
 
-def preproc(impath, config_path, lfile=None, draw=None, output=None, start_index=0):
+def preproc(
+    impath,
+    config_path,
+    lfile=None,
+    draw=None,
+    output=None,
+    start_index=0,
+    executor='thread',
+    n_workers=None,
+    chunksize=None,
+):
+    """Preprocess images (see the module docstring) into a folder of images for PIE.
+    Input:
+    executor: 'thread' or 'process', run preproc_worker in a pool of threads or of
+              processes. Decoding, resizing and encoding partly hold the GIL, processes
+              scale with the number of CPUs. Images are processed one at a time in this
+              thread when draw is set, as the drawing tool is interactive.
+    n_workers: integer or None, size of the pool. Default: see concurrent.futures
+    chunksize: integer or None, number of images sent to a worker process at once.
+               Default: about 4 chunks per process
+    Returns:
+    path to the folder of preprocessed images
+    """
 
     if not os.path.exists(impath):
         raise ValueError('Image file/folder "%s" does not exist. Check input.' % impath)
@@ -229,13 +277,32 @@ def preproc(impath, config_path, lfile=None, draw=None, output=None, start_index
             [output_dir] * num_files,
         )
     )
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        proc_count_list = list(
-            tqdm.tqdm(
-                executor.map(preproc_worker, arguments_list),
-                total=len(arguments_list),
+    if draw:
+        # the drawing tool is interactive: one image at a time, in this thread
+        proc_count_list = [
+            preproc_worker(arguments) for arguments in tqdm.tqdm(arguments_list)
+        ]
+    elif executor == 'process':
+        if chunksize is None:
+            num_chunks = 4 * (n_workers or os.cpu_count() or 1)
+            chunksize = max(1, num_files // num_chunks)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            proc_count_list = list(
+                tqdm.tqdm(
+                    pool.map(preproc_worker, arguments_list, chunksize=chunksize),
+                    total=len(arguments_list),
+                )
             )
-        )
+    elif executor == 'thread':
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            proc_count_list = list(
+                tqdm.tqdm(
+                    pool.map(preproc_worker, arguments_list),
+                    total=len(arguments_list),
+                )
+            )
+    else:
+        raise ValueError('Unknown executor "%s"' % executor)
     proc_count = sum(proc_count_list)
 
     print('Total processed {} images'.format(proc_count))
@@ -263,8 +330,52 @@ def preproc(impath, config_path, lfile=None, draw=None, output=None, start_index
     return output_dir
 
 
+def benchmark_preproc(impath, config_path, n_workers=None, lfile=''):
+    """Time preproc of a folder of images with thread and with process workers.
+    Outputs are written to temporary folders, deleted afterwards.
+    Returns:
+    dict with the number of images per second of each executor
+    """
+    num_files = len(
+        [f for f in os.listdir(impath) if os.path.isfile(os.path.join(impath, f))]
+    )
+    throughput = {}
+    for executor in ('thread', 'process'):
+        output = tempfile.mkdtemp(prefix='pie-preproc-')
+        try:
+            start = time.time()
+            preproc(
+                impath,
+                config_path,
+                lfile=lfile,
+                draw=False,
+                output=output,
+                executor=executor,
+                n_workers=n_workers,
+            )
+            throughput[executor] = num_files / (time.time() - start)
+        finally:
+            shutil.rmtree(output)
+
+    for executor, imgs_per_sec in throughput.items():
+        print('{:8s} {:8.1f} images/s'.format(executor, imgs_per_sec))
+    return throughput
+
+
 if __name__ == '__main__':
     print(__doc__)
     # Get arguments
     args = argparser.parse_args()
-    preproc(args.impath, args.conf, args.draw, args.output, args.lfile, args.start_index)
+    if args.benchmark:
+        benchmark_preproc(args.impath, args.conf, args.workers)
+    else:
+        preproc(
+            args.impath,
+            args.conf,
+            lfile=args.lfile,
+            draw=args.draw,
+            output=args.output,
+            start_index=args.start_index,
+            executor=args.executor,
+            n_workers=args.workers,
+        )
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Process-wide registry of loaded PIE models.
+
+Building a TripletLoss model creates the whole Keras graph and loading
+best_weights.h5 reads every layer from disk, which dominates the latency of
+small embedding requests. The registry keeps warm models resident, keyed by
+the config file and the signature (path, mtime, size) of the weight file, so
+a retrained model is picked up automatically. The least recently used model
+is dropped once more than MAX_RESIDENT_MODELS are loaded.
+
+USAGE:
+    from wbia_pie.registry import get_model
+    mymodel = get_model(config_path)
+    embeddings = mymodel.preproc_predict(imgs)
+===============================================================================
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+
+from .model.triplet import TripletLoss
+
+_PLUGIN_FOLDER = os.path.dirname(os.path.realpath(__file__))
+
+# enough for every species config (manta, whale, rw-v18, orca, orca saddle, gw-rc)
+MAX_RESIDENT_MODELS = int(os.environ.get('PIE_MAX_RESIDENT_MODELS', 6))
+
+_MODELS = OrderedDict()
+_MODELS_LOCK = threading.RLock()
+
+
+def read_config(config_path):
+    with open(config_path) as config_buffer:
+        config = json.loads(config_buffer.read())
+    return config
+
+
+def model_args_from_config(config, weights=None):
+    """Keyword arguments for TripletLoss as parameterized by a PIE config.
+    weights: None or 'imagenet'. Resident models load all layers from best_weights.h5,
+             so the ImageNet initialisation is skipped by default.
+    """
+    INPUT_SHAPE = (config['model']['input_height'], config['model']['input_width'], 3)
+    model_args = dict(
+        backend=config['model']['backend'],
+        frontend=config['model']['frontend'],
+        input_shape=INPUT_SHAPE,
+        embedding_size=config['model']['embedding_size'],
+        connect_layer=config['model']['connect_layer'],
+        train_from_layer=config['model']['train_from_layer'],
+        loss_func=config['model']['loss'],
+        weights=weights,
+        optimizer=config['model'].get('optimizer', 'adam'),
+        use_dropout=config['model'].get('use_dropout', False),
+        augmentation=config['model'].get('augmentation', 'keras'),
+        show_summary=False,
+    )
+    return model_args
+
+
+def saved_weights_path(config):
+    """Location of best_weights.h5 for a config, relative to the plugin folder."""
+    exp_folder = os.path.join(
+        _PLUGIN_FOLDER, config['train']['exp_dir'], config['train']['exp_id']
+    )
+    return os.path.join(exp_folder, 'best_weights.h5')
+
+
+def _model_key(config, config_path, weights_path):
+    stat = os.stat(weights_path)
+    if config_path is not None:
+        config_key = os.path.realpath(config_path)
+    else:
+        # configs passed as dicts (eg. from pie_predict_prepare_config) share a model
+        # whenever their model section is the same
+        config_key = json.dumps(config['model'], sort_keys=True)
+    return (config_key, weights_path, stat.st_mtime_ns, stat.st_size)
+
+
+def get_model(config_path=None, config=None):
+    """Return a TripletLoss model with trained weights loaded, building it only on first use.
+    Input:
+    config_path: string, path to a PIE config .json file
+    config: dict, already parsed config. Takes precedence over config_path for the model
+            parameters; config_path is still used as the registry key when provided.
+    Returns:
+    TripletLoss instance shared by every caller in this process
+    """
+    if config is None:
+        config = read_config(config_path)
+
+    if config['model']['type'] != 'TripletLoss':
+        raise Exception('Only TripletLoss model type is supported')
+
+    weights_path = saved_weights_path(config)
+    if not os.path.exists(weights_path):
+        raise IOError('No pre-trained weights are found in {}'.format(weights_path))
+
+    key = _model_key(config, config_path, weights_path)
+    with _MODELS_LOCK:
+        if key in _MODELS:
+            _MODELS.move_to_end(key)
+            return _MODELS[key]
+
+        # Weights file changed on disk: drop the stale model for this config
+        for stale_key in [k for k in _MODELS if k[0] == key[0]]:
+            print('[pie] Weights changed, unloading model for {}'.format(stale_key[0]))
+            del _MODELS[stale_key]
+
+        print('[pie] Building model for {}'.format(key[0]))
+        mymodel = TripletLoss(**model_args_from_config(config))
+        print('[pie] Loading saved weights in {}'.format(weights_path))
+        mymodel.load_weights(weights_path)
+        # server threads predict in the graph and session the model was loaded in
+        mymodel.capture_graph()
+
+        _MODELS[key] = mymodel
+        while len(_MODELS) > max(1, MAX_RESIDENT_MODELS):
+            evicted_key, _ = _MODELS.popitem(last=False)
+            print('[pie] Evicting least recently used model {}'.format(evicted_key[0]))
+    return mymodel
+
+
+def warmup(config_path_list):
+    """Load models for a list of configs so the first request does not pay for it."""
+    return [get_model(config_path) for config_path in config_path_list]
+
+
+def resident_models():
+    """List of (config, weights_path) of currently loaded models, least recently used first."""
+    with _MODELS_LOCK:
+        return [(key[0], key[1]) for key in _MODELS]
+
+
+def clear():
+    """Unload every resident model."""
+    with _MODELS_LOCK:
+        _MODELS.clear()
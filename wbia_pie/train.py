@@ -51,6 +51,7 @@ from .utils.preprocessing import (  # NOQA
     split_classification,  # NOQA
 )
 from .utils.utils import print_nested, save_res_csv  # NOQA
+from .utils.feature_cache import FeatureCache  # NOQA
 from .evaluation.evaluate_accuracy import evaluate_1_vs_all  # NOQA
 
 argparser = argparse.ArgumentParser(
@@ -329,6 +330,39 @@ def train(config, split_num=-1):
     else:
         raise Exception('Define Data Generator for the model type')
 
+    ############################################
+    # Precomputed backbone features
+    ############################################
+    # With a frozen backbone, the head is trained on cached backbone features instead of
+    # running the backbone on every image of every batch (see utils/feature_cache.py)
+    use_features = (
+        config['model'].get('precomp_feat', False)
+        and config['model']['type'] == 'TripletLoss'
+        and mymodel.backbone_frozen()
+    )
+    if config['model'].get('precomp_feat', False) and not use_features:
+        print('precomp_feat is ignored: only for TripletLoss with a frozen backbone')
+
+    if use_features:
+        feature_cache = FeatureCache(
+            os.path.join(
+                plugin_folder, config['model'].get('feature_cache', 'feature_cache')
+            ),
+            mymodel,
+        )
+        print('Backbone features are cached in {}'.format(feature_cache.folder))
+        train_feats = feature_cache.features(train_imgs, config['train']['batch_size'])
+        valid_feats = feature_cache.features(valid_imgs, config['train']['batch_size'])
+        print('Training augmentation is not applied to precomputed features')
+        feat_gen_params = dict(
+            aug_gen=None,
+            p=config['train']['cl_per_batch'],
+            k=config['train']['sampl_per_class'],
+            equal_k=config['train']['equal_k'],
+        )
+        train_generator = BatchGenerator(train_feats, train_labels, **feat_gen_params)
+        valid_generator = BatchGenerator(valid_feats, valid_labels, **feat_gen_params)
+
     # Compute preprocessing time:
     preprocTime = datetime.now() - startTime
     print('Preprocessing time is {}'.format(preprocTime))
@@ -352,7 +386,24 @@ def train(config, split_num=-1):
 
     print('Steps per epoch: {}'.format(steps_per_epoch))
 
-    if warm_up_flag:
+    if warm_up_flag and use_features:
+        print(
+            '-----First training. Warm up epochs to train random weights with higher learning rate--------'
+        )
+        # only the head is trained on features, as in warm_up_train
+        mymodel.train_on_features(
+            train_gen=train_generator,
+            valid_gen=valid_generator,
+            nb_epochs=10,
+            batch_size=config['train']['batch_size'],
+            learning_rate=config['train']['learning_rate'] * 10,
+            steps_per_epoch=steps_per_epoch,
+            distance=config['train']['distance'],
+            saved_weights_name=SAVED_WEIGHTS,
+            logs_file=LOGS_FILE,
+            debug=config['train']['debug'],
+        )
+    elif warm_up_flag:
         print(
             '-----First training. Warm up epochs to train random weights with higher learning rate--------'
         )
@@ -378,7 +429,8 @@ def train(config, split_num=-1):
         # Add weights to balance losses if required
         weights = [1.0, 1.0]
 
-        mymodel.train(
+        train_func = mymodel.train_on_features if use_features else mymodel.train
+        train_func(
             train_gen=train_generator,
             valid_gen=valid_generator,
             nb_epochs=config['train']['log_step'],
@@ -400,12 +452,20 @@ def train(config, split_num=-1):
 
         if config['model']['type'] in ('TripletLoss', 'TripletPose', 'Siamese'):
             print('Evaluating...')
-            train_preds = mymodel.preproc_predict(
-                train_imgs, config['train']['batch_size']
-            )
-            valid_preds = mymodel.preproc_predict(
-                valid_imgs, config['train']['batch_size']
-            )
+            if use_features:
+                train_preds = mymodel.predict_features(
+                    train_feats, config['train']['batch_size']
+                )
+                valid_preds = mymodel.predict_features(
+                    valid_feats, config['train']['batch_size']
+                )
+            else:
+                train_preds = mymodel.preproc_predict(
+                    train_imgs, config['train']['batch_size']
+                )
+                valid_preds = mymodel.preproc_predict(
+                    valid_imgs, config['train']['batch_size']
+                )
 
             print('Shape of computed predictions', train_preds.shape, valid_preds.shape)
 
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Batched test-time augmentation.
+
+Same random transforms as the keras ImageDataGenerator used by BaseModel for test-time
+augmentation (rotation, shifts, shear, zoom and channel shift, reflected borders), with
+the affine matrices of a whole batch drawn as arrays and applied with a single
+vectorised bilinear warp instead of one scipy affine_transform per image and channel.
+
+Transforms are drawn from a RandomState seeded with the augmentation seed, so a batch is
+augmented the same way for a given seed, whatever the global random state and thread.
+They are drawn image by image, so the transform of an image only depends on the seed and
+its position in the batch: a batch can be augmented in parts (see augment_batch's start)
+with the same result.
+"""
+
+import numpy as np
+
+# Parameters of the test-time augmentation, as keyword arguments of ImageDataGenerator
+TTA_PARAMS = dict(
+    rotation_range=30,
+    width_shift_range=0.15,
+    height_shift_range=0.15,
+    shear_range=0.1,
+    zoom_range=0.15,
+    channel_shift_range=0.15,
+)
+
+# Images warped at once, bounds the memory of the sampling coordinates
+WARP_BLOCK_SIZE = 32
+
+
+def random_affine_params(
+    n_imgs,
+    height,
+    width,
+    seed,
+    start=0,
+    rotation_range=30,
+    width_shift_range=0.15,
+    height_shift_range=0.15,
+    shear_range=0.1,
+    zoom_range=0.15,
+    channel_shift_range=0.15,
+):
+    """Draw the random transforms of a batch, with the ranges of ImageDataGenerator.
+    Input:
+    n_imgs, height, width: integers, size of the batch
+    seed: integer, seed of the transforms
+    start: integer, position of the first image in the seeded batch
+    Returns:
+    matrices - float64 array (n_imgs, 3, 3), affine maps from output to input pixel
+               coordinates (row, col, 1)
+    channel_shifts - float64 array (n_imgs,), intensity added to every channel
+    """
+    # one row of draws per image, the same for an image whatever the number of images
+    draws = np.random.RandomState(seed).uniform(size=(start + n_imgs, 7))[start:].T
+
+    def uniform(draw, low, high):
+        return low + (high - low) * draw
+
+    theta = np.deg2rad(uniform(draws[0], -rotation_range, rotation_range))
+    tx = uniform(draws[1], -height_shift_range, height_shift_range) * height
+    ty = uniform(draws[2], -width_shift_range, width_shift_range) * width
+    shear = np.deg2rad(uniform(draws[3], -shear_range, shear_range))
+    zx = uniform(draws[4], 1 - zoom_range, 1 + zoom_range)
+    zy = uniform(draws[5], 1 - zoom_range, 1 + zoom_range)
+    channel_shifts = uniform(draws[6], -channel_shift_range, channel_shift_range)
+
+    # rotation . shift . shear . zoom, as composed by ImageDataGenerator
+    cos, sin = np.cos(theta), np.sin(theta)
+    shear_sin, shear_cos = -np.sin(shear), np.cos(shear)
+    matrices = np.zeros((n_imgs, 3, 3))
+    matrices[:, 0, 0] = cos * zx
+    matrices[:, 0, 1] = (cos * shear_sin - sin * shear_cos) * zy
+    matrices[:, 0, 2] = cos * tx - sin * ty
+    matrices[:, 1, 0] = sin * zx
+    matrices[:, 1, 1] = (sin * shear_sin + cos * shear_cos) * zy
+    matrices[:, 1, 2] = sin * tx + cos * ty
+    matrices[:, 2, 2] = 1.0
+
+    # transforms are centred on the image
+    offset = np.array([[1, 0, height / 2.0 + 0.5], [0, 1, width / 2.0 + 0.5], [0, 0, 1]])
+    reset = np.array([[1, 0, -height / 2.0 - 0.5], [0, 1, -width / 2.0 - 0.5], [0, 0, 1]])
+    matrices = np.matmul(np.matmul(offset, matrices), reset)
+    return matrices, channel_shifts
+
+
+def warp_affine_batch(imgs, matrices):
+    """Bilinear warp of a batch of images, each with its own affine map, with reflected
+    borders (mode 'reflect' of scipy.ndimage: d c b a | a b c d | d c b a).
+    Input:
+    imgs: 4D array (n_imgs, height, width, channels)
+    matrices: float array (n_imgs, 3, 3), maps from output to input (row, col, 1)
+    Returns:
+    float32 array of the same shape as imgs
+    """
+    n_imgs, height, width, channels = imgs.shape
+    rows, cols = np.meshgrid(
+        np.arange(height, dtype=np.float32),
+        np.arange(width, dtype=np.float32),
+        indexing='ij',
+    )
+    matrices = matrices.astype(np.float32)
+    in_rows = (
+        matrices[:, 0, 0, None, None] * rows
+        + matrices[:, 0, 1, None, None] * cols
+        + matrices[:, 0, 2, None, None]
+    )
+    in_cols = (
+        matrices[:, 1, 0, None, None] * rows
+        + matrices[:, 1, 1, None, None] * cols
+        + matrices[:, 1, 2, None, None]
+    )
+
+    # images are padded once by reflection, wide enough for every sampled point and its
+    # neighbours, instead of reflecting each index
+    pad_rows = _pad_width(in_rows, height)
+    pad_cols = _pad_width(in_cols, width)
+    padded = np.pad(imgs, ((0, 0), pad_rows, pad_cols, (0, 0)), mode='symmetric')
+    padded_height, padded_width = padded.shape[1:3]
+
+    row0 = np.floor(in_rows)
+    col0 = np.floor(in_cols)
+    row_w = (in_rows - row0)[..., None]
+    col_w = (in_cols - col0)[..., None]
+    base = (np.arange(n_imgs, dtype=np.int32) * (padded_height * padded_width))[
+        :, None, None
+    ]
+    idx00 = (
+        base
+        + (row0.astype(np.int32) + pad_rows[0]) * padded_width
+        + (col0.astype(np.int32) + pad_cols[0])
+    )
+
+    flat = padded.reshape(-1, channels)
+
+    def sample(offset):
+        return np.take(flat, idx00 + offset, axis=0).astype(np.float32)
+
+    top = sample(0)
+    top += (sample(1) - top) * col_w
+    bottom = sample(padded_width)
+    bottom += (sample(padded_width + 1) - bottom) * col_w
+    top += (bottom - top) * row_w
+    return top
+
+
+def _pad_width(coords, size):
+    before = max(0, -int(np.floor(coords.min())))
+    after = max(0, int(np.floor(coords.max())) + 2 - size)
+    return before, after
+
+
+def augment_batch(imgs, seed, params=None, start=0):
+    """Randomly transform a batch of images for test-time augmentation.
+    Input:
+    imgs: 4D array (n_imgs, height, width, channels), not normalised
+    seed: integer, the same seed gives the same transform at the same position
+    params: dict, ranges of the transforms. Default: TTA_PARAMS
+    start: integer, position of imgs[0] in the seeded batch, when augmenting it in parts
+    Returns:
+    float32 array of transformed images, in the order of imgs
+    """
+    if params is None:
+        params = TTA_PARAMS
+    n_imgs, height, width, _ = imgs.shape
+    matrices, channel_shifts = random_affine_params(
+        n_imgs, height, width, seed, start, **params
+    )
+
+    out = np.empty(imgs.shape, dtype=np.float32)
+    for sid in range(0, n_imgs, WARP_BLOCK_SIZE):
+        eid = min(sid + WARP_BLOCK_SIZE, n_imgs)
+        out[sid:eid] = warp_affine_batch(imgs[sid:eid], matrices[sid:eid])
+
+    # channel shift, clipped to the range of each input image
+    axes = (1, 2, 3)
+    min_vals = imgs.min(axis=axes).astype(np.float32)[:, None, None, None]
+    max_vals = imgs.max(axis=axes).astype(np.float32)[:, None, None, None]
+    out += channel_shifts.astype(np.float32)[:, None, None, None]
+    np.clip(out, min_vals, max_vals, out=out)
+    return out
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Binary store for embeddings and their labels.
+
+A store with a given prefix is a pair of .npy files in a folder:
+    <prefix>_emb.npy - float32 array (num_emb, emb_size)
+    <prefix>_lbl.npy - structured array (num_emb,) of strings, one field per info column
+                       (eg. class, file, name); field names are the csv header
+
+Both files can be opened with np.load(..., mmap_mode='r') without parsing or copying,
+and are written/read without pickle. Stores replace the pair of _emb.csv/_lbl.csv files
+written by utils.export_emb; csv pairs are still read when no store exists.
+
+A folder of stores can be consolidated into a single database matrix
+(db-matrix.npy, db-matrix-info.npy) which is memory-mapped by open_db_embeddings,
+so every process querying the same database shares one page-cache copy of it.
+"""
+
+import os
+import json
+import hashlib
+from glob import glob
+
+import numpy as np
+
+EMB_SUFFIX = '_emb.npy'
+LBL_SUFFIX = '_lbl.npy'
+CSV_EMB_SUFFIX = '_emb.csv'
+CSV_LBL_SUFFIX = '_lbl.csv'
+DB_MATRIX_FNAME = 'db-matrix.npy'
+DB_INFO_FNAME = 'db-matrix-info.npy'
+DB_MANIFEST_FNAME = 'db-matrix.json'
+
+
+def _info_header(info_header, n_cols):
+    if info_header is None:
+        return ['info_' + str(i) for i in range(n_cols)]
+    # headers are often given as one comma separated string, eg. ['class,file,name']
+    info_header = ','.join(map(str, info_header)).split(',')
+    return info_header[:n_cols]
+
+
+def info_to_records(info, info_header=None):
+    """Pack a list of 1D arrays of extra information into a structured string array."""
+    columns = [np.asarray(col).astype(str) for col in info]
+    names = _info_header(info_header, len(columns))
+    dtype = [(name, col.dtype) for name, col in zip(names, columns)]
+    records = np.zeros(len(columns[0]), dtype=dtype)
+    for name, col in zip(names, columns):
+        records[name] = col
+    return records
+
+
+def records_to_info(records):
+    """Unpack a structured string array to a 2D string array, one column per field."""
+    if len(records.dtype.names) == 0:
+        return np.zeros((len(records), 0), dtype=str)
+    return np.stack([records[name] for name in records.dtype.names], axis=-1)
+
+
+def save_emb_store(emb, info=None, folder='', prefix='prefix', info_header=None):
+    """Export embeddings and extra information (labels, filenames) to a binary store.
+    Same arguments as utils.export_emb.
+    Input:
+    emb: 2D float array (num_emb, emb_size):  embeddings, stored as float32
+    info: list of string 1D arrays of size (num_emb,): extra information to each embedding: label, filename, class_name
+    folder: string, folder to save files
+    prefix: string to add to each filename
+    info_header: list of strings, list of headers for info list
+    Returns:
+    path to the embeddings file
+    """
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    filename_emb = os.path.join(folder, prefix + EMB_SUFFIX)
+    save_npy_atomic(filename_emb, np.asarray(emb, dtype=np.float32))
+    print('Embeddings are saved to file: {}'.format(filename_emb))
+
+    if info is not None:
+        filename_info = os.path.join(folder, prefix + LBL_SUFFIX)
+        save_npy_atomic(filename_info, info_to_records(info, info_header))
+        print('Info is saved to file: {}'.format(filename_info))
+    return filename_emb
+
+
+def save_npy_atomic(filename, arr):
+    """np.save to a temporary file and rename it, so that readers (possibly
+    memory-mapping the file from another process) never see a partial array."""
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as tmp_file:
+        np.save(tmp_file, arr)
+    os.replace(tmp_filename, filename)
+
+
+def load_emb_store(filename_emb, mmap_mode=None):
+    """Read a store written by save_emb_store.
+    Input:
+    filename_emb: string, path to a <prefix>_emb.npy file
+    mmap_mode: None or 'r', if 'r' the embeddings are memory-mapped instead of read
+    Returns:
+    emb - 2D float32 array (num_emb, emb_size)
+    info - 2D string array (num_emb, num_info) or None if there is no label file
+    info_header - list of strings or None
+    """
+    emb = np.load(filename_emb, mmap_mode=mmap_mode)
+    filename_info = filename_emb[: -len(EMB_SUFFIX)] + LBL_SUFFIX
+    if not os.path.exists(filename_info):
+        return emb, None, None
+    records = np.load(filename_info)
+    return emb, records_to_info(records), list(records.dtype.names)
+
+
+def read_csv_pair(filename_emb):
+    """Read embeddings and info from a pair of _emb.csv/_lbl.csv files written by export_emb."""
+    emb = np.genfromtxt(filename_emb, delimiter=',', skip_header=1)
+    if len(emb.shape) == 1:
+        emb = np.expand_dims(emb, 0)
+
+    filename_info = filename_emb[: -len(CSV_EMB_SUFFIX)] + CSV_LBL_SUFFIX
+    info = np.genfromtxt(filename_info, dtype=str, delimiter=',', skip_header=1)
+    if len(info.shape) == 1:
+        info = np.expand_dims(info, 0)
+    with open(filename_info) as info_file:
+        info_header = info_file.readline().lstrip('# ').strip().split(',')
+    return emb, info, info_header
+
+
+def convert_csv_to_store(filename_emb, folder=None):
+    """Convert a pair of _emb.csv/_lbl.csv files to a binary store with the same prefix.
+    Input:
+    filename_emb: string, path to a <prefix>_emb.csv file
+    folder: string or None, folder for the store. Default: folder of the csv files
+    Returns:
+    path to the embeddings file of the store
+    """
+    src_folder, basename = os.path.split(filename_emb)
+    prefix = basename[: -len(CSV_EMB_SUFFIX)]
+    if folder is None:
+        folder = src_folder
+    emb, info, info_header = read_csv_pair(filename_emb)
+    return save_emb_store(
+        emb, info=list(info.T), folder=folder, prefix=prefix, info_header=info_header
+    )
+
+
+def find_emb_files(folder):
+    """List embedding files in a folder: binary stores and csv files without a store."""
+    stores = sorted(glob(os.path.join(folder, '*' + EMB_SUFFIX)))
+    csvs = sorted(glob(os.path.join(folder, '*' + CSV_EMB_SUFFIX)))
+    store_prefixes = set(fname[: -len(EMB_SUFFIX)] for fname in stores)
+    csvs = [
+        fname for fname in csvs if fname[: -len(CSV_EMB_SUFFIX)] not in store_prefixes
+    ]
+    return stores + csvs
+
+
+def read_db_embeddings(folder, mmap_mode=None):
+    """Read and concatenate every embedding store (or csv pair) in a folder.
+    Every store needs a label file: database embeddings are matched by their labels.
+    Returns:
+    db_embs - 2D float array (num_emb, emb_size)
+    db_info - 2D string array (num_emb, num_info)
+    """
+    db_embs = []
+    db_info = []
+    for filename in find_emb_files(folder):
+        print('Reading embeddings from file {}'.format(filename))
+        if filename.endswith(EMB_SUFFIX):
+            emb, info, _ = load_emb_store(filename, mmap_mode=mmap_mode)
+        else:
+            emb, info, _ = read_csv_pair(filename)
+        if info is None:
+            raise IOError(
+                'Embedding store {} has no label file {}: database embeddings need '
+                'labels'.format(filename, filename[: -len(EMB_SUFFIX)] + LBL_SUFFIX)
+            )
+        db_embs.append(emb)
+        db_info.append(info)
+
+    if len(db_embs) == 0:
+        raise IOError('No embeddings are found in {}'.format(folder))
+    db_embs = np.concatenate(db_embs, axis=0)
+    db_info = np.concatenate(db_info, axis=0)
+    return db_embs, db_info
+
+
+def _sources_manifest(folder):
+    sources = find_emb_files(folder)
+    return [
+        [os.path.basename(fname), os.stat(fname).st_size, os.stat(fname).st_mtime_ns]
+        for fname in sources
+    ]
+
+
+def consolidate_db_embeddings(folder):
+    """Concatenate every embedding store (or csv pair) in a folder into a single
+    database matrix db-matrix.npy with its info in db-matrix-info.npy.
+    The list of consolidated files is kept in db-matrix.json to detect stale matrices.
+    Input:
+    folder: string, folder with embedding stores
+    Returns:
+    path to the database matrix
+    """
+    manifest = _sources_manifest(folder)
+    db_embs, db_info = read_db_embeddings(folder)
+    filename_emb = os.path.join(folder, DB_MATRIX_FNAME)
+    save_npy_atomic(filename_emb, np.asarray(db_embs, dtype=np.float32))
+    save_npy_atomic(os.path.join(folder, DB_INFO_FNAME), info_to_records(list(db_info.T)))
+    # the manifest is written last: a matrix is only used once it is complete
+    manifest_fpath = os.path.join(folder, DB_MANIFEST_FNAME)
+    tmp_fpath = '{}.{}.tmp'.format(manifest_fpath, os.getpid())
+    with open(tmp_fpath, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_fpath, manifest_fpath)
+    print(
+        'Database matrix of {} embeddings is saved to {}'.format(
+            len(db_embs), filename_emb
+        )
+    )
+    return filename_emb
+
+
+def _db_matrix_is_current(folder):
+    manifest_fpath = os.path.join(folder, DB_MANIFEST_FNAME)
+    for fname in (DB_MATRIX_FNAME, DB_INFO_FNAME, DB_MANIFEST_FNAME):
+        if not os.path.exists(os.path.join(folder, fname)):
+            return False
+    with open(manifest_fpath) as manifest_file:
+        return json.load(manifest_file) == _sources_manifest(folder)
+
+
+def open_db_embeddings(folder):
+    """Memory-map the database matrix of a folder, consolidating the stores first
+    if the matrix is missing or older than the stores.
+    Embeddings are not read or copied: pages are loaded on demand and shared through
+    the page cache between all processes opening the same matrix.
+    Input:
+    folder: string, folder with embedding stores
+    Returns:
+    db_embs - read-only memory-mapped 2D float32 array (num_emb, emb_size)
+    db_info - 2D string array (num_emb, num_info)
+    """
+    if not _db_matrix_is_current(folder):
+        consolidate_db_embeddings(folder)
+    db_embs = np.load(os.path.join(folder, DB_MATRIX_FNAME), mmap_mode='r')
+    db_info = records_to_info(np.load(os.path.join(folder, DB_INFO_FNAME), mmap_mode='r'))
+    return db_embs, db_info
+
+
+def db_matrix_key(folder):
+    """Key identifying the current database matrix of a folder, computed from its
+    manifest (names, sizes and modification times of the consolidated files),
+    so it costs no pass over the embeddings. Call after open_db_embeddings.
+    """
+    with open(os.path.join(folder, DB_MANIFEST_FNAME), 'rb') as manifest_file:
+        hasher = hashlib.sha1(manifest_file.read())
+    hasher.update(os.path.realpath(folder).encode('utf-8'))
+    return hasher.hexdigest()[:16]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        description='Convert _emb.csv/_lbl.csv pairs in a folder to binary embedding stores.'
+    )
+    argparser.add_argument('folder', help='Folder with csv files written by export_emb')
+    args = argparser.parse_args()
+    for filename in sorted(glob(os.path.join(args.folder, '*' + CSV_EMB_SUFFIX))):
+        convert_csv_to_store(filename)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of backbone features.
+
+Features of an image are the outputs of BaseModel.backend_model (the feature extractor
+up to connect_layer) on the normalised image. They only depend on the image and on the
+backbone, so while the backbone is frozen (see BaseModel.backbone_frozen) they can be
+computed once and reused to train or evaluate heads on top of them.
+
+Features are stored one .npy file per image:
+    <folder>/<backbone key>/<image hash[:2]>/<image hash>.npy
+where the image hash is a sha1 of the decoded image (shape, dtype and pixels) and the
+backbone key is BaseModel.backbone_key(): backend, connect_layer, input shape and a digest
+of the backbone weights. Retraining the head does not change the key; fine-tuning the
+backbone does.
+"""
+
+import os
+import sys
+import hashlib
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from emb_store import save_npy_atomic  # NOQA
+
+
+def image_hash(img):
+    """Content hash of one decoded image."""
+    img = np.ascontiguousarray(img)
+    hasher = hashlib.sha1(repr((img.shape, img.dtype.str)).encode('utf-8'))
+    hasher.update(img.tobytes())
+    return hasher.hexdigest()
+
+
+class FeatureCache(object):
+    """Backbone features of images, computed on first use and read from disk after.
+
+    Input:
+    folder: string, root folder of the cache, shared by every backbone
+    model: BaseModel whose backend_model computes the features
+    """
+
+    def __init__(self, folder, model):
+        self.model = model
+        self.folder = os.path.join(folder, model.backbone_key())
+        self.hits = 0
+        self.misses = 0
+
+    def _fpath(self, img_hash):
+        return os.path.join(self.folder, img_hash[:2], img_hash + '.npy')
+
+    def features(self, imgs, batch_size=32):
+        """Features of a set of images, in the order of imgs.
+        Input:
+        imgs: 4D array of images, not normalised, resized to the model input
+        batch_size: integer, batch size of the backbone for missing features
+        Returns:
+        float32 array (num_images,) + model.features_shape
+        """
+        features = np.zeros((len(imgs),) + tuple(self.model.features_shape), 'float32')
+        missing = []
+        for i, img in enumerate(imgs):
+            fpath = self._fpath(image_hash(img))
+            if os.path.exists(fpath):
+                features[i] = np.load(fpath)
+            else:
+                missing.append((i, fpath))
+        self.hits += len(imgs) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            print(
+                'Computing backbone features of {} of {} images'.format(
+                    len(missing), len(imgs)
+                )
+            )
+        for sid in range(0, len(missing), batch_size):
+            batch = missing[sid : sid + batch_size]
+            idx = [i for i, _ in batch]
+            batch_features = self.model.precompute_features(imgs[idx], batch_size)
+            for (i, fpath), feats in zip(batch, batch_features):
+                features[i] = feats
+                if not os.path.exists(os.path.dirname(fpath)):
+                    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                save_npy_atomic(fpath, np.asarray(feats, dtype='float32'))
+        return features
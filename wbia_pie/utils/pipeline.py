@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """Accumulates wall-clock time spent in each stage of a pipeline.
+    Stages can be timed from several threads at once, so the sum of all stages
+    can be larger than the elapsed time when the stages overlap.
+
+    # Example
+        ```python
+            timer = StageTimer()
+            with timer.stage('decode'):
+                imgs = load_resized_imgs(files, size)
+            timer.report()
+        ```
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self.totals)
+
+    def report(self):
+        with self._lock:
+            for name, total in self.totals.items():
+                print(
+                    'Stage {}: {:.3f} s in {} calls ({:.4f} s per call)'.format(
+                        name, total, self.counts[name], total / self.counts[name]
+                    )
+                )
+
+
+def prefetch(func, items, n_workers=4, queue_depth=8, timer=None):
+    """Yield func(item) for every item, in order, while the next items are computed
+    by a pool of worker threads. At most queue_depth results are computed ahead of the
+    consumer, which bounds the memory held by the pipeline.
+    Input:
+    func: callable applied to each item, eg. decoding and normalising a batch of images
+    items: iterable of inputs to func
+    n_workers: integer, number of worker threads. If 0, func is run in the calling thread
+    queue_depth: integer, maximum number of results computed ahead
+    timer: StageTimer or None, if provided the time the consumer waits on workers
+           is recorded as stage 'wait'
+    """
+    if n_workers <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    queue_depth = max(1, queue_depth)
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= queue_depth:
+                yield _wait_result(pending.popleft(), timer)
+        while pending:
+            yield _wait_result(pending.popleft(), timer)
+    finally:
+        # consumer stopped early or a worker failed: do not compute the rest
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _wait_result(future, timer):
+    if timer is None:
+        return future.result()
+    with timer.stage('wait'):
+        return future.result()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of preprocessed chips, shared by every preprocessing call.
+
+An entry is one chip resized to the network input and saved as png (resize_to_png):
+    <folder>/entries/<key[:2]>/<key>.png
+where the key is a sha1 of the chip file (real path, size and modification time), the
+target size and the flip flag, so an entry is computed once whatever the set of annots it
+is requested with, and a chip that is regenerated gets a new key.
+
+PIE reads its datasets from a folder with one sub-folder per label. Each call builds a
+dataset of its own from hard links to the entries:
+    <folder>/datasets/<pid>.<uuid>/<label>/<file>.png
+which stays readable whatever other writers evict, and is removed by release() once it has
+been read. Datasets left behind by processes that are no longer running are removed by the
+next call, and a process keeps at most max_datasets of its own.
+
+The total size of the entries is bounded: the least recently used entries are evicted
+first. Use times are kept in an index file rather than as file times, as entries may be
+hard links to the chips themselves. Every update of the index reads, changes and rewrites
+it under a lock file, so concurrent writers (threads or processes sharing the folder)
+merge their entries; chips are preprocessed outside of the lock. gc() and stats() also
+walk entries/, so files missing from the index (e.g. left by an interrupted call) are
+still evicted.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+from preprocessing import resize_to_png  # NOQA
+
+INDEX_FNAME = 'index.json'
+LOCK_FNAME = 'index.lock'
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def _sha1(obj):
+    return hashlib.sha1(repr(obj).encode('utf-8')).hexdigest()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PreprocCache(object):
+    """Preprocessed chips, computed on first use and evicted least recently used first.
+
+    Input:
+    folder: string, root folder of the cache
+    max_mb: float or None, bound on the total size of the entries. Default: no bound
+    n_workers: integer or None, threads preprocessing missing chips. Default: os.cpu_count()
+    max_datasets: integer, datasets this process keeps before removing the oldest ones
+    not released yet. Default: 16
+    """
+
+    def __init__(self, folder, max_mb=None, n_workers=None, max_datasets=16):
+        self.folder = folder
+        self.max_mb = max_mb
+        self.n_workers = n_workers
+        self.max_datasets = max_datasets
+        self.hits = 0
+        self.misses = 0
+        # flock is held per open file, threads of a process also need a lock of their own
+        self._thread_lock = threading.Lock()
+
+    def key(self, chip_fpath, size, flip=False):
+        """Key of the entry of a chip resized to size, flipped or not."""
+        stat = os.stat(chip_fpath)
+        ident = (
+            os.path.realpath(chip_fpath),
+            stat.st_size,
+            stat.st_mtime_ns,
+            tuple(int(s) for s in size),
+            bool(flip),
+        )
+        return _sha1(ident)
+
+    def _entry_fpath(self, key):
+        return os.path.join(self.folder, 'entries', key[:2], key + '.png')
+
+    def _datasets_dir(self):
+        return os.path.join(self.folder, 'datasets')
+
+    def _load_index(self):
+        index_fpath = os.path.join(self.folder, INDEX_FNAME)
+        if os.path.exists(index_fpath):
+            try:
+                with open(index_fpath, 'r') as f:
+                    index = json.load(f)
+                # datasets were recorded in the index by earlier versions
+                index.pop('datasets', None)
+                return index
+            except ValueError:
+                print('Ignoring unreadable cache index {}'.format(index_fpath))
+        return {'entries': {}}
+
+    def _save_index(self, index):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        index_fpath = os.path.join(self.folder, INDEX_FNAME)
+        tmp_fpath = '{}.{}.tmp'.format(index_fpath, os.getpid())
+        with open(tmp_fpath, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_fpath, index_fpath)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Index loaded under the lock file, saved back on exit."""
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        with self._thread_lock:
+            with open(os.path.join(self.folder, LOCK_FNAME), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    index = self._load_index()
+                    yield index
+                    self._save_index(index)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _add_entry(self, key, chip_fpath, size):
+        # preprocessed in a folder of its own, then moved in place
+        tmp_dir = os.path.join(self.folder, 'tmp', '{}.{}'.format(key, os.getpid()))
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            png_file = resize_to_png(chip_fpath, tmp_dir, size)
+            entry_fpath = self._entry_fpath(key)
+            os.makedirs(os.path.dirname(entry_fpath), exist_ok=True)
+            os.replace(png_file, entry_fpath)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return os.path.getsize(entry_fpath)
+
+    def _entries(self, chip_fpaths, size, flips):
+        if flips is None:
+            flips = [False] * len(chip_fpaths)
+        keys = [
+            self.key(chip_fpath, size, flip)
+            for chip_fpath, flip in zip(chip_fpaths, flips)
+        ]
+
+        with self._locked_index() as index:
+            missing = {}
+            for key, chip_fpath in zip(keys, chip_fpaths):
+                if key in index['entries'] and os.path.exists(self._entry_fpath(key)):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    missing[key] = chip_fpath
+
+        added = {}
+        if len(missing) > 0:
+            print(
+                'Preprocessing {} of {} chips into {}'.format(
+                    len(missing), len(chip_fpaths), self.folder
+                )
+            )
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                sizes = pool.map(
+                    lambda item: self._add_entry(item[0], item[1], size),
+                    missing.items(),
+                )
+                for key, n_bytes in zip(missing.keys(), sizes):
+                    added[key] = {'bytes': n_bytes}
+        return keys, added
+
+    def dataset(self, chip_fpaths, size, labels, fnames, flips=None):
+        """Folder with one sub-folder per label of preprocessed chips, as read by
+        read_dataset. The folder belongs to the caller, who removes it with release().
+        Input:
+        chip_fpaths: list of strings, paths to chips (already flipped if need be)
+        size: 2D tuple, target size of chips (width, height)
+        labels: list of strings, label of each chip
+        fnames: list of strings, file name of each chip in its label folder
+        flips: list of booleans, whether each chip is flipped. Default: none are
+        Returns:
+        path to the dataset folder
+        """
+        keys, added = self._entries(chip_fpaths, size, flips)
+        self._remove_stale_datasets()
+        dataset_dir = os.path.join(
+            self._datasets_dir(), '{}.{}'.format(os.getpid(), uuid.uuid4().hex)
+        )
+
+        # merged into the index as it is on disk now, not as it was before preprocessing
+        with self._locked_index() as index:
+            index['entries'].update(added)
+            chip_fpath_map = dict(zip(keys, chip_fpaths))
+            now = time.time()
+            for key in keys:
+                if not os.path.exists(self._entry_fpath(key)):
+                    # evicted by another writer meanwhile
+                    n_bytes = self._add_entry(key, chip_fpath_map[key], size)
+                    index['entries'][key] = {'bytes': n_bytes}
+                index['entries'][key]['used'] = now
+
+            # linked under the lock, so entries are not evicted before they are linked
+            os.makedirs(dataset_dir)
+            for key, label, fname in zip(keys, labels, fnames):
+                label_dir = os.path.join(dataset_dir, label)
+                if not os.path.isdir(label_dir):
+                    os.makedirs(label_dir)
+                dest = os.path.join(label_dir, fname)
+                if not os.path.exists(dest):
+                    _link_or_copy(self._entry_fpath(key), dest)
+
+            self._gc(index, keep=keys)
+        return dataset_dir
+
+    def release(self, dataset_dir):
+        """Remove a dataset folder returned by dataset(), once it has been read."""
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    def _remove_stale_datasets(self):
+        # datasets of processes that are gone, and the oldest ones of this process beyond
+        # max_datasets; datasets of other running processes may still be read
+        datasets_dir = self._datasets_dir()
+        if not os.path.isdir(datasets_dir):
+            return 0
+        own_dirs = []
+        num_removed = 0
+        for dname in os.listdir(datasets_dir):
+            dataset_dir = os.path.join(datasets_dir, dname)
+            try:
+                pid = int(dname.split('.')[0])
+            except ValueError:
+                # left by an earlier version
+                pid = None
+            if pid == os.getpid():
+                own_dirs.append(dataset_dir)
+            elif pid is None or not _pid_alive(pid):
+                shutil.rmtree(dataset_dir, ignore_errors=True)
+                num_removed += 1
+        own_dirs.sort(key=lambda dataset_dir: os.path.getmtime(dataset_dir))
+        # one more is about to be built by dataset()
+        for dataset_dir in own_dirs[: max(0, len(own_dirs) - self.max_datasets + 1)]:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+            num_removed += 1
+        return num_removed
+
+    def stats(self):
+        """Size and use of the cache.
+        Returns:
+        dict with the folder, number and total size (MB) of entries, number of datasets,
+        size bound (MB), and hits and misses of this cache object
+        """
+        with self._locked_index() as index:
+            self._adopt_files(index)
+        n_bytes = sum(entry['bytes'] for entry in index['entries'].values())
+        datasets_dir = self._datasets_dir()
+        num_datasets = len(os.listdir(datasets_dir)) if os.path.isdir(datasets_dir) else 0
+        return {
+            'folder': self.folder,
+            'num_entries': len(index['entries']),
+            'num_datasets': num_datasets,
+            'size_mb': n_bytes / (1024.0 * 1024.0),
+            'max_mb': self.max_mb,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def gc(self, max_mb=None):
+        """Evict least recently used entries until the cache fits in max_mb, remove the
+        datasets of processes that are no longer running, and drop index records of
+        removed files.
+        Input:
+        max_mb: float or None, size bound. Default: the bound of the cache; 0 empties it
+        Returns:
+        dict with the number of evicted entries and removed datasets
+        """
+        removed_datasets = self._remove_stale_datasets()
+        with self._locked_index() as index:
+            self._adopt_files(index)
+            result = self._gc(index, max_mb=max_mb)
+        result['removed_datasets'] = removed_datasets
+        return result
+
+    def _adopt_files(self, index):
+        # entries on disk but not in the index, as least recently used, and records of
+        # entries no longer on disk
+        entries = index['entries']
+        entries_dir = os.path.join(self.folder, 'entries')
+        if os.path.isdir(entries_dir):
+            for sub_dir in os.listdir(entries_dir):
+                for fname in os.listdir(os.path.join(entries_dir, sub_dir)):
+                    key, ext = os.path.splitext(fname)
+                    if ext != '.png' or key in entries:
+                        continue
+                    n_bytes = os.path.getsize(self._entry_fpath(key))
+                    entries[key] = {'bytes': n_bytes, 'used': 0}
+        for key in [key for key in entries if not os.path.exists(self._entry_fpath(key))]:
+            del entries[key]
+
+    def _gc(self, index, max_mb=None, keep=()):
+        if max_mb is None:
+            max_mb = self.max_mb
+        entries = index['entries']
+
+        evicted = []
+        if max_mb is not None:
+            keep = set(keep)
+            max_bytes = max_mb * 1024 * 1024
+            n_bytes = sum(entry['bytes'] for entry in entries.values())
+            lru_keys = sorted(entries, key=lambda key: entries[key].get('used', 0))
+            for key in lru_keys:
+                if n_bytes <= max_bytes:
+                    break
+                if key in keep:
+                    continue
+                entry_fpath = self._entry_fpath(key)
+                if os.path.exists(entry_fpath):
+                    # datasets linking to it keep their own link
+                    os.remove(entry_fpath)
+                n_bytes -= entries[key]['bytes']
+                evicted.append(key)
+        for key in evicted:
+            del entries[key]
+
+        if len(evicted) > 0:
+            print('Evicted {} chips from {}'.format(len(evicted), self.folder))
+        return {'evicted_entries': len(evicted)}
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import struct
 import cv2
 import numpy as np
 from imageio import imread, imsave
@@ -213,6 +215,141 @@ def resize_imgs(src, dest, size, del_src=False):
         return resized_files[0]
 
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(file):
+    """Size (width, height) of a png file read from its header, None if not a png."""
+    with open(file, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def resize_to_png(src, dest, size):
+    """Resize one image and save it as png in a dest folder, with the same pixels as
+    resize_imgs followed by convert_to_fmt(..., imformat='png') (better for lossy
+    sources, which are encoded once instead of twice) and half the reading and writing.
+    A png already at the target size is hard-linked (copied across file systems)
+    instead: the output must then not be modified in place. Outputs are written to a
+    temporary file and moved in place, so an existing output linked to a source image
+    is replaced rather than written through.
+    Input:
+    src: string, path to image
+    dest: string, target folder for the png image
+    size: 2D tuple, target size of image (width, height)
+    Returns:
+    path to the png image
+    """
+    if not os.path.exists(dest):
+        os.mkdir(dest)
+    file_noext = os.path.splitext(os.path.basename(src))[0]
+    png_file = os.path.join(dest, file_noext + '.png')
+    same_file = os.path.exists(png_file) and os.path.samefile(src, png_file)
+
+    # keeps the png extension, OpenCV picks the encoder from it
+    tmp_file = '{}.{}.tmp.png'.format(os.path.splitext(png_file)[0], os.getpid())
+
+    if png_size(src) == tuple(size):
+        if not same_file:
+            try:
+                os.link(src, tmp_file)
+            except OSError:
+                shutil.copyfile(src, tmp_file)
+            os.replace(tmp_file, png_file)
+        return png_file
+
+    img = imread(src)
+    res = cv2.resize(img, tuple(size), interpolation=cv2.INTER_LINEAR)
+    if png_size(src) is None:
+        # convert_to_fmt reads non-png images as 3 channel colour images
+        if len(res.shape) == 2:
+            res = np.stack((res, res, res), -1)
+        res = res[:, :, :3]
+    # encoded with OpenCV as in convert_to_fmt, much faster than imsave for png
+    if len(res.shape) == 3 and res.shape[2] == 3:
+        res = cv2.cvtColor(res, cv2.COLOR_RGB2BGR)
+    elif len(res.shape) == 3 and res.shape[2] == 4:
+        res = cv2.cvtColor(res, cv2.COLOR_RGBA2BGRA)
+    cv2.imwrite(tmp_file, res)
+    os.replace(tmp_file, png_file)
+
+    # like convert_to_fmt, do not leave the source behind in the dest folder
+    if not same_file and os.path.dirname(os.path.abspath(src)) == os.path.abspath(dest):
+        os.remove(src)
+    return png_file
+
+
+def multiply_by_masks(chips, masks):
+    """Background subtraction of a batch of chips: each chip multiplied by its
+    foreground mask, with the same pixels as vt.blend_images_multiply (alpha 0.5)
+    followed by rounding back to uint8, one chip at a time.
+    round(255 * (c / 255) * (m / 255)) in float32 is (c * m + 127) // 255 for every pair
+    of uint8 values, which is computed in uint16 without any float copy of the batch.
+    Input:
+    chips: 4D uint8 array (n_imgs, height, width, channels)
+    masks: uint8 array broadcastable to chips, foreground probability in [0, 255]
+    Returns:
+    4D uint8 array of the shape of chips
+    """
+    blended = chips.astype(np.uint16)
+    blended *= masks
+    blended += 127
+    blended //= 255
+    return blended.astype(np.uint8)
+
+
+def load_resized_img(file, size):
+    """Read an image and resize it in memory to the network input size.
+    Gives the same pixels as resize_imgs followed by convert_to_fmt and read_dataset
+    for lossless inputs, without writing any files.
+    Input:
+    file: string, path to image
+    size: 2D tuple, target size of image (width, height)
+    Returns:
+    3D uint8 array of shape (height, width, 3)
+    """
+    img = imread(file)
+    if (img.shape[1], img.shape[0]) != tuple(size):
+        img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_LINEAR)
+    if len(img.shape) == 2:
+        img = np.stack((img, img, img), -1)
+    return img[:, :, :3]
+
+
+def load_resized_imgs(files, size, data_type='uint8'):
+    """Read and resize a list of images into one batch, in the order of files.
+    Input:
+    files: list of strings, paths to images
+    size: 2D tuple, target size of images (width, height)
+    data_type: string, data type of the batch
+    Returns:
+    4D array of shape (len(files), height, width, 3)
+    """
+    X = np.zeros((len(files), size[1], size[0], 3), dtype=data_type)
+    for i, file in enumerate(files):
+        X[i] = load_resized_img(file, size)
+    return X
+
+
+def chunk_size_for_memory(max_memory_mb, input_shape, batch_size=None):
+    """Number of images per chunk so that a chunk fits in a memory ceiling.
+    Each image is held as uint8 and once more as a normalised copy (float64 at worst).
+    Input:
+    max_memory_mb: float, memory ceiling in megabytes
+    input_shape: 3D tuple, (height, width, channels) of network input
+    batch_size: integer or None, if provided the chunk is rounded down to a multiple of it
+    Returns:
+    integer, number of images per chunk (at least 1)
+    """
+    bytes_per_img = int(np.prod(input_shape)) * (1 + 8)
+    chunk_size = max(1, int(max_memory_mb * 1024 * 1024) // bytes_per_img)
+    if batch_size is not None and chunk_size > batch_size:
+        chunk_size -= chunk_size % batch_size
+    return chunk_size
+
+
 def get_bound_box(filename):
     """Find bounding box for masked image.
     --------------------------------------
@@ -338,6 +475,68 @@ def read_dataset(
         return X, y, class_dict
 
 
+def dataset_labels(filenames, original_labels=False):
+    """Labels for files in a dataset where each class is in a subdirectory,
+    numbered in the same way as read_dataset. No images are read.
+    Input:
+    filenames: list of strings, paths to images as returned by glob(img_dir + '/*/*')
+    original_labels: boolean, if True, subdirectory names are returned instead of integers
+    Returns:
+    y - 1D labels
+    class_dict - dictionary of labels and subdir names
+    """
+    class_dict = {}
+    y = []
+    label_count = 0
+    for file in filenames:
+        subfolder = os.path.basename(os.path.dirname(file))
+        if subfolder not in class_dict:
+            class_dict[subfolder] = label_count
+            label_count += 1
+        if original_labels:
+            y.append(subfolder)
+        else:
+            y.append(class_dict[subfolder])
+    y = np.array(y)
+    class_dict.update({v: k for k, v in class_dict.items()})
+    return y, class_dict
+
+
+def iter_dataset(img_dir, chunk_size, size=None, original_labels=False):
+    """Streaming version of read_dataset: yields the dataset in chunks so that only
+    chunk_size images are in memory at a time.
+    img_dir: string, path to image directory, each class is in a subdirectory
+    chunk_size: integer, number of images per chunk
+    size: 2D tuple or None, (width, height) to resize images to. Images are expected
+          to be of the same size if None.
+    original_labels: boolean, if True, an original labels returned, if False, integer labels are returned
+
+    Yields:
+    X - uint8 ndarray of images in the chunk
+    y - 1D labels of the chunk
+    class_dict - dictionary of labels and subdir names (for the whole dataset)
+    filenames - array of filenames of the chunk
+    """
+    print('Streaming files from {}'.format(img_dir))
+    filenames = glob(img_dir + '/*/*')
+    print('Found %d files' % len(filenames))
+    y, class_dict = dataset_labels(filenames, original_labels)
+
+    for start in range(0, len(filenames), chunk_size):
+        chunk_files = filenames[start : start + chunk_size]
+        if size is None:
+            chunk_size_ = len(chunk_files)
+            X = None
+            for i, file in enumerate(chunk_files):
+                img = imread(file)
+                if X is None:
+                    X = np.zeros((chunk_size_,) + img.shape[:2] + (3,), dtype='uint8')
+                X[i] = img[:, :, :3]
+        else:
+            X = load_resized_imgs(chunk_files, size)
+        yield X, y[start : start + chunk_size], class_dict, chunk_files
+
+
 def split_classes(
     dataset, labels, test_size=0.15, seed=None, return_mask=False, split_num=-1
 ):
@@ -26,6 +26,29 @@ def make_batches(size, batch_size):
     return [(i * batch_size, min(size, (i + 1) * batch_size)) for i in range(num_batches)]
 
 
+def make_seeded_batches(size, batch_size, seed_batch_size=None, offset=0):
+    """Batches of at most batch_size items that do not straddle two seeded batches, the
+    batches of seed_batch_size items test-time augmentation draws its transforms for.
+    Input:
+    size: integer, number of items
+    batch_size: integer, maximum size of a batch
+    seed_batch_size: integer or None, size of the seeded batches. Default: batch_size
+    offset: integer, number of items before the first one (eg. in previous chunks)
+    Returns:
+    list of tuples (start index, end index, position of the start in its seeded batch)
+    """
+    if seed_batch_size is None:
+        seed_batch_size = batch_size
+    batches = []
+    sid = 0
+    while sid < size:
+        start = (offset + sid) % seed_batch_size
+        eid = min(size, sid + batch_size, sid + seed_batch_size - start)
+        batches.append((sid, eid, start))
+        sid = eid
+    return batches
+
+
 def export_emb(emb, info=None, folder='', prefix='prefix', info_header=None):
     """Export embeddings and extra information (labels, filenames) to csv file
     Input: